@@ -0,0 +1 @@
+from . import load, models, monitor, packages, report
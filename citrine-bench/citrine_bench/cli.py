@@ -0,0 +1,126 @@
+import argparse
+import os
+import sys
+import time
+from typing import *
+
+import requests
+
+from citrine_bench import load, monitor, packages, report
+
+
+default_workdir = os.path.join(os.path.expanduser('~'), '.cache', 'citrine-bench')
+endpoints = ['run', '_run', 'async']
+
+
+def csv(value: str) -> List[str]:
+    return [v for v in value.split(',') if v]
+
+
+def cli_args(parser: argparse.ArgumentParser):
+    command = parser.add_subparsers(dest='command')
+
+    build = command.add_parser('build', help='Generate the benchmark packages')
+    build.add_argument('--workdir', default=default_workdir)
+    build.add_argument('--sizes', type=csv, default=list(packages.bench_packages.keys()))
+
+    run = command.add_parser('run', help='Install the benchmark packages and put load on the daemon')
+    run.add_argument('--server', default='http://127.0.0.1:5402')
+    run.add_argument('--workdir', default=default_workdir)
+    run.add_argument('--sizes', type=csv, default=list(packages.bench_packages.keys()))
+    run.add_argument('--endpoints', type=csv, default=endpoints)
+    run.add_argument('--concurrency', type=lambda v: [int(c) for c in csv(v)], default=[1, 4, 16])
+    run.add_argument('--duration', type=float, default=10, help='Seconds per scenario')
+    run.add_argument('--requests', type=int, help='Requests per scenario, instead of --duration')
+    run.add_argument('--warmup', type=int, default=10, help='Untimed requests before each scenario')
+    run.add_argument('--payloads', type=int, default=32, help='Distinct request bodies per scenario')
+    run.add_argument('--pid', type=int, help='Daemon process id, for CPU / RSS. Found automatically if left out')
+    run.add_argument('--skip-install', action='store_true')
+    run.add_argument('--output', default=f'citrine-bench-{time.strftime("%Y%m%d-%H%M%S")}.json')
+
+
+def build_packages(workdir: str, sizes: List[str]) -> Dict[str, str]:
+    package_root = os.path.join(workdir, 'packages')
+    os.makedirs(package_root, exist_ok=True)
+    built = {}
+    for size in sizes:
+        bench_package = packages.bench_packages[size]
+        print(f'Building {bench_package.name}', file=sys.stderr)
+        built[size] = packages.build_package(bench_package, package_root)
+    return built
+
+
+def install_package(server: str, package_dir: str, name: str):
+    # Goes through the daemon's install_package_file, same as `citrine package install --localfile`
+    resp = requests.post(f'{server}/package/install', json={'localfile': package_dir})
+    if resp.status_code == 200:
+        return
+    if resp.json().get('error') == 'Package Already Exists':
+        resp = requests.post(f'{server}/package/activate', json={'name': name})
+        if resp.status_code == 200:
+            return
+    raise RuntimeError(f'Failed to install {name}: {resp.text}')
+
+
+def make_target(bench_package: packages.BenchPackage, endpoint: str, n_payloads: int) -> load.Target:
+    if endpoint == '_run':
+        bodies = load.make_bodies(bench_package.raw_payload, n_payloads)
+        return load.Target(endpoint, f'/_run/{bench_package.name}/{packages.model_name}', bodies)
+    bodies = load.make_bodies(bench_package.make_payload, n_payloads)
+    path = f'/run/{bench_package.name}/{packages.function_name}'
+    if endpoint == 'async':
+        return load.Target(endpoint, f'/async{path}', bodies, poll=True)
+    return load.Target(endpoint, path, bodies)
+
+
+def command_build(args: Dict):
+    for size, package_dir in build_packages(args['workdir'], args['sizes']).items():
+        print(package_dir)
+
+
+def command_run(args: Dict):
+    server = args['server'].rstrip('/')
+    daemon_info = requests.get(f'{server}/').json()
+
+    if not args['skip_install']:
+        for size, package_dir in build_packages(args['workdir'], args['sizes']).items():
+            install_package(server, package_dir, packages.bench_packages[size].name)
+
+    pid = args['pid'] or monitor.find_daemon_pid()
+    if pid is None:
+        print('Could not find the daemon process; CPU / RSS will not be reported', file=sys.stderr)
+
+    results = []
+    for size in args['sizes']:
+        bench_package = packages.bench_packages[size]
+        for endpoint in args['endpoints']:
+            target = make_target(bench_package, endpoint, args['payloads'])
+            for concurrency in args['concurrency']:
+                print(f'{size} {endpoint} x{concurrency}', file=sys.stderr)
+                if args['warmup']:
+                    load.run_load(server, target, concurrency, n_requests=args['warmup'])
+                with monitor.ProcessMonitor(pid) as proc_monitor:
+                    result = load.run_load(
+                        server,
+                        target,
+                        concurrency,
+                        duration=None if args['requests'] else args['duration'],
+                        n_requests=args['requests'],
+                    )
+                results.append(report.scenario_result(size, endpoint, concurrency, result, proc_monitor.summary()))
+
+    report.write_report(args['output'], report.run_metadata(server, daemon_info, args), results)
+    print(report.format_table(results))
+    print(f'Wrote {args["output"]}', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='citrine-bench')
+    cli_args(parser)
+    args = vars(parser.parse_args())
+    if args['command'] == 'build':
+        command_build(args)
+    elif args['command'] == 'run':
+        command_run(args)
+    else:
+        parser.print_help()
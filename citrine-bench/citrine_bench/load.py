@@ -0,0 +1,119 @@
+import itertools
+import json
+import random
+import threading
+import time
+from typing import *
+
+import requests
+
+
+# How often /async jobs are polled for their result
+async_poll_interval = 0.005
+
+
+class Target(object):
+    """
+    One endpoint to hit, with a set of request bodies to cycle through
+    """
+
+    def __init__(self, endpoint: str, path: str, bodies: List[bytes], poll: bool = False):
+        self.endpoint = endpoint
+        self.path = path
+        self.bodies = bodies
+        # /async endpoints return a job handle; the request isn't done until the job is
+        self.poll = poll
+
+
+class LoadResult(object):
+    def __init__(self, latencies: List[float], errors: int, error_samples: List[str], wall_time: float):
+        self.latencies = latencies
+        self.errors = errors
+        self.error_samples = error_samples
+        self.wall_time = wall_time
+
+
+def make_bodies(make_payload: Callable[[random.Random], Dict], n: int, seed: int = 0) -> List[bytes]:
+    # Built up front, so the load generator spends its time waiting on the daemon instead of encoding
+    rng = random.Random(seed)
+    return [json.dumps(make_payload(rng)).encode('utf-8') for _ in range(n)]
+
+
+def _send(session: requests.Session, base_url: str, target: Target, body: bytes) -> Optional[str]:
+    """
+    :return: None on success, otherwise a description of what went wrong
+    """
+    resp = session.post(f'{base_url}{target.path}', data=body, headers={'Content-Type': 'application/json'})
+    if resp.status_code != 200:
+        return f'{resp.status_code}: {resp.text[:200]}'
+    if not target.poll:
+        return None
+
+    uid = resp.json()['uid']
+    while True:
+        resp = session.get(f'{base_url}/async/get/{uid}')
+        if resp.status_code != 200:
+            return f'{resp.status_code}: {resp.text[:200]}'
+        status = resp.json()
+        if status['status'] == 'Done':
+            return None
+        if status['status'] not in ('Initializing', 'In Progress'):
+            return f'{status["status"]}: {json.dumps(status.get("error"))[:200]}'
+        time.sleep(async_poll_interval)
+
+
+def run_load(
+        base_url: str,
+        target: Target,
+        concurrency: int,
+        duration: Optional[float] = None,
+        n_requests: Optional[int] = None,
+) -> LoadResult:
+    """
+    Send requests from `concurrency` threads, each waiting for its last response before sending the next (a closed
+    loop), until either `duration` seconds have passed or `n_requests` have been sent
+    """
+    if duration is None and n_requests is None:
+        raise ValueError('One of duration or n_requests is required')
+
+    counter = itertools.count()
+    lock = threading.Lock()
+    latencies = []  # type: List[float]
+    error_samples = []  # type: List[str]
+    errors = [0]
+
+    t_start = time.monotonic()
+    deadline = t_start + duration if duration is not None else None
+
+    def worker():
+        local_latencies = []
+        with requests.Session() as session:
+            while True:
+                idx = next(counter)
+                if n_requests is not None and idx >= n_requests:
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                body = target.bodies[idx % len(target.bodies)]
+                t_req = time.monotonic()
+                try:
+                    err = _send(session, base_url, target, body)
+                except requests.RequestException as e:
+                    err = str(e)
+                if err is None:
+                    local_latencies.append(time.monotonic() - t_req)
+                else:
+                    with lock:
+                        errors[0] += 1
+                        if len(error_samples) < 10:
+                            error_samples.append(err)
+        with lock:
+            latencies.extend(local_latencies)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return LoadResult(latencies, errors[0], error_samples, time.monotonic() - t_start)
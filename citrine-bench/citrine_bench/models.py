@@ -0,0 +1,88 @@
+from typing import *
+
+import numpy as np
+import onnx
+from onnx import helper, numpy_helper, TensorProto
+
+
+# Synthetic models, built from random weights. They don't compute anything meaningful, but they're the shape and
+# size of real ones, which is all the daemon cares about
+
+OPSET = 13
+
+
+def _finish(name: str, nodes: List, inputs: List, outputs: List, weights: List) -> onnx.ModelProto:
+    graph = helper.make_graph(nodes, name, inputs, outputs, weights)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', OPSET)], producer_name='citrine-bench')
+    # Keep to an IR version every supported onnxruntime can load
+    model.ir_version = 8
+    onnx.checker.check_model(model)
+    return model
+
+
+def mlp(name: str, sizes: List[int], seed: int = 0) -> onnx.ModelProto:
+    """
+    x [N, sizes[0]] -> Gemm / Relu layers -> logits [N, sizes[-1]]
+    """
+    rng = np.random.default_rng(seed)
+    nodes = []
+    weights = []
+    prev = 'x'
+    for idx, (n_in, n_out) in enumerate(zip(sizes[:-1], sizes[1:])):
+        w = rng.normal(0, (2 / n_in) ** 0.5, (n_in, n_out)).astype(np.float32)
+        b = np.zeros(n_out, dtype=np.float32)
+        weights.append(numpy_helper.from_array(w, f'w{idx}'))
+        weights.append(numpy_helper.from_array(b, f'b{idx}'))
+        last = (idx == len(sizes) - 2)
+        out = 'logits' if last else f'h{idx}'
+        gemm_out = out if last else f'g{idx}'
+        nodes.append(helper.make_node('Gemm', [prev, f'w{idx}', f'b{idx}'], [gemm_out]))
+        if not last:
+            nodes.append(helper.make_node('Relu', [gemm_out], [out]))
+        prev = out
+
+    return _finish(
+        name,
+        nodes,
+        [helper.make_tensor_value_info('x', TensorProto.FLOAT, ['N', sizes[0]])],
+        [helper.make_tensor_value_info('logits', TensorProto.FLOAT, ['N', sizes[-1]])],
+        weights,
+    )
+
+
+def convnet(name: str, image_size: int, channels: List[int], n_classes: int, seed: int = 0) -> onnx.ModelProto:
+    """
+    image [N, 3, H, W] -> stride 2 Conv / Relu layers -> global average pool -> logits [N, n_classes]
+    """
+    rng = np.random.default_rng(seed)
+    nodes = []
+    weights = []
+    prev = 'image'
+    prev_c = 3
+    for idx, c in enumerate(channels):
+        w = rng.normal(0, (2 / (prev_c * 9)) ** 0.5, (c, prev_c, 3, 3)).astype(np.float32)
+        b = np.zeros(c, dtype=np.float32)
+        weights.append(numpy_helper.from_array(w, f'conv{idx}_w'))
+        weights.append(numpy_helper.from_array(b, f'conv{idx}_b'))
+        nodes.append(helper.make_node(
+            'Conv', [prev, f'conv{idx}_w', f'conv{idx}_b'], [f'conv{idx}'],
+            kernel_shape=[3, 3], strides=[2, 2], pads=[1, 1, 1, 1],
+        ))
+        nodes.append(helper.make_node('Relu', [f'conv{idx}'], [f'relu{idx}']))
+        prev = f'relu{idx}'
+        prev_c = c
+
+    nodes.append(helper.make_node('GlobalAveragePool', [prev], ['pooled']))
+    nodes.append(helper.make_node('Flatten', ['pooled'], ['features'], axis=1))
+    w = rng.normal(0, (1 / prev_c) ** 0.5, (prev_c, n_classes)).astype(np.float32)
+    weights.append(numpy_helper.from_array(w, 'fc_w'))
+    weights.append(numpy_helper.from_array(np.zeros(n_classes, dtype=np.float32), 'fc_b'))
+    nodes.append(helper.make_node('Gemm', ['features', 'fc_w', 'fc_b'], ['logits']))
+
+    return _finish(
+        name,
+        nodes,
+        [helper.make_tensor_value_info('image', TensorProto.FLOAT, ['N', 3, image_size, image_size])],
+        [helper.make_tensor_value_info('logits', TensorProto.FLOAT, ['N', n_classes])],
+        weights,
+    )
@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from typing import *
+
+
+# Samples CPU and memory of the daemon (and any processes it started) from /proc while a benchmark runs. Off Linux
+# there's no /proc, and the report just leaves these out
+
+
+def find_daemon_pid() -> Optional[int]:
+    if not os.path.isdir('/proc'):
+        return None
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/cmdline', 'rb') as in_f:
+                cmdline = in_f.read().split(b'\0')
+        except OSError:
+            continue
+        args = [arg.decode('utf-8', 'replace') for arg in cmdline]
+        if any(arg.endswith('citrine-daemon') for arg in args) or args[1:3] == ['-m', 'citrine_daemon']:
+            return int(entry)
+    return None
+
+
+def _process_tree(pid: int) -> List[int]:
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as in_f:
+                stat = in_f.read()
+        except OSError:
+            continue
+        # comm can contain spaces, so split after its closing paren
+        fields = stat[stat.rindex(')') + 2:].split()
+        parents[int(entry)] = int(fields[1])
+    tree = [pid]
+    for candidate, parent in parents.items():
+        if parent in tree and candidate not in tree:
+            tree.append(candidate)
+    return tree
+
+
+def _cpu_seconds(pid: int) -> float:
+    with open(f'/proc/{pid}/stat', 'r') as in_f:
+        stat = in_f.read()
+    fields = stat[stat.rindex(')') + 2:].split()
+    # utime and stime, fields 14 and 15 of the full stat line
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def _rss_bytes(pid: int) -> int:
+    with open(f'/proc/{pid}/status', 'r') as in_f:
+        for line in in_f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class ProcessMonitor(object):
+    def __init__(self, pid: Optional[int], interval: float = 0.25):
+        self.pid = pid
+        self.interval = interval
+        self.rss_samples = []  # type: List[int]
+        self._cpu_start = None  # type: Optional[float]
+        self._cpu_end = None  # type: Optional[float]
+        self._t_start = None  # type: Optional[float]
+        self._t_end = None  # type: Optional[float]
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def available(self) -> bool:
+        return self.pid is not None and os.path.isdir(f'/proc/{self.pid}')
+
+    def _cpu_total(self) -> float:
+        total = 0.0
+        for pid in _process_tree(self.pid):
+            try:
+                total += _cpu_seconds(pid)
+            except OSError:
+                pass
+        return total
+
+    def _rss_total(self) -> int:
+        total = 0
+        for pid in _process_tree(self.pid):
+            try:
+                total += _rss_bytes(pid)
+            except OSError:
+                pass
+        return total
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.rss_samples.append(self._rss_total())
+
+    def __enter__(self) -> 'ProcessMonitor':
+        if not self.available:
+            return self
+        self._t_start = time.monotonic()
+        self._cpu_start = self._cpu_total()
+        self.rss_samples.append(self._rss_total())
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._t_end = time.monotonic()
+        self._cpu_end = self._cpu_total()
+        self.rss_samples.append(self._rss_total())
+
+    def summary(self) -> Optional[Dict]:
+        if self._cpu_end is None:
+            return None
+        wall = self._t_end - self._t_start
+        mb = 1024 ** 2
+        return {
+            'pid': self.pid,
+            # 100% is one core fully busy
+            'cpu_percent': 100 * (self._cpu_end - self._cpu_start) / wall if wall > 0 else None,
+            'rss_mb_max': max(self.rss_samples) / mb,
+            'rss_mb_mean': sum(self.rss_samples) / len(self.rss_samples) / mb,
+        }
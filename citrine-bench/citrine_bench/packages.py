@@ -0,0 +1,252 @@
+import base64
+import io
+import json
+import os
+import random
+from typing import *
+
+import numpy as np
+import onnx
+from PIL import Image
+
+from citrine_bench import models
+
+
+# Benchmark packages, one per model size. Each one does the kind of pre/post-processing a real package of that size
+# would: scaling a feature vector, hashing text into a bag of words, decoding and resizing an image
+
+
+class BenchPackage(object):
+    def __init__(
+            self,
+            size: str,
+            name: str,
+            build_model: Callable[[], onnx.ModelProto],
+            input_name: str,
+            input_shape: Tuple[int, ...],
+            module_source: str,
+            input_validator: Dict,
+            make_payload: Callable[[random.Random], Dict],
+            n_labels: int,
+            extra_files: Callable[[str], None] = None,
+    ):
+        self.size = size
+        self.name = name
+        self.build_model = build_model
+        # Model input, for driving /_run directly
+        self.input_name = input_name
+        self.input_shape = input_shape
+        self.module_source = module_source
+        self.input_validator = input_validator
+        self.make_payload = make_payload
+        self.n_labels = n_labels
+        self.extra_files = extra_files
+
+    def raw_payload(self, rng: random.Random) -> Dict:
+        np_rng = np.random.default_rng(rng.getrandbits(32))
+        return {self.input_name: np_rng.standard_normal(self.input_shape, dtype=np.float32).tolist()}
+
+
+version = '1.0'
+function_name = 'classify'
+model_name = 'model'
+
+
+_module_header = '''
+import json
+
+import numpy as np
+
+from citrine_daemon import create_function
+
+
+def softmax(logits):
+    e = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def top_k(probs, labels, k):
+    order = np.argsort(-probs)[:k]
+    return [{'label': labels[idx], 'score': float(probs[idx])} for idx in order]
+
+
+with open('labels.json', 'r') as in_f:
+    labels = json.load(in_f)
+'''
+
+
+_tabular_module = _module_header + '''
+stats = np.load('stats.npz')
+mean = stats['mean']
+std = stats['std']
+
+
+def process_input(inputs):
+    x = (np.asarray(inputs['features'], dtype=np.float32) - mean) / std
+    return {'x': x[np.newaxis, :]}
+
+
+def process_output(outputs):
+    return {'top': top_k(softmax(outputs['logits'][0]), labels, 3)}
+
+
+create_function('classify', process_input, process_output, model='model', input_validator=INPUT_VALIDATOR)
+'''
+
+
+_text_module = _module_header + '''
+import re
+import zlib
+
+n_buckets = N_BUCKETS
+token_re = re.compile(r"[a-z0-9']+")
+
+
+def process_input(inputs):
+    x = np.zeros(n_buckets, dtype=np.float32)
+    for token in token_re.findall(inputs['text'].lower()):
+        x[zlib.crc32(token.encode('utf-8')) % n_buckets] += 1
+    norm = np.linalg.norm(x)
+    if norm > 0:
+        x /= norm
+    return {'x': x[np.newaxis, :]}
+
+
+def process_output(outputs):
+    return {'top': top_k(softmax(outputs['logits'][0]), labels, 5)}
+
+
+create_function('classify', process_input, process_output, model='model', input_validator=INPUT_VALIDATOR)
+'''
+
+
+_image_module = _module_header + '''
+import base64
+import io
+
+from PIL import Image
+
+image_size = IMAGE_SIZE
+channel_mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+channel_std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def process_input(inputs):
+    img = Image.open(io.BytesIO(base64.b64decode(inputs['image']))).convert('RGB')
+    img = img.resize((image_size, image_size), Image.BILINEAR)
+    arr = (np.asarray(img, dtype=np.float32) / 255 - channel_mean) / channel_std
+    return {'image': arr.transpose(2, 0, 1)[np.newaxis, ...]}
+
+
+def process_output(outputs):
+    return {'top': top_k(softmax(outputs['logits'][0]), labels, 5)}
+
+
+create_function('classify', process_input, process_output, model='model', input_validator=INPUT_VALIDATOR)
+'''
+
+
+_words = (
+    'the quick brown fox jumps over lazy dog model daemon request latency inference tensor batch queue '
+    'worker session cache python numpy onnx runtime image text label score network layer weight thread'
+).split()
+
+
+def _tabular_payload(rng: random.Random) -> Dict:
+    return {'features': [rng.gauss(0, 1) for _ in range(32)]}
+
+
+def _text_payload(rng: random.Random) -> Dict:
+    return {'text': ' '.join(rng.choice(_words) for _ in range(rng.randint(20, 200)))}
+
+
+def _image_payload(rng: random.Random) -> Dict:
+    np_rng = np.random.default_rng(rng.getrandbits(32))
+    pixels = np_rng.integers(0, 256, (240, 320, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format='JPEG', quality=85)
+    return {'image': base64.b64encode(buf.getvalue()).decode('ascii')}
+
+
+def _tabular_stats(package_dir: str):
+    rng = np.random.default_rng(1)
+    np.savez(
+        os.path.join(package_dir, 'stats.npz'),
+        mean=rng.normal(0, 0.1, 32).astype(np.float32),
+        std=rng.uniform(0.5, 1.5, 32).astype(np.float32),
+    )
+
+
+text_buckets = 4096
+image_size = 224
+
+bench_packages = {
+    'small': BenchPackage(
+        size='small',
+        name='bench-small',
+        build_model=lambda: models.mlp('bench-small', [32, 64, 10]),
+        input_name='x',
+        input_shape=(1, 32),
+        module_source=_tabular_module,
+        input_validator={
+            'features': {'type': 'list', 'schema': {'type': 'number'}, 'minlength': 32, 'maxlength': 32},
+        },
+        make_payload=_tabular_payload,
+        n_labels=10,
+        extra_files=_tabular_stats,
+    ),
+    'medium': BenchPackage(
+        size='medium',
+        name='bench-medium',
+        build_model=lambda: models.mlp('bench-medium', [text_buckets, 1024, 1024, 256]),
+        input_name='x',
+        input_shape=(1, text_buckets),
+        module_source=_text_module.replace('N_BUCKETS', str(text_buckets)),
+        input_validator={'text': {'type': 'string', 'maxlength': 100000}},
+        make_payload=_text_payload,
+        n_labels=256,
+    ),
+    'large': BenchPackage(
+        size='large',
+        name='bench-large',
+        build_model=lambda: models.convnet('bench-large', image_size, [32, 64, 128, 256, 512], 1000),
+        input_name='image',
+        input_shape=(1, 3, image_size, image_size),
+        module_source=_image_module.replace('IMAGE_SIZE', str(image_size)),
+        input_validator={'image': {'type': 'string'}},
+        make_payload=_image_payload,
+        n_labels=1000,
+    ),
+}
+
+
+def build_package(bench_package: BenchPackage, out_dir: str) -> str:
+    package_dir = os.path.join(out_dir, bench_package.name)
+    os.makedirs(package_dir, exist_ok=True)
+
+    onnx.save(bench_package.build_model(), os.path.join(package_dir, 'model.onnx'))
+
+    with open(os.path.join(package_dir, 'labels.json'), 'w') as out_f:
+        json.dump([f'class_{idx}' for idx in range(bench_package.n_labels)], out_f)
+
+    source = bench_package.module_source.replace('INPUT_VALIDATOR', repr(bench_package.input_validator))
+    with open(os.path.join(package_dir, 'module.py'), 'w') as out_f:
+        out_f.write(source)
+
+    if bench_package.extra_files is not None:
+        bench_package.extra_files(package_dir)
+
+    with open(os.path.join(package_dir, 'meta.json'), 'w') as out_f:
+        json.dump({
+            'name': bench_package.name,
+            'version': version,
+            'humanname': f'Citrine benchmark ({bench_package.size})',
+            'module': 'module.py',
+            'model': {
+                model_name: {'type': 'onnx', 'file': 'model.onnx'},
+            },
+            # Benchmarks send the same few payloads over and over; the result cache would measure itself instead
+            'deterministic': False,
+        }, out_f, indent=2)
+
+    return package_dir
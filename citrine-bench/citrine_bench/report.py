@@ -0,0 +1,81 @@
+import datetime
+import json
+import os
+import platform
+import socket
+from typing import *
+
+import numpy as np
+
+from citrine_bench.load import LoadResult
+
+
+def latency_summary(latencies: List[float]) -> Optional[Dict]:
+    if not latencies:
+        return None
+    arr = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(arr, [50, 95, 99])
+    return {
+        'p50': float(p50),
+        'p95': float(p95),
+        'p99': float(p99),
+        'mean': float(arr.mean()),
+        'min': float(arr.min()),
+        'max': float(arr.max()),
+    }
+
+
+def scenario_result(
+        size: str,
+        endpoint: str,
+        concurrency: int,
+        load: LoadResult,
+        daemon: Optional[Dict],
+) -> Dict:
+    return {
+        'size': size,
+        'endpoint': endpoint,
+        'concurrency': concurrency,
+        'requests': len(load.latencies),
+        'errors': load.errors,
+        'error_samples': load.error_samples,
+        'duration_s': load.wall_time,
+        'requests_per_s': len(load.latencies) / load.wall_time if load.wall_time > 0 else None,
+        'latency_ms': latency_summary(load.latencies),
+        'daemon': daemon,
+    }
+
+
+def run_metadata(server: str, daemon_info: Dict, args: Dict) -> Dict:
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'server': server,
+        'daemon': daemon_info,
+        'args': args,
+    }
+
+
+def write_report(path: str, metadata: Dict, results: List[Dict]):
+    with open(path, 'w') as out_f:
+        json.dump({'run': metadata, 'results': results}, out_f, indent=2)
+
+
+def format_table(results: List[Dict]) -> str:
+    header = f'{"size":<8}{"endpoint":<10}{"conc":>6}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}' \
+             f'{"errors":>8}{"cpu %":>8}{"rss MB":>9}'
+    lines = [header, '-' * len(header)]
+    fmt = lambda v, spec: format(v, spec) if v is not None else '-'
+    for res in results:
+        lat = res['latency_ms'] or {}
+        daemon = res['daemon'] or {}
+        lines.append(
+            f'{res["size"]:<8}{res["endpoint"]:<10}{res["concurrency"]:>6}'
+            f'{fmt(res["requests_per_s"], ">10.1f")}'
+            f'{fmt(lat.get("p50"), ">10.2f")}{fmt(lat.get("p95"), ">10.2f")}{fmt(lat.get("p99"), ">10.2f")}'
+            f'{res["errors"]:>8}{fmt(daemon.get("cpu_percent"), ">8.0f")}{fmt(daemon.get("rss_mb_max"), ">9.0f")}'
+        )
+    return '\n'.join(lines)
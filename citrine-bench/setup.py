@@ -0,0 +1,21 @@
+from setuptools import setup, find_packages
+
+
+setup(
+    name='citrine-bench',
+    version='0.3.0',
+    python_requires='>3.7.0',
+    description='Throughput and latency benchmarks for citrine-daemon',
+    packages=find_packages(),
+    install_requires=[
+        'numpy',
+        'onnx',
+        'Pillow',
+        'requests',
+    ],
+    entry_points={
+        'console_scripts': [
+            'citrine-bench = citrine_bench.__main__:main',
+        ],
+    },
+)
@@ -4,9 +4,12 @@ from typing import *
 
 import requests
 
+import numpy as np
+
 import citrine_client.errors as errors
 import citrine_client.api.util as util
 from citrine_client.server import SyncRequest, AsyncRequest, DaemonLink
+from citrine_client.util import binary_content_type, encode_binary
 
 
 __all__ = [
@@ -16,8 +19,15 @@ __all__ = [
 
 
 class PackageClient(object):
-    def __init__(self, host: str, port: int, autocancel: bool = True, async_: bool = False):
-        self.server = DaemonLink(host=host, port=port)
+    def __init__(
+            self,
+            host: str,
+            port: int,
+            autocancel: bool = True,
+            async_: bool = False,
+            client: Optional[str] = None,
+    ):
+        self.server = DaemonLink(host=host, port=port, client=client)
         self.autocancel = autocancel
         self.async_ = async_
         if async_:
@@ -145,9 +155,23 @@ class PackageClient(object):
 
 class CitrineClient(object):
     # Synchronous consumer of the asynchronous API
-    def __init__(self, host: str, port: int, autocancel: bool = True, async_: bool = False):
-        self.server = DaemonLink(host=host, port=port)
-        self.package = PackageClient(host=host, port=port, autocancel=autocancel, async_=async_)
+    def __init__(
+            self,
+            host: str,
+            port: int,
+            autocancel: bool = True,
+            async_: bool = False,
+            client: Optional[str] = None,
+    ):
+        """
+        :param client:
+            Who the daemon should consider this to be when taking turns between clients, and the name to give it in
+            the daemon's scheduling.client_weights. Defaults to a name for this process
+        """
+        self.server = DaemonLink(host=host, port=port, client=client)
+        self.package = PackageClient(
+            host=host, port=port, autocancel=autocancel, async_=async_, client=self.server.client,
+        )
         self.autocancel = autocancel
         self.async_ = async_
         if async_:
@@ -168,41 +192,125 @@ class CitrineClient(object):
             target: str,
             params: Dict = None,
             progress_callback: Optional[Callable[[Dict], None]] = None,
+            binary: bool = False,
+            priority: Optional[str] = None,
     ) -> Dict:
+        """
+        :param binary:
+            Send numpy arrays in params as raw buffers instead of base64 JSON, and get tensors in the result back as
+            numpy arrays
+        :param priority:
+            One of interactive, normal, batch. By default the server treats synchronous calls as interactive and
+            async ones as normal
+        """
         if not params:
             params = {}
         req = self.Request(
             server=self.server,
             endpoint=f'/run/{target}',
-            jsn=params,
+            **self._body_args(params, binary, priority),
         )
         if self.async_:
             return req.run(callback=progress_callback)
         else:
             return req.run()
 
+    def run_batch(
+            self,
+            target: str,
+            inputs: Iterable[Dict],
+            chunk_size: int = 256,
+            binary: bool = False,
+            priority: Optional[str] = None,
+    ) -> List[Dict]:
+        """
+        Call a function on each of a list of inputs, sending them chunk_size at a time
+        :param priority:
+            Defaults to batch on the server
+        :return:
+            One entry per input, in order: {'result': ...} if it succeeded, {'error': ...} if it didn't. A bad input
+            doesn't fail the rest
+        """
+        if chunk_size < 1:
+            raise errors.InvalidOptions('chunk_size must be at least 1')
+        results = []
+        chunk = []
+        for item in inputs:
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                results.extend(self._run_batch_chunk(target, chunk, binary, priority))
+                chunk = []
+        if chunk:
+            results.extend(self._run_batch_chunk(target, chunk, binary, priority))
+        return results
+
+    def _run_batch_chunk(self, target: str, chunk: List[Dict], binary: bool, priority: Optional[str]) -> List[Dict]:
+        req = self.Request(
+            server=self.server,
+            endpoint=f'/run_batch/{target}',
+            **self._body_args({'inputs': chunk}, binary, priority),
+        )
+        return req.run()['results']
+
     def _run(
             self,
             target_package: str,
             target_model: str,
             params: Dict = None,
             progress_callback: Optional[Callable[[Dict], None]] = None,
+            binary: bool = False,
+            priority: Optional[str] = None,
     ) -> Dict:
-        # TODO: _run wants numpy arrays
-        # Consider enforcing / coercing params to {str: np.ndarray}
-        # Which might have implications for serialization (tensor protobuf?)
         if not params:
             params = {}
+        if binary:
+            params = {k: np.asarray(v) for k, v in params.items()}
         req = self.Request(
             server=self.server,
             endpoint=f'/_run/{target_package}/{target_model}',
-            jsn=params,
+            **self._body_args(params, binary, priority),
         )
         if self.async_:
             return req.run(callback=progress_callback)
         else:
             return req.run()
 
+    def get_many(
+            self,
+            uids: List[str],
+            since: Optional[int] = None,
+            results: bool = False,
+    ) -> Dict:
+        """
+        Status of many async jobs in one request
+        :param since:
+            The "version" from a previous call. Only jobs that have changed since then are returned
+        :param results:
+            Include each job's data and result, not just its status
+        :return:
+            {'version': cursor for the next call, 'jobs': {uid: status}, 'missing': [expired / unknown uids],
+            'evicted': [uids whose results were dropped early to save memory]}
+        """
+        req = SyncRequest(
+            server=self.server,
+            endpoint='/async/get_many',
+            jsn={'uids': list(uids), 'since': since, 'results': results},
+        )
+        return req.run()
+
+    @staticmethod
+    def _body_args(params: Dict, binary: bool, priority: Optional[str] = None) -> Dict:
+        headers = {}
+        if priority is not None:
+            headers['X-Citrine-Priority'] = priority
+        if not binary:
+            return {'jsn': params, 'headers': headers or None}
+        headers.update({'Content-Type': binary_content_type, 'Accept': binary_content_type})
+        return {
+            'data': encode_binary(params),
+            'headers': headers,
+        }
+
     def result(
             self,
             result_hash: str
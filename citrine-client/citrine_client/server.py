@@ -1,16 +1,24 @@
 import json
+import os
 import time
 from typing import Dict, Optional
 
 import requests
 
 import citrine_client.errors as errors
+from citrine_client.util import binary_content_type, decode_binary
 
 
 class DaemonLink(object):
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, client: Optional[str] = None):
+        """
+        :param client:
+            Name sent as X-Citrine-Client, which the daemon schedules by: clients take turns, and
+            scheduling.client_weights is keyed on it. Defaults to one name per process
+        """
         self.host = host
         self.port = port
+        self.client = client or f'pid-{os.getpid()}'
 
 
 class CitrineRequest(object):
@@ -25,6 +33,8 @@ class CitrineRequest(object):
             jsn: Optional[Dict] = None,
             method: str = 'post',
             timeout: float = None,
+            data: Optional[bytes] = None,
+            headers: Optional[Dict[str, str]] = None,
     ):
         """
         :param server:
@@ -33,6 +43,8 @@ class CitrineRequest(object):
         :param files: Passed to requests 'files'
         :param jsn: Passed to requests 'json'
         :param method: Which HTTP method to use
+        :param data: Raw request body, passed to requests 'data'
+        :param headers: Passed to requests 'headers'
         """
         self.server = server
         self.method = method
@@ -47,8 +59,13 @@ class CitrineRequest(object):
             self.request_args['params'] = params
         if files is not None:
             self.request_args['files'] = files
-        if json is not None:
+        if jsn is not None:
             self.request_args['json'] = jsn
+        if data is not None:
+            self.request_args['data'] = data
+        self.headers = dict(headers or {})
+        self.headers.setdefault('X-Citrine-Client', server.client)
+        self.request_args['headers'] = self.headers
 
     def send(self):
         try:
@@ -71,6 +88,11 @@ class CitrineRequest(object):
 
     @staticmethod
     def _parse_response(response):
+        if response.status_code == 200 and response.headers.get('Content-Type', '').startswith(binary_content_type):
+            try:
+                return decode_binary(response.content)
+            except (ValueError, KeyError, IndexError, TypeError):
+                raise errors.InvalidResponse('Malformed binary server response')
         try:
             resp = json.loads(response.content)
         except json.JSONDecodeError:
@@ -78,16 +100,21 @@ class CitrineRequest(object):
         if response.status_code != 200:
             raise errors.ServerError('Server rejected request', data=resp)
         return resp
-    
-               cancel: bool = True
+
 
 class SyncRequest(CitrineRequest):
     default_timeout = 60
     def run(self):
+        # Once we've given up waiting, the daemon needn't bother starting the job
+        headers = dict(self.request_args.get('headers') or {})
+        headers.setdefault('X-Citrine-Deadline', str(self.timeout))
+        self.request_args['headers'] = headers
         return self.send()
 
 
 class AsyncRequest(CitrineRequest):
+    # The daemon sends a keepalive every 15s on a quiet stream, so this long without anything means it's gone
+    stream_read_timeout = 60
     def __init__(
             self,
             server: DaemonLink,
@@ -98,6 +125,8 @@ class AsyncRequest(CitrineRequest):
             method: str = 'post',
             cancel: bool = True,
             timeout: float = None,
+            data: Optional[bytes] = None,
+            headers: Optional[Dict[str, str]] = None,
     ):
         """
         :param cancel:
@@ -111,6 +140,8 @@ class AsyncRequest(CitrineRequest):
             jsn=jsn,
             method=method,
             timeout=timeout,
+            data=data,
+            headers=headers,
         )
         self.url = f'http://{server.host}:{server.port}/async{endpoint}'
         self.cancel = cancel
@@ -120,18 +151,32 @@ class AsyncRequest(CitrineRequest):
         self.data = None  # type: Optional[Dict]
         self.result = None  # type: Optional[Dict]
         self.error = None  # type: Optional[Dict]
+        # Of the last status we got, so polls can skip downloading it again if nothing's changed
+        self.etag = None  # type: Optional[str]
 
     def refresh(self):
         url_update = f'http://{self.server.host}:{self.server.port}/async/get/{self.uid}'
         try:
-            r = requests.get(url_update, timeout=10)
+            r = requests.get(url_update, headers=self._poll_headers(), timeout=10)
         except requests.exceptions.ConnectTimeout:
             raise errors.ConnectionError('Connection timed out')
         except requests.exceptions.ConnectionError:
             raise errors.ConnectionRefused('Cannot connect to server')
+        if r.status_code == 304:
+            return
         resp = self._parse_response(r)
+        self.etag = r.headers.get('ETag')
         self._update(resp)
 
+    def _poll_headers(self) -> Dict[str, str]:
+        headers = {}
+        # Keep asking for the same response format as the original request
+        if 'Accept' in self.headers:
+            headers['Accept'] = self.headers['Accept']
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        return headers
+
     def _update(self, response):
         self.uid = response['uid']
         self.status = response['status']
@@ -141,14 +186,49 @@ class AsyncRequest(CitrineRequest):
         if 'error' in response:
             self.error = response['error']
 
+    def stream(self, callback=None) -> bool:
+        """
+        Follow the job with /async/stream until it's done
+        :return: Whether it got to the end. If not (e.g. an older daemon without streams), fall back to refresh()
+        """
+        url_stream = f'http://{self.server.host}:{self.server.port}/async/stream/{self.uid}'
+        try:
+            r = requests.get(url_stream, stream=True, timeout=(10, self.stream_read_timeout))
+        except requests.exceptions.RequestException:
+            return False
+        with r:
+            if r.status_code != 200:
+                return False
+            try:
+                data_lines = []
+                for line in r.iter_lines(decode_unicode=True):
+                    if line.startswith('data:'):
+                        data_lines.append(line[len('data:'):].lstrip())
+                    elif not line and data_lines:
+                        self._update(json.loads('\n'.join(data_lines)))
+                        data_lines = []
+                        if callback and self.data:
+                            callback(self.data)
+                        if self.done:
+                            break
+            except (requests.exceptions.RequestException, json.JSONDecodeError):
+                return False
+        if not self.done:
+            return False
+        if binary_content_type in self.headers.get('Accept', ''):
+            # Events are JSON, so pick up the result again in the format that was asked for
+            self.refresh()
+        return True
+
     def run(self, callback=None):
         with self:
-            while not self.done:
-                time.sleep(0.1)
-                self.refresh()
-                if callback and self.data:
-                    callback(self.data)
-        if self.status == 'Error':
+            if not self.done and not self.stream(callback):
+                while not self.done:
+                    time.sleep(0.1)
+                    self.refresh()
+                    if callback and self.data:
+                        callback(self.data)
+        if self.status in {'Error', 'Interrupted', 'Timed Out'}:
             raise errors.ServerError('Request failed', data=self.error)
         return self.result
 
@@ -174,4 +254,4 @@ class AsyncRequest(CitrineRequest):
 
     @property
     def done(self):
-        return self.status in {'Error', 'Done'}
+        return self.status in {'Error', 'Done', 'Interrupted', 'Timed Out'}
@@ -1,4 +1,6 @@
 import base64
+import json
+import struct
 from typing import *
 
 import numpy as np
@@ -16,3 +18,71 @@ def encode_tensor(arr: np.ndarray) -> Dict:
 def decode_tensor(t: Dict) -> np.ndarray:
     arr = np.frombuffer(base64.b64decode(t['data']), t['dtype'])
     return arr.reshape(t['shape'])
+
+
+# Binary wire format, matching citrine_daemon.util.pack_binary / unpack_binary
+#   b'CTRN' | uint32 LE header length | header JSON | padding | buffers
+# The header is {"doc": <document>, "buffers": [[offset, nbytes], ...]}, with each tensor in the document replaced by
+# {"dtype": ..., "shape": ..., "buffer": <index>}
+binary_content_type = 'application/x-citrine-binary'
+_binary_magic = b'CTRN'
+_binary_align = 64
+
+
+def _align(n: int) -> int:
+    return (n + _binary_align - 1) // _binary_align * _binary_align
+
+
+def encode_binary(doc: Any) -> bytearray:
+    buffers = []
+
+    def tensor_ref(o: Any) -> Dict:
+        if not isinstance(o, np.ndarray):
+            raise TypeError(f'Object of type {type(o).__name__} is not serializable')
+        buffers.append(np.ascontiguousarray(o))
+        return {'dtype': str(o.dtype), 'shape': list(o.shape), 'buffer': len(buffers) - 1}
+
+    doc_json = json.dumps(doc, default=tensor_ref)
+
+    layout = []
+    offset = 0
+    for arr in buffers:
+        offset = _align(offset)
+        layout.append((offset, arr.nbytes))
+        offset += arr.nbytes
+
+    header = f'{{"doc": {doc_json}, "buffers": {json.dumps(layout)}}}'.encode('utf-8')
+    prefix_len = len(_binary_magic) + 4 + len(header)
+    data_start = _align(prefix_len)
+
+    out = bytearray(data_start + offset)
+    out[:prefix_len] = _binary_magic + struct.pack('<I', len(header)) + header
+    for arr, (buf_offset, nbytes) in zip(buffers, layout):
+        start = data_start + buf_offset
+        # Not memoryview(arr).cast('B'), which refuses arrays with a zero-length axis
+        out[start:start + nbytes] = memoryview(arr.reshape(-1).view(np.uint8))
+    return out
+
+
+def decode_binary(data: bytes) -> Any:
+    if len(data) < 8 or data[:4] != _binary_magic:
+        raise ValueError('Response is missing the citrine binary header')
+    header_len, = struct.unpack_from('<I', data, 4)
+    header_end = 8 + header_len
+    header = json.loads(bytes(data[8:header_end]).decode('utf-8'))
+    layout = header['buffers']
+    data_start = _align(header_end)
+
+    def walk(obj: Any) -> Any:
+        if isinstance(obj, dict):
+            if obj.keys() == {'dtype', 'shape', 'buffer'}:
+                buf_offset, nbytes = layout[obj['buffer']]
+                dtype = np.dtype(obj['dtype'])
+                arr = np.frombuffer(data, dtype, count=nbytes // dtype.itemsize, offset=data_start + buf_offset)
+                return arr.reshape(obj['shape'])
+            return {k: walk(v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [walk(v) for v in obj]
+        return obj
+
+    return walk(header['doc'])
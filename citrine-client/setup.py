@@ -7,6 +7,7 @@ setup(
     description='Utility for interacting with citrine-daemon',
     packages=find_packages(),
     install_requires=[
+        'numpy',
         'requests',
         'progress',
     ],
@@ -1,5 +1,9 @@
+import multiprocessing
+
 from citrine_daemon.app import main
 
 
 if __name__ == '__main__':
+    # In the PyInstaller build every spawned pool process starts from here, this turns it into a worker instead
+    multiprocessing.freeze_support()
     main()
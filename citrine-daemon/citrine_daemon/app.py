@@ -1,6 +1,6 @@
 import logging
 
-from citrine_daemon import storage, server, package, logs, config
+from citrine_daemon import storage, server, package, logs, config, core, metrics, profiling
 
 
 logger = logging.getLogger(__name__)
@@ -11,7 +11,46 @@ def main():
     storage.init_storage()
     logs.init_logging()
     logger.info('Citrine v0.3.0')
+    metrics.init_metrics(attach=config.get_config('metrics.attach_timings'))
+    profiling.init_profiling(config.get_config('profiling.sample_rate'))
+    pools = dict(config.get_config('worker_pools'))
+    if config.get_config('pipeline.enabled'):
+        stages = dict(config.get_config('pipeline.workers'))
+        stages['infer'] = stages.get('infer') or pools['inference']
+        pools.update(stages)
+    core.nn.init_sessions(
+        max_bytes=config.get_config('session_cache.max_bytes'),
+        ttl=config.get_config('session_cache.ttl'),
+        thread_budget_total=config.get_config('thread_budget'),
+        # Only the workers that run models count against onnxruntime's threads
+        reserved_threads=pools['inference'] + pools.get('infer', 0),
+        defaults=config.get_config('session_defaults'),
+    )
+    core.memo.init_result_cache(
+        enabled=config.get_config('result_cache.enabled'),
+        max_bytes=config.get_config('result_cache.max_bytes'),
+        ttl=config.get_config('result_cache.ttl'),
+    )
+    core.procpool.init_process_pool(
+        workers=config.get_config('process_pool.workers'),
+        min_shared_bytes=config.get_config('process_pool.min_shared_bytes'),
+    )
     package.db.init_db()
     package.load.init_packages()
-    server.parallel.init_workers(n_workers=config.get_config('worker_threads'))
+    server.parallel.init_job_cache(
+        hold_time=config.get_config('job_cache.hold_time'),
+        max_result_bytes=config.get_config('job_cache.max_result_bytes'),
+    )
+    server.parallel.init_workers(
+        pools=pools,
+        queue_size=config.get_config('job_queue.max_size'),
+        retry_after=config.get_config('job_queue.retry_after'),
+        default_deadline=config.get_config('job_queue.default_deadline'),
+        aging=config.get_config('scheduling.aging_s'),
+        weights=config.get_config('scheduling.client_weights'),
+        queue_sizes={
+            'infer': config.get_config('pipeline.stage_queue_size'),
+            'post': config.get_config('pipeline.stage_queue_size'),
+        },
+    )
     server.run_server(config.get_config('serve.host'), config.get_config('serve.port'))
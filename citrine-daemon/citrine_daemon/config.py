@@ -27,7 +27,108 @@ default_config = {
         'port': 5402,
     },
     'storage_path': storage_path,
-    'worker_threads': 16,
+    'database': {
+        # Seconds a writer waits on a locked database before giving up
+        'busy_timeout': 30,
+        'cache_size_kb': 8192,
+    },
+    'worker_pools': {
+        # Number of worker threads for each class of job
+        'inference': 16,
+        'package': 2,
+        'download': 2,
+        'control': 2,
+    },
+    'job_queue': {
+        'max_size': 1000,
+        'retry_after': 1,
+        # Seconds a synchronous request's job may wait to start before it's dropped, unless the request sets its own
+        # deadline. Matches the client's timeout, after which nobody is waiting for the result. 0 to never drop
+        'default_deadline': 60,
+    },
+    'job_cache': {
+        # Seconds a finished job's result is kept for /async/get
+        'hold_time': 60,
+        # Total size of the results being kept. Past this, the oldest finished jobs are dropped early
+        'max_result_bytes': 256 * 1024 ** 2,
+    },
+    'scheduling': {
+        # Jobs in each pool run by priority: interactive, normal, then batch. Requests choose with X-Citrine-Priority
+        # or ?priority=; by default synchronous calls are interactive and /async ones normal
+        # A waiting job moves up one priority for every aging_s seconds it's waited, so batch jobs still get through.
+        # 0 for strict priorities
+        'aging_s': 5,
+        # Within a priority, clients (X-Citrine-Client, or else their address) take turns. A client with weight 3
+        # gets three jobs per turn. CitrineClient sends its client option, or a name per process if that isn't set
+        'client_weights': {},
+    },
+    'coalescing': {
+        # Identical /run and /_run requests that arrive while one is in flight share its job
+        'enabled': True,
+    },
+    'pipeline': {
+        # Run /run calls as three stages (input processing, model, output processing) on separate pools instead of
+        # start to finish on one inference worker. Off by default: it moves /run off the inference pool entirely
+        'enabled': False,
+        'workers': {
+            'pre': 4,
+            # Defaults to worker_pools.inference, so as many models run at once as without the pipeline
+            'infer': None,
+            'post': 4,
+        },
+        # Requests are queued up front in the pre stage; the queues between stages are kept short so a slow stage
+        # holds back the ones before it
+        'stage_queue_size': 32,
+    },
+    'run_batch': {
+        # Most inputs one /run_batch request can carry. The client splits bigger lists up to fit
+        'max_items': 1024,
+    },
+    'session_cache': {
+        'max_bytes': 2 * 1024 ** 3,
+        'ttl': 600,
+    },
+    # Upper bound on inference worker threads plus onnxruntime pool threads. Defaults to the core count. Workers hold
+    # back at most half of it; models that set their own thread counts get them regardless
+    'thread_budget': None,
+    # onnxruntime options for every session, unless a model's meta.json "session" block overrides them
+    'session_defaults': {
+        'intra_op_threads': None,
+        'inter_op_threads': None,
+        'execution_mode': 'sequential',
+        'enable_cpu_mem_arena': None,
+        'enable_mem_pattern': None,
+        'cpu_affinity': None,
+    },
+    'process_pool': {
+        # For packages with "execution": "process". workers defaults to the core count
+        'workers': None,
+        # Tensors at least this big are passed to and from the processes through shared memory
+        'min_shared_bytes': 64 * 1024,
+    },
+    'optimization': {
+        # Save a graph-optimized copy of each model at install time, and load that instead of the original
+        # level is one of disable, basic, extended, all
+        'enabled': True,
+        'level': 'extended',
+    },
+    # Load and test-run every model when its package is activated, and at startup
+    'warmup': True,
+    'result_cache': {
+        # Only ever used for packages whose meta.json declares "deterministic": true
+        'enabled': True,
+        'max_bytes': 256 * 1024 ** 2,
+        'ttl': 300,
+    },
+    'metrics': {
+        # Add each job's per-phase timings to its data in /async/get
+        'attach_timings': False,
+    },
+    'profiling': {
+        # Fraction of jobs to run under cProfile, on top of the ones that ask for it (X-Citrine-Profile: 1 or
+        # ?profile=1). Profiles are saved to the results dir, and the job's data points at them
+        'sample_rate': 0.0,
+    },
     'repository_url': 'https://raw.githubusercontent.com/antonpaquin/citrine-repo/master/daemon/index',
 }
 
@@ -70,6 +171,7 @@ def init_config():
         user_config = {}
 
     daemon_config = recursive_merge(base_config, user_config)
+    _apply_legacy_worker_threads(user_config or {})
 
     if not os.path.isdir(config_path):
         os.makedirs(config_path)
@@ -79,6 +181,19 @@ def init_config():
             yaml.dump(daemon_config, out_f)
         
         
+def _apply_legacy_worker_threads(user_config: Dict):
+    # daemon.yaml from before worker_pools has worker_threads instead, and first start wrote it out for everyone,
+    # so a tuned value there still sizes the inference pool unless worker_pools.inference is set too
+    worker_threads = user_config.get('worker_threads')
+    if worker_threads is None:
+        return
+    if 'inference' in (user_config.get('worker_pools') or {}):
+        warnings.warn('daemon.yaml sets both worker_threads and worker_pools.inference; ignoring worker_threads')
+        return
+    warnings.warn('worker_threads in daemon.yaml is deprecated, use worker_pools.inference instead')
+    daemon_config['worker_pools']['inference'] = worker_threads
+
+
 def get_config(key: str):
     keys = key.split('.')
     c = daemon_config
@@ -1,4 +1,4 @@
-from . import nn
+from . import batch, cache, memo, nn, procpool
 
-from .call import call, call_raw
-from .functions import create_function, list_active_function_names, clear_functions
+from .call import call, call_batch, call_raw
+from .functions import create_function, list_active_function_names, clear_functions, invalidate_package
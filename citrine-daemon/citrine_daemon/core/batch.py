@@ -0,0 +1,207 @@
+import logging
+import threading
+from typing import *
+
+import numpy as np
+
+from citrine_daemon import errors
+from . import nn
+
+
+logger = logging.getLogger(__name__)
+
+NP_ARGT = Dict[str, np.ndarray]
+
+
+class BatchItem(object):
+    def __init__(self, inputs: NP_ARGT):
+        self.inputs = inputs
+        self.outputs = None  # type: Optional[NP_ARGT]
+        self.exc = None  # type: Optional[BaseException]
+        self.done = threading.Event()
+
+    def resolve(self, outputs: NP_ARGT):
+        self.outputs = outputs
+        self.done.set()
+
+    def fail(self, exc: BaseException):
+        self.exc = exc
+        self.done.set()
+
+
+class Batch(object):
+    def __init__(self):
+        self.items = []  # type: List[BatchItem]
+        self.full = threading.Event()
+        self.closed = False
+
+
+def batch_signature(inputs: NP_ARGT) -> Optional[Tuple]:
+    """
+    Inputs with the same signature can be concatenated along the first axis.
+    Returns None if the inputs can't be batched at all (scalars, or inputs that disagree on the batch size)
+    """
+    rows = None
+    signature = []
+    for name in sorted(inputs.keys()):
+        arr = inputs[name]
+        if arr.ndim == 0:
+            return None
+        if rows is None:
+            rows = arr.shape[0]
+        elif arr.shape[0] != rows:
+            return None
+        signature.append((name, arr.dtype.str, arr.shape[1:]))
+    if rows is None:
+        return None
+    return tuple(signature)
+
+
+def batch_rows(inputs: NP_ARGT) -> int:
+    return next(iter(inputs.values())).shape[0]
+
+
+def run_batched(model_file: str, items: List[NP_ARGT]) -> List[Union[NP_ARGT, 'errors.CitrineException']]:
+    """
+    Run a list of model inputs, merging the ones that share a signature into a single session.run call.
+    Each entry of the result is either that item's outputs or the exception it failed with
+    """
+    results = [None] * len(items)  # type: List[Union[NP_ARGT, errors.CitrineException, None]]
+    groups = {}  # type: Dict[Any, List[int]]
+    for idx, inputs in enumerate(items):
+        signature = batch_signature(inputs)
+        if signature is None:
+            groups[('unbatchable', idx)] = [idx]
+        else:
+            groups.setdefault(signature, []).append(idx)
+
+    for indices in groups.values():
+        if len(indices) > 1:
+            try:
+                outputs = _run_group(model_file, [items[idx] for idx in indices])
+                for idx, out in zip(indices, outputs):
+                    results[idx] = out
+                continue
+            except errors.CitrineException as e:
+                # Usually means the model doesn't have a dynamic batch axis. Fall back to running one by one, so that
+                # a single malformed item can't fail everything it was batched with
+                logger.debug('Batched model run failed; retrying items individually', {'error': e.to_dict()})
+        for idx in indices:
+            try:
+                results[idx] = nn.run_model(model_file, items[idx])
+            except errors.CitrineException as e:
+                results[idx] = e
+
+    return results
+
+
+def _run_group(model_file: str, group: List[NP_ARGT]) -> List[NP_ARGT]:
+    rows = [batch_rows(inputs) for inputs in group]
+    total = sum(rows)
+    merged = {
+        name: np.concatenate([inputs[name] for inputs in group], axis=0)
+        for name in group[0].keys()
+    }
+    logger.debug(f'Running batch of {len(group)} requests ({total} rows)', {'requests': len(group), 'rows': total})
+    outputs = nn.run_model(model_file, merged)
+
+    for name, arr in outputs.items():
+        if arr.ndim == 0 or arr.shape[0] != total:
+            raise errors.ModelRunError(f'Output {name} does not have a batch axis; cannot split batched results')
+
+    split_points = np.cumsum(rows)[:-1]
+    per_output = {name: np.split(arr, split_points, axis=0) for name, arr in outputs.items()}
+    return [
+        {name: parts[idx] for name, parts in per_output.items()}
+        for idx in range(len(group))
+    ]
+
+
+class ModelBatcher(object):
+    """
+    Collects concurrent run_model calls for a single model into batches.
+
+    The first worker to arrive at an empty batcher becomes the leader for a new batch. It waits up to `window` seconds
+    (or until the batch is full) for other workers to join, then runs the whole batch and hands each worker its slice
+    of the output. Workers that joined just block until their slice is ready.
+    """
+
+    def __init__(self, model_file: str, window: float, max_size: int):
+        self.model_file = model_file
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._current = None  # type: Optional[Batch]
+
+    def run(self, inputs: NP_ARGT) -> NP_ARGT:
+        item = BatchItem(inputs)
+        with self._lock:
+            batch = self._current
+            leader = batch is None or batch.closed or len(batch.items) >= self.max_size
+            if leader:
+                batch = Batch()
+                self._current = batch
+            batch.items.append(item)
+            if len(batch.items) >= self.max_size:
+                batch.full.set()
+
+        if leader:
+            self._lead(batch)
+
+        item.done.wait()
+        if item.exc is not None:
+            raise item.exc
+        return item.outputs
+
+    def _lead(self, batch: Batch):
+        try:
+            batch.full.wait(self.window)
+            with self._lock:
+                batch.closed = True
+                if self._current is batch:
+                    self._current = None
+            results = run_batched(self.model_file, [item.inputs for item in batch.items])
+        except BaseException as e:
+            # Includes the leader's job being interrupted -- everyone else in the batch still needs an answer
+            if isinstance(e, errors.JobInterrupted):
+                follower_exc = errors.ModelRunError('Batch was interrupted before it could run')
+            else:
+                follower_exc = e
+            for item in batch.items:
+                if not item.done.is_set():
+                    item.fail(follower_exc)
+            raise
+        for item, result in zip(batch.items, results):
+            if isinstance(result, Exception):
+                item.fail(result)
+            else:
+                item.resolve(result)
+
+
+batchers = {}  # type: Dict[str, ModelBatcher]
+batchers_lock = threading.Lock()
+
+
+def get_batcher(model_file: str, batching: Dict) -> ModelBatcher:
+    with batchers_lock:
+        batcher = batchers.get(model_file)
+        if batcher is None:
+            batcher = ModelBatcher(
+                model_file=model_file,
+                window=batching['window_ms'] / 1000,
+                max_size=batching['max_batch_size'],
+            )
+            batchers[model_file] = batcher
+        return batcher
+
+
+def run_model(model_file: str, inputs: NP_ARGT, batching: Optional[Dict] = None) -> NP_ARGT:
+    if not batching or batching['max_batch_size'] <= 1 or batch_signature(inputs) is None:
+        return nn.run_model(model_file, inputs)
+    return get_batcher(model_file, batching).run(inputs)
+
+
+def drop_batchers(model_files: Iterable[str]) -> None:
+    with batchers_lock:
+        for model_file in model_files:
+            batchers.pop(model_file, None)
@@ -0,0 +1,177 @@
+from collections import OrderedDict
+import logging
+import threading
+import time
+from typing import *
+
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry(object):
+    __slots__ = ('value', 'weight', 'last_used')
+
+    def __init__(self, value: Any, weight: int):
+        self.value = value
+        self.weight = weight
+        self.last_used = time.monotonic()
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU cache bounded by the total weight of its entries, with an optional idle TTL
+
+    Entries are evicted least-recently-used first until the total weight fits in max_weight, so one heavy entry can
+    push out several light ones. on_evict is called (outside the lock) with (key, value) for everything that leaves
+    the cache, whether by eviction, expiry or an explicit pop.
+    """
+
+    def __init__(
+            self,
+            max_weight: int,
+            ttl: Optional[float] = None,
+            on_evict: Optional[Callable[[Any, Any], None]] = None,
+    ):
+        self.max_weight = max_weight
+        self.ttl = ttl
+        self.on_evict = on_evict
+
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()  # type: OrderedDict[Any, CacheEntry]
+        self._lock = threading.Lock()
+
+    def configure(self, max_weight: int, ttl: Optional[float]):
+        with self._lock:
+            self.max_weight = max_weight
+            self.ttl = ttl
+            evicted = self._shrink()
+        self._notify(evicted)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        t_now = time.monotonic()
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry, t_now):
+                # Don't leave it for the janitor, or peek() would keep handing it out until then
+                evicted.append((key, self._evict(key)))
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                entry.last_used = t_now
+                self._entries.move_to_end(key)
+        self._notify(evicted)
+        return default if entry is None else entry.value
+
+    def peek(self, key: Any, default: Any = None) -> Any:
+        # Like get, but doesn't count as a use of the entry
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._is_expired(entry, time.monotonic()):
+                return default
+            return entry.value
+
+    def put(self, key: Any, value: Any, weight: int = 1) -> None:
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                old = self._entries.pop(key)
+                self.weight -= old.weight
+                evicted.append((key, old.value))
+            if weight > self.max_weight:
+                logger.debug('Cache entry is larger than the whole cache; not storing it', {'weight': weight})
+                # Never made it in, but the owner still needs the callback to clean up after it
+                evicted.append((key, value))
+            else:
+                self._entries[key] = CacheEntry(value, weight)
+                self.weight += weight
+            evicted.extend(self._shrink())
+        self._notify(evicted)
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.weight -= entry.weight
+        self._notify([(key, entry.value)])
+        return entry.value
+
+    def pop_where(self, predicate: Callable[[Any], bool]) -> int:
+        with self._lock:
+            keys = [k for k in self._entries.keys() if predicate(k)]
+            evicted = []
+            for k in keys:
+                evicted.append((k, self._evict(k)))
+        self._notify(evicted)
+        return len(evicted)
+
+    def expire(self) -> int:
+        if self.ttl is None:
+            return 0
+        t_now = time.monotonic()
+        with self._lock:
+            evicted = []
+            # Entries are in LRU order, so the stale ones are all at the front
+            while self._entries:
+                key, entry = next(iter(self._entries.items()))
+                if not self._is_expired(entry, t_now):
+                    break
+                self._entries.popitem(last=False)
+                self.weight -= entry.weight
+                self.evictions += 1
+                evicted.append((key, entry.value))
+        self._notify(evicted)
+        return len(evicted)
+
+    def clear(self):
+        self.pop_where(lambda k: True)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'weight': self.weight,
+                'max_weight': self.max_weight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _is_expired(self, entry: CacheEntry, t_now: float) -> bool:
+        return self.ttl is not None and (t_now - entry.last_used) > self.ttl
+
+    def _evict(self, key: Any) -> Any:
+        # Caller holds the lock
+        entry = self._entries.pop(key)
+        self.weight -= entry.weight
+        self.evictions += 1
+        return entry.value
+
+    def _shrink(self) -> List[Tuple[Any, Any]]:
+        # Caller holds the lock
+        evicted = []
+        while self.weight > self.max_weight and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            self.weight -= entry.weight
+            self.evictions += 1
+            evicted.append((key, entry.value))
+        return evicted
+
+    def _notify(self, evicted: List[Tuple[Any, Any]]):
+        if self.on_evict is None:
+            return
+        for key, value in evicted:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                logger.warning('Cache eviction callback failed', {'error': e, 'args': e.args})
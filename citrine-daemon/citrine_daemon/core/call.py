@@ -4,9 +4,8 @@ from typing import *
 
 import numpy as np
 
-from citrine_daemon import errors, package, storage
-from . import nn, functions
-from .validator import CitrineValidator
+from citrine_daemon import errors, metrics, package, storage
+from . import batch, memo, nn, functions, procpool
 
 
 logger = logging.getLogger(__name__)
@@ -14,21 +13,78 @@ logger = logging.getLogger(__name__)
 NP_ARGT = Dict[str, np.ndarray]
 
 
+class PreparedCall(object):
+    """
+    A call part-way through: call() is split into prepare, infer and finish, so the server can run each step on its
+    own pool and overlap one request's model run with the next one's input processing
+    """
+
+    def __init__(self, resolved: functions.ResolvedFunction, memo_key: Optional[Tuple]):
+        self.resolved = resolved
+        self.memo_key = memo_key
+        self.model_input = None  # type: Optional[NP_ARGT]
+        self.model_outputs = None  # type: Optional[NP_ARGT]
+        self.ctx = None
+        self.wants_ctx = False
+        # Set when the call was answered without needing the model (cached, or run in the process pool)
+        self.finished = False
+        self.outputs = None
+
+    def finish_early(self, outputs: Dict) -> 'PreparedCall':
+        self.finished = True
+        self.outputs = outputs
+        return self
+
+
 def call(package_name: str, function_name: str, inputs: Dict = None) -> Dict:
+    prepared = prepare(package_name, function_name, inputs)
+    if prepared.finished:
+        return prepared.outputs
+    infer(prepared)
+    return finish(prepared)
+
+
+def prepare(package_name: str, function_name: str, inputs: Dict = None) -> PreparedCall:
     logger.info(
         f'Attempting to call function {package_name}/{function_name}',
         {'package': package_name, 'function': function_name},
     )
-    function = functions.get_active_function(package_name, function_name)
-    if function.input_validator:
-        v = CitrineValidator(schema=function.input_validator)
-        if not v.validate(inputs):
+    # The names come straight off the URL, they only become metric labels once they've resolved to something real
+    metrics.label_job(metrics.UNKNOWN, metrics.UNKNOWN)
+    resolved = functions.resolve_function(package_name, function_name)
+    metrics.label_job(package_name, function_name)
+    return prepare_resolved(resolved, inputs)
+
+
+def prepare_resolved(resolved: functions.ResolvedFunction, inputs: Dict) -> PreparedCall:
+    function = resolved.function
+    package_name = resolved.package_name
+    function_name = function.name
+    if function.execution == 'process' and not procpool.in_worker:
+        return PreparedCall(resolved, None).finish_early(procpool.call(package_name, function_name, inputs))
+
+    v = function.get_validator()
+    if v is not None:
+        with metrics.timed('validate'):
+            valid = v.validate(inputs)
+        if not valid:
             raise errors.ValidationError(v.errors)
         inputs = v.document
 
+    memo_key = None
+    if function.deterministic:
+        memo_key = memo.input_key(resolved.package_name, resolved.package_version, function_name, inputs)
+    prepared = PreparedCall(resolved, memo_key)
+    if memo_key is not None:
+        hit, outputs = memo.lookup(memo_key)
+        if hit:
+            logger.debug('Returning cached result')
+            return prepared.finish_early(outputs)
+
     try:
         logger.debug('Beginning 3rd party input processing')
-        processed_input = function.process_input(inputs)
+        with metrics.timed('process_input'):
+            processed_input = function.process_input(inputs)
         logger.debug('Input processing completed')
     except errors.CitrineException:
         raise
@@ -37,42 +93,124 @@ def call(package_name: str, function_name: str, inputs: Dict = None) -> Dict:
         raise errors.PackageError(f'Error in processing inputs for model {package_name}/{function_name}: {e}')
     
     if isinstance(processed_input, dict):
-        model_input = processed_input
-        ctx = None
-        wants_ctx = False
+        prepared.model_input = processed_input
     elif (
             isinstance(processed_input, tuple) 
             and len(processed_input) == 2 
             and isinstance(processed_input[0], dict)
     ):
-        model_input, ctx = processed_input
-        wants_ctx = True
+        prepared.model_input, prepared.ctx = processed_input
+        prepared.wants_ctx = True
     else:
         raise errors.PackageError('"process_input" format error. Acceptable return types are Dict or Tuple[Dict, Any]')
 
-    nn.assert_like_input(model_input)
-    db_model = package.db.DBModel.from_id_name(function.package_id, function.model)
-    model_outputs = nn.run_model(storage.get_model_file(db_model), model_input)
+    nn.assert_like_input(prepared.model_input)
+    return prepared
+
 
+def infer(prepared: PreparedCall) -> PreparedCall:
+    resolved = prepared.resolved
+    with metrics.timed('infer'):
+        prepared.model_outputs = batch.run_model(resolved.model_file, prepared.model_input, resolved.function.batching)
+    # Inputs can be big, no reason to hold onto them through post-processing
+    prepared.model_input = None
+    return prepared
+
+
+def finish(prepared: PreparedCall) -> Dict:
+    resolved = prepared.resolved
+    function = resolved.function
     try:
         logger.debug('Beginning 3rd party output processing')
-        if wants_ctx:
-            outputs = function.process_output(model_outputs, ctx)
-        else:
-            outputs = function.process_output(model_outputs)
+        with metrics.timed('process_output'):
+            if prepared.wants_ctx:
+                outputs = function.process_output(prepared.model_outputs, prepared.ctx)
+            else:
+                outputs = function.process_output(prepared.model_outputs)
         logger.debug('Output processing completed')
     except errors.CitrineException:
         raise
     except Exception as e:
         logger.info('Output processing failed', {'error': e, 'args': e.args})
-        raise errors.PackageError(f'Error in processing outputs for model {package_name}/{function_name}: {e}')
+        raise errors.PackageError(
+            f'Error in processing outputs for model {resolved.package_name}/{function.name}: {e}'
+        )
 
+    if prepared.memo_key is not None:
+        memo.store(prepared.memo_key, outputs)
     return outputs
 
 
+# One item of a batch call: where it's got to, or what it failed with
+BATCH_ITEM = Union[PreparedCall, 'errors.CitrineException']
+
+
+def call_batch(package_name: str, function_name: str, inputs: List[Dict]) -> List[Dict]:
+    return finish_batch(infer_batch(prepare_batch(package_name, function_name, inputs)))
+
+
+def prepare_batch(package_name: str, function_name: str, inputs: List[Dict]) -> List[BATCH_ITEM]:
+    """
+    prepare for each of a list of inputs. One bad input fails on its own rather than taking the batch down with it
+    """
+    logger.info(
+        f'Attempting to call function {package_name}/{function_name} on a batch of {len(inputs)}',
+        {'package': package_name, 'function': function_name, 'batch_size': len(inputs)},
+    )
+    metrics.label_job(metrics.UNKNOWN, metrics.UNKNOWN)
+    resolved = functions.resolve_function(package_name, function_name)
+    metrics.label_job(package_name, function_name)
+    items = []  # type: List[BATCH_ITEM]
+    for item_inputs in inputs:
+        try:
+            items.append(prepare_resolved(resolved, item_inputs))
+        except errors.CitrineException as e:
+            items.append(e)
+    return items
+
+
+def infer_batch(items: List[BATCH_ITEM]) -> List[BATCH_ITEM]:
+    waiting = [item for item in items if isinstance(item, PreparedCall) and not item.finished]
+    if not waiting:
+        return items
+    # Every item calls the same function, so they all run against the same model
+    model_file = waiting[0].resolved.model_file
+    with metrics.timed('infer'):
+        # Items whose inputs line up go through the model together
+        results = batch.run_batched(model_file, [prepared.model_input for prepared in waiting])
+    failed = {}
+    for prepared, res in zip(waiting, results):
+        prepared.model_input = None
+        if isinstance(res, errors.CitrineException):
+            failed[id(prepared)] = res
+        else:
+            prepared.model_outputs = res
+    return [failed.get(id(item), item) for item in items]
+
+
+def finish_batch(items: List[BATCH_ITEM]) -> List[Dict]:
+    """
+    :return: For each input, {'result': outputs} or {'error': what went wrong}
+    """
+    results = []
+    for item in items:
+        if isinstance(item, errors.CitrineException):
+            results.append({'error': item})
+        elif item.finished:
+            results.append({'result': item.outputs})
+        else:
+            try:
+                results.append({'result': finish(item)})
+            except errors.CitrineException as e:
+                results.append({'error': e})
+    return results
+
+
 def call_raw(package_name: str, model_name: str, inputs: NP_ARGT) -> NP_ARGT:
+    metrics.label_job(metrics.UNKNOWN, metrics.UNKNOWN)
     db_package = package.DBPackage.from_name_latest(package_name)
     db_model = package.DBModel.from_id_name(db_package.rowid, model_name)
+    metrics.label_job(package_name, model_name)
     model_file = storage.get_model_file(db_model)
     return nn.run_model(model_file, inputs)
 
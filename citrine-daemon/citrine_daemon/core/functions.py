@@ -1,11 +1,13 @@
 import logging
+import threading
 from typing import *
 
 import cerberus
 import numpy as np
 
-from citrine_daemon import errors, package
+from citrine_daemon import errors, package, storage
 
+from . import memo, procpool
 from .validator import CitrineValidator
 
 
@@ -16,6 +18,10 @@ NP_ARGT = Dict[str, np.ndarray]
 
 function_lookup = {}  # type: Dict[int, Dict[str, Function]]
 
+# package name -> function name -> ResolvedFunction, for whichever version of the package is active
+active_index = {}  # type: Dict[str, Dict[str, ResolvedFunction]]
+active_index_lock = threading.Lock()
+
 
 class Function(object):
     def __init__(
@@ -26,6 +32,10 @@ class Function(object):
             process_input: Callable[[Dict], Union[NP_ARGT, Tuple[NP_ARGT, Any]]],
             process_output: Union[Callable[[NP_ARGT], Dict], Callable[[NP_ARGT, Any], Dict]],
             input_validator: Dict = None,
+            input_schema: cerberus.schema.DefinitionSchema = None,
+            batching: Dict = None,
+            deterministic: bool = False,
+            execution: str = 'thread',
     ):
         self.name = name
         self.package_id = package_id
@@ -33,6 +43,40 @@ class Function(object):
         self.process_input = process_input
         self.process_output = process_output
         self.input_validator = input_validator
+        self.input_schema = input_schema
+        self.batching = batching
+        # Only functions whose package opts in as deterministic have their results cached
+        self.deterministic = deterministic
+        # 'thread' runs in the daemon's worker threads, 'process' in the inference process pool
+        self.execution = execution
+        self._validators = threading.local()
+
+    def get_validator(self) -> Optional[CitrineValidator]:
+        """
+        Validators hold the document they're working on, so they can't be shared between worker threads. Each thread
+        gets its own, all built from the same pre-normalized schema (cerberus skips normalization when it's handed a
+        DefinitionSchema)
+        """
+        if self.input_schema is None:
+            return None
+        validator = getattr(self._validators, 'validator', None)
+        if validator is None:
+            validator = CitrineValidator(schema=self.input_schema)
+            self._validators.validator = validator
+        return validator
+
+
+class ResolvedFunction(object):
+    """
+    A function joined with the package and model it runs against, so calls don't need to go back to the DB
+    """
+
+    def __init__(self, function: Function, package_name: str, package_version: str, model_file: str):
+        self.function = function
+        self.package_name = package_name
+        self.package_version = package_version
+        # Also the key for the session cache
+        self.model_file = model_file
 
 
 def create_function(
@@ -51,13 +95,15 @@ def create_function(
     if model is None:
         model = name
 
+    input_schema = None
     if input_validator is not None:
         try:
-            CitrineValidator(schema=input_validator)
+            input_schema = CitrineValidator(schema=input_validator).schema
         except cerberus.schema.SchemaError as e:
             raise errors.PackageInstallError('Package input_validator is incorrect', data=e.args[0])
 
     pkg = package.load.get_loading_package()  # type: package.DBPackage
+    pkg_meta = package.load.get_loading_meta() or {}
 
     function = Function(
         name=name,
@@ -66,6 +112,10 @@ def create_function(
         process_input=process_input,
         process_output=process_output,
         input_validator=input_validator,
+        input_schema=input_schema,
+        batching=pkg_meta.get('batching'),
+        deterministic=pkg_meta.get('deterministic', False),
+        execution=pkg_meta.get('execution', 'thread'),
     )
 
     # package is always active or in the process of activating when this is called
@@ -77,18 +127,70 @@ def create_function(
     logger.info(f'Function {name} created for package id {pkg.rowid}', {'function': name, 'package_id': pkg.rowid})
 
 
-def get_active_function(package_name: str, function_name: str) -> 'Function':
+def index_package(package_name: str) -> Dict[str, ResolvedFunction]:
     pkg = package.DBPackage.from_name_latest(package_name, only_active=True)
     if pkg.rowid not in function_lookup:
         raise errors.MissingFunction(f'No active package {package_name}', 400)
 
-    package_functions = function_lookup[pkg.rowid]
+    entries = {}
+    for name, function in function_lookup[pkg.rowid].items():
+        db_model = package.DBModel.from_id_name(pkg.rowid, function.model)
+        entries[name] = ResolvedFunction(
+            function=function,
+            package_name=pkg.name,
+            package_version=pkg.version,
+            model_file=storage.get_model_file(db_model),
+        )
+
+    with active_index_lock:
+        active_index[package_name] = entries
+    logger.debug(f'Indexed functions for package {package_name}', {'package_name': package_name})
+    return entries
+
+
+def invalidate_package(package_name: str):
+    """
+    Drop the package from the index, now and again once the current transaction finishes -- otherwise a call
+    on another thread could re-index it from the DB before this change is committed. The process pool only restarts
+    for packages that run (or ran) in it, once the change is committed
+    """
+    def invalidate():
+        with active_index_lock:
+            active_index.pop(package_name, None)
+        memo.drop_package(package_name)
+
+    def refresh_pool():
+        active = [p for p in package.db.DBPackage.get_active_packages() if p.name == package_name]
+        if procpool.package_changed(package_name, any(package.load.is_process_package(p) for p in active)):
+            procpool.reset()
+
+    invalidate()
+    package.db.after_transaction(invalidate)
+    if not procpool.in_worker:
+        package.db.after_commit(('process_pool', package_name), refresh_pool)
+
+
+def resolve_function(package_name: str, function_name: str) -> ResolvedFunction:
+    package_functions = active_index.get(package_name)
+    if package_functions is None:
+        package_functions = index_package(package_name)
+
     if function_name not in package_functions:
         raise errors.MissingFunction(f'Package {package_name} has no function {function_name}', 400)
 
     return package_functions[function_name]
 
 
+def is_deterministic(package_name: str, function_name: str) -> bool:
+    # Safe to call from the event loop: never goes to the DB, and says no to anything not already indexed
+    resolved = active_index.get(package_name, {}).get(function_name)
+    return resolved is not None and resolved.function.deterministic
+
+
+def get_active_function(package_name: str, function_name: str) -> 'Function':
+    return resolve_function(package_name, function_name).function
+
+
 def list_active_function_names(package_id: int) -> List[str]:
     if package_id not in function_lookup:
         return []
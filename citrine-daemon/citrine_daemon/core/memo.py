@@ -0,0 +1,114 @@
+import copy
+import hashlib
+import logging
+import threading
+from typing import *
+
+import numpy as np
+
+from citrine_daemon.util import approx_size
+from .cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+result_cache = LRUCache(max_weight=256 * 1024 ** 2, ttl=300)
+result_cache_enabled = True
+
+# (package name, function name) -> {'hits': int, 'misses': int}
+function_stats = {}  # type: Dict[Tuple[str, str], Dict[str, int]]
+function_stats_lock = threading.Lock()
+
+
+_missing = object()
+
+
+class Unhashable(Exception):
+    pass
+
+
+def init_result_cache(enabled: bool, max_bytes: int, ttl: Optional[float]):
+    global result_cache_enabled
+    logger.info('Configuring result cache', {'enabled': enabled, 'max_bytes': max_bytes, 'ttl': ttl})
+    result_cache_enabled = enabled
+    result_cache.configure(max_weight=max_bytes, ttl=ttl)
+
+
+def _hash_into(h, obj: Any):
+    # Type tags keep e.g. the string "1" and the integer 1 from hashing the same
+    if obj is None:
+        h.update(b'N')
+    elif isinstance(obj, bool):
+        h.update(b'T' if obj else b'F')
+    elif isinstance(obj, (int, float)):
+        h.update(b'n' + repr(obj).encode('utf-8'))
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        h.update(b's' + len(data).to_bytes(8, 'little') + data)
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'l' + len(obj).to_bytes(8, 'little'))
+        for item in obj:
+            _hash_into(h, item)
+    elif isinstance(obj, dict):
+        h.update(b'd' + len(obj).to_bytes(8, 'little'))
+        for key in sorted(obj.keys(), key=str):
+            _hash_into(h, key)
+            _hash_into(h, obj[key])
+    elif isinstance(obj, np.ndarray) and obj.dtype != object:
+        h.update(b'a' + obj.dtype.str.encode('utf-8') + repr(obj.shape).encode('utf-8'))
+        # Not memoryview(...).cast('B'), which refuses arrays with a zero-length axis
+        h.update(memoryview(np.ascontiguousarray(obj).reshape(-1).view(np.uint8)))
+    else:
+        raise Unhashable(type(obj).__name__)
+
+
+def input_key(package_name: str, package_version: str, function_name: str, inputs: Any) -> Optional[Tuple]:
+    if not result_cache_enabled:
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        _hash_into(h, inputs)
+    except Unhashable as e:
+        logger.debug(f'Not caching result: input contains unhashable type {e.args[0]}')
+        return None
+    return package_name, package_version, function_name, h.hexdigest()
+
+
+def _count(key: Tuple, field: str):
+    stat_key = (key[0], key[2])
+    with function_stats_lock:
+        if stat_key not in function_stats:
+            function_stats[stat_key] = {'hits': 0, 'misses': 0}
+        function_stats[stat_key][field] += 1
+
+
+def lookup(key: Tuple) -> Tuple[bool, Any]:
+    # Results can legitimately be None, so report hit / miss separately
+    outputs = result_cache.get(key, _missing)
+    if outputs is _missing:
+        _count(key, 'misses')
+        return False, None
+    _count(key, 'hits')
+    # Every hit would otherwise share the one stored object, and whatever one caller did to it the next would see
+    return True, copy.deepcopy(outputs)
+
+
+def store(key: Tuple, outputs: Any):
+    result_cache.put(key, outputs, weight=approx_size(outputs))
+
+
+def expire_results():
+    result_cache.expire()
+
+
+def drop_package(package_name: str):
+    result_cache.pop_where(lambda key: key[0] == package_name)
+
+
+def get_stats() -> Dict:
+    with function_stats_lock:
+        per_function = {f'{pkg}/{fn}': dict(counts) for (pkg, fn), counts in function_stats.items()}
+    res = result_cache.stats()
+    res['enabled'] = result_cache_enabled
+    res['functions'] = per_function
+    return res
@@ -1,57 +1,268 @@
 import logging
+import os
+import threading
 import time
-from typing import Dict
+from typing import *
 
 import numpy as np
 import onnxruntime
 
-from citrine_daemon import errors
+from citrine_daemon import errors, metrics, storage
 from citrine_daemon.util import truncate_str
+from .cache import LRUCache
 
 
 logger = logging.getLogger(__name__)
 
 
-class OnnxSession:
-    sessions: Dict[str, 'OnnxSession'] = {}
-    ttl = 30
+class ThreadBudget(object):
+    """
+    Keeps the threads onnxruntime spins up for cached sessions, plus the worker threads that call into them, within a
+    fixed total (by default, the core count). Each session is charged for the pool threads it adds beyond the calling
+    thread, and gets its charge back when it leaves the cache. Sessions that don't ask for a thread count split
+    what's left after the workers evenly between the models expected to load, instead of first come first served
+    """
+
+    # Worker threads spend most of their time waiting on a queue or on the model, so they never hold back more than
+    # this share of the budget; counted one for one, 20 workers would leave nothing for sessions on most machines
+    max_reserved_fraction = 0.5
 
-    def __init__(self, model_file: str):
-        self.model_file = model_file
-        self.sess: onnxruntime.InferenceSession = None
-        self.expire_timer = None
-        self.reset_expiration()
+    def __init__(self, total: int, reserved: int):
+        self.total = total
+        self.reserved = min(reserved, int(total * self.max_reserved_fraction))
+        self.allocated = 0
+        self._lock = threading.Lock()
+
+    def allocate(
+            self,
+            intra_op: Optional[int],
+            inter_op: Optional[int],
+            parallel: bool,
+            model_file: str = '',
+            sessions: int = 1,
+    ) -> Tuple[int, int]:
+        """
+        :param sessions: How many models are expected to hold a session at once
+        """
+        with self._lock:
+            available = max(self.total - self.reserved - self.allocated, 0)
+            share = min(max(self.total - self.reserved, 0) // max(sessions, 1), available)
+            intra_extra = self._extra(intra_op, available, share, 'intra_op_threads', model_file)
+            available = max(available - intra_extra, 0)
+            share = max(min(share - intra_extra, available), 0)
+            inter_extra = self._extra(inter_op, available, share, 'inter_op_threads', model_file) if parallel else 0
+            self.allocated += intra_extra + inter_extra
+        return 1 + intra_extra, 1 + inter_extra
 
     @staticmethod
-    def get_session(model_file: str):
-        if model_file not in OnnxSession.sessions:
-            sess = OnnxSession.sessions[model_file]
-            sess.reset_expiration()
+    def _extra(requested: Optional[int], available: int, share: int, setting: str, model_file: str) -> int:
+        # None / 0 means "as many as you can spare", like onnxruntime's own default, but only out of this session's
+        # share so the models loaded after it still get theirs
+        if not requested:
+            return min((os.cpu_count() or 1) - 1, share)
+        # An explicit count from meta.json or daemon.yaml is honoured, even past the budget
+        if requested - 1 > available:
+            logger.warning(
+                f'Session asked for more {setting} than the thread budget has left',
+                {'model_file': model_file, 'setting': setting, 'requested': requested, 'available': available + 1},
+            )
+        return requested - 1
+
+    def release(self, intra_op: int, inter_op: int):
+        with self._lock:
+            self.allocated -= (intra_op - 1) + (inter_op - 1)
+
+    def stats(self) -> Dict:
+        return {'total': self.total, 'reserved': self.reserved, 'allocated': self.allocated}
+
+
+def _release_session(model_file: str, session: onnxruntime.InferenceSession):
+    threads = _session_threads.pop(id(session), None)
+    if threads is not None:
+        thread_budget.release(*threads)
+
+
+session_cache = LRUCache(max_weight=2 * 1024 ** 3, ttl=600, on_evict=_release_session)
+_session_load_locks = {}  # type: Dict[str, threading.Lock]
+_session_load_locks_lock = threading.Lock()
+
+thread_budget = ThreadBudget(total=os.cpu_count() or 1, reserved=0)
+_session_threads = {}  # type: Dict[int, Tuple[int, int]]
+session_defaults = {}  # type: Dict[str, Any]
+# model file -> session settings from the package's meta.json
+model_settings = {}  # type: Dict[str, Dict[str, Any]]
+# Models of loaded packages, as the files each may be opened from, for splitting the thread budget between them
+known_models = set()  # type: Set[Tuple[str, ...]]
+
+
+def init_sessions(
+        max_bytes: int,
+        ttl: Optional[float],
+        thread_budget_total: Optional[int] = None,
+        reserved_threads: int = 0,
+        defaults: Optional[Dict[str, Any]] = None,
+):
+    global thread_budget, session_defaults
+    logger.info('Configuring ONNX session cache', {'max_bytes': max_bytes, 'ttl': ttl})
+    session_cache.configure(max_weight=max_bytes, ttl=ttl)
+    thread_budget = ThreadBudget(total=thread_budget_total or os.cpu_count() or 1, reserved=reserved_threads)
+    logger.info('Configuring session thread budget', thread_budget.stats())
+    session_defaults = {k: v for k, v in (defaults or {}).items() if v is not None}
+
+
+def configure_model(model_files: Iterable[str], settings: Optional[Dict[str, Any]]):
+    model_files = tuple(model_files)
+    known_models.add(model_files)
+    for model_file in model_files:
+        if settings:
+            model_settings[model_file] = {k: v for k, v in settings.items() if v is not None}
         else:
-            sess = OnnxSession(model_file)
-            OnnxSession.sessions[model_file] = sess
-        return sess
-        
-    def reset_expiration(self):
-        self.expire_timer = time.time()
+            model_settings.pop(model_file, None)
 
-    @staticmethod
-    def cleanup():
-        t_now = time.time()
-        for k, sess in OnnxSession.sessions.items():
-            if (t_now - sess.expire_timer) > OnnxSession.ttl:
-                OnnxSession.sessions.pop(k)
-                
-    def test_expire(self):
-        if (self.expire_timer - time.time()) >= OnnxSession.ttl:
-            OnnxSession.sessions.pop(self.model_file)
-        
 
-def _get_session(model_file: str) -> onnxruntime.InferenceSession:
-    session = onnxruntime.InferenceSession(model_file)
+def _session_weight(model_file: str) -> int:
+    # onnxruntime doesn't report how much memory a session holds, but for most models the initializers dominate, and
+    # those are roughly the size of the file on disk
+    try:
+        return max(os.path.getsize(model_file), 1)
+    except OSError:
+        return 1
+
+
+def _load_lock(model_file: str) -> threading.Lock:
+    with _session_load_locks_lock:
+        if model_file not in _session_load_locks:
+            _session_load_locks[model_file] = threading.Lock()
+        return _session_load_locks[model_file]
+
+
+optimization_levels = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+execution_modes = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def session_options(model_file: str) -> Tuple[onnxruntime.SessionOptions, Tuple[int, int]]:
+    """
+    Build the options for a new session from daemon.yaml's session_defaults, overridden by the model's own settings.
+    Also returns the (intra, inter) thread counts charged against the thread budget
+    """
+    settings = dict(session_defaults)
+    settings.update(model_settings.get(model_file, {}))
+
+    opts = onnxruntime.SessionOptions()
+    if storage.is_optimized_model_file(model_file):
+        # Already optimized at install time, don't pay for it again on every load
+        opts.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+
+    mode = settings.get('execution_mode', 'sequential')
+    opts.execution_mode = execution_modes[mode]
+    intra_op, inter_op = thread_budget.allocate(
+        settings.get('intra_op_threads'),
+        settings.get('inter_op_threads'),
+        parallel=(mode == 'parallel'),
+        model_file=model_file,
+        sessions=len(known_models),
+    )
+    opts.intra_op_num_threads = intra_op
+    opts.inter_op_num_threads = inter_op
+
+    if 'enable_cpu_mem_arena' in settings:
+        opts.enable_cpu_mem_arena = settings['enable_cpu_mem_arena']
+    if 'enable_mem_pattern' in settings:
+        opts.enable_mem_pattern = settings['enable_mem_pattern']
+
+    affinity = settings.get('cpu_affinity')
+    if affinity and intra_op > 1:
+        # One entry per pool thread (the calling thread isn't pinned), and onnxruntime counts processors from 1
+        pinned = ';'.join(str(affinity[idx % len(affinity)] + 1) for idx in range(intra_op - 1))
+        try:
+            opts.add_session_config_entry('session.intra_op_thread_affinities', pinned)
+        except Exception as e:
+            logger.warning('This onnxruntime does not support thread affinity', {'error': str(e)})
+
+    return opts, (intra_op, inter_op)
+
+
+def optimize_model(source_file: str, target_file: str, level: str) -> float:
+    """
+    Run onnxruntime's graph optimizations on source_file once and save the result to target_file
+    """
+    if level not in optimization_levels:
+        raise errors.InternalError(f'Unknown optimization level {level}', data={'allowed': list(optimization_levels)})
+    t_start = time.monotonic()
+    part_file = target_file + '.part'
+    opts = onnxruntime.SessionOptions()
+    opts.graph_optimization_level = optimization_levels[level]
+    opts.optimized_model_filepath = part_file
+    try:
+        onnxruntime.InferenceSession(source_file, opts)
+        os.replace(part_file, target_file)
+    except Exception as e:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        raise errors.ModelRunError(f'Failed to optimize model {source_file}', data=str(e))
+    optimize_time = time.monotonic() - t_start
+    logger.info(f'Optimized {source_file}', {'model': source_file, 'level': level, 'optimize_time': optimize_time})
+    return optimize_time
+
+
+def get_session(model_file: str) -> onnxruntime.InferenceSession:
+    session = session_cache.get(model_file)
+    if session is not None:
+        return session
+
+    # Two workers asking for the same cold model should only load it once
+    with _load_lock(model_file):
+        session = session_cache.peek(model_file)
+        if session is not None:
+            return session
+        logger.debug(f'Loading ONNX session for {model_file}', {'model': model_file})
+        t_start = time.monotonic()
+        opts, threads = session_options(model_file)
+        try:
+            session = onnxruntime.InferenceSession(model_file, opts)
+        except BaseException:
+            thread_budget.release(*threads)
+            raise
+        load_time = time.monotonic() - t_start
+        metrics.record('session_load', load_time)
+        logger.info(f'Loaded ONNX session for {model_file}', {
+            'model': model_file,
+            'load_time': load_time,
+            'intra_op_threads': threads[0],
+            'inter_op_threads': threads[1],
+        })
+        _session_threads[id(session)] = threads
+        session_cache.put(model_file, session, weight=_session_weight(model_file))
     return session
 
 
+def drop_sessions(model_files: Iterable[str]) -> None:
+    model_files = set(model_files)
+    known_models.difference_update([model for model in known_models if model_files.intersection(model)])
+    dropped = session_cache.pop_where(lambda k: k in model_files)
+    with _session_load_locks_lock:
+        for model_file in model_files:
+            _session_load_locks.pop(model_file, None)
+    if dropped:
+        logger.info(f'Dropped {dropped} cached ONNX sessions', {'dropped': dropped})
+
+
+def expire_sessions() -> None:
+    expired = session_cache.expire()
+    if expired:
+        logger.debug(f'Expired {expired} idle ONNX sessions', {'expired': expired})
+
+
 def assert_like_input(inputs: Dict) -> None:
     for k, v in inputs.items():
         if not isinstance(k, str):
@@ -91,22 +302,92 @@ def coerce_types(raw_inputs: Dict[str, np.ndarray], session: onnxruntime.Inferen
     return res
 
 
+onnx_np_types = {
+    'tensor(float)': np.float32,
+    'tensor(double)': np.float64,
+    'tensor(float16)': np.float16,
+    'tensor(int8)': np.int8,
+    'tensor(int16)': np.int16,
+    'tensor(int32)': np.int32,
+    'tensor(int64)': np.int64,
+    'tensor(uint8)': np.uint8,
+    'tensor(uint16)': np.uint16,
+    'tensor(uint32)': np.uint32,
+    'tensor(uint64)': np.uint64,
+    'tensor(bool)': np.bool_,
+}
+
+
+def synthetic_inputs(session: onnxruntime.InferenceSession) -> Dict[str, np.ndarray]:
+    # Zeros in the shape the model declares, with 1 standing in for every symbolic / unknown dimension
+    res = {}
+    for tensor_input in session.get_inputs():
+        if tensor_input.type not in onnx_np_types:
+            raise errors.ModelRunError(f'Cannot make a synthetic input {tensor_input.name} of type {tensor_input.type}')
+        shape = [dim if isinstance(dim, int) and dim > 0 else 1 for dim in tensor_input.shape]
+        res[tensor_input.name] = np.zeros(shape, dtype=onnx_np_types[tensor_input.type])
+    return res
+
+
+def warm_up(model_file: str, sample_inputs: Optional[Dict[str, np.ndarray]] = None) -> Dict[str, float]:
+    """
+    Load the session and push one inference through it, so that neither the model load nor onnxruntime's first-run
+    allocations land on a real request
+    """
+    t_start = time.monotonic()
+    session = get_session(model_file)
+    t_loaded = time.monotonic()
+    if sample_inputs is None:
+        sample_inputs = synthetic_inputs(session)
+    run_model(model_file, sample_inputs)
+    t_done = time.monotonic()
+    timings = {
+        'load_time': t_loaded - t_start,
+        'run_time': t_done - t_loaded,
+    }
+    logger.info(f'Warmed up {model_file}', dict(timings, model=model_file))
+    return timings
+
+
+def profile_model(model_file: str, sample_inputs: Optional[Dict[str, np.ndarray]] = None, runs: int = 10) -> str:
+    """
+    Run the model a few times in a separate session with onnxruntime's profiler on, so live sessions aren't slowed
+    down by it. Returns the name of the chrome-trace JSON in the results dir
+    """
+    opts, threads = session_options(model_file)
+    opts.enable_profiling = True
+    opts.profile_file_prefix = os.path.join(
+        storage.results_path(),
+        'ort-profile-' + os.path.splitext(os.path.basename(model_file))[0],
+    )
+    try:
+        session = onnxruntime.InferenceSession(model_file, opts)
+        if sample_inputs is None:
+            sample_inputs = synthetic_inputs(session)
+        inputs = coerce_types(sample_inputs, session)
+        outputs = [n.name for n in session.get_outputs()]
+        for _ in range(runs):
+            session.run(outputs, inputs)
+        trace_file = session.end_profiling()
+    except onnxruntime.capi.onnxruntime_pybind11_state.Fail as e:
+        raise errors.ModelRunError('Failed to profile model', data=str(e))
+    finally:
+        thread_budget.release(*threads)
+    logger.info(f'Profiled {model_file}', {'model': model_file, 'runs': runs, 'trace_file': trace_file})
+    return os.path.basename(trace_file)
+
+
 def run_model(
         model_file: str,
         raw_inputs: Dict[str, np.ndarray],
 ) -> Dict[str, np.ndarray]:
-    # TODO: session caching, batching
-    # Probably once I have a garbage collector
-    # I want to hold sessions in an LRU-like cache
-    # (or have it be very configurable)
-    # With possibly eviction weighted by memory size of the sessions
-    logger.debug(f'Starting ONNX session for {model_file}', {'model': model_file})
-    session = _get_session(model_file)
+    session = get_session(model_file)
     inputs = coerce_types(raw_inputs, session)
     outputs = [n.name for n in session.get_outputs()]
     try:
         logger.debug('Running neural network')
-        arr_out = session.run(outputs, inputs)
+        with metrics.timed('session_run'):
+            arr_out = session.run(outputs, inputs)
         logger.debug('Neural network inference complete')
     except onnxruntime.capi.onnxruntime_pybind11_state.InvalidArgument as e:
         raise errors.ModelRunError('Failed to run model', data=str(e))
@@ -0,0 +1,241 @@
+import concurrent.futures
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import threading
+from typing import *
+
+import numpy as np
+
+from citrine_daemon import config, errors, logs, package, server, storage
+from . import memo, nn
+
+
+logger = logging.getLogger(__name__)
+
+# Set in pool processes, so that call() runs the function right there instead of handing it off again
+in_worker = False
+
+process_workers = 1
+shared_min_bytes = 64 * 1024
+
+# Active packages with execution: process -- changes to any other package leave the pool alone
+process_packages = set()  # type: Set[str]
+
+_executor = None  # type: Optional[concurrent.futures.ProcessPoolExecutor]
+_executor_lock = threading.Lock()
+
+# In a pool process: extra data package code sets during the call it's running, sent back along with the outputs
+_call_extra = threading.local()
+
+
+class SharedTensor(object):
+    """
+    Stand-in for an ndarray that was copied into a shared memory segment. This is what actually gets pickled across
+    to the other process, so a big tensor costs one memcpy on each side instead of a trip through the pipe
+    """
+
+    def __init__(self, name: str, dtype: str, shape: Tuple[int, ...]):
+        self.name = name
+        self.dtype = dtype
+        self.shape = shape
+
+
+def init_process_pool(workers: Optional[int], min_shared_bytes: int):
+    global process_workers, shared_min_bytes
+    process_workers = workers or os.cpu_count() or 1
+    shared_min_bytes = min_shared_bytes
+    logger.info('Configuring inference process pool', {'workers': process_workers, 'min_shared_bytes': min_shared_bytes})
+
+
+def get_executor() -> concurrent.futures.ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            logger.info('Starting inference process pool', {'workers': process_workers})
+            _executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=process_workers,
+                # fork would copy the parent's threads' locks mid-use, and onnxruntime's thread pools with them
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(config.daemon_config, process_workers),
+            )
+        return _executor
+
+
+def start():
+    # Boot every process now, so the first requests don't wait for them to import and load packages
+    executor = get_executor()
+    pings = [executor.submit(_ping) for _ in range(process_workers)]
+    concurrent.futures.wait(pings)
+
+
+def package_changed(package_name: str, is_process: bool) -> bool:
+    """
+    Record a package's execution mode after a change, returns whether the pool has to restart for it, i.e. whether
+    it runs (or ran) in the pool
+    """
+    was_process = package_name in process_packages
+    if is_process:
+        process_packages.add(package_name)
+    else:
+        process_packages.discard(package_name)
+    return was_process or is_process
+
+
+def reset():
+    """
+    Called when packages change. Processes only load packages when they boot, so the old ones are retired (after
+    finishing whatever they're running) and a fresh pool comes up on the next call
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        logger.info('Retiring inference process pool')
+        executor.shutdown(wait=False)
+
+
+def _init_worker(daemon_config: Dict, n_workers: int):
+    global in_worker
+    in_worker = True
+    config.daemon_config = daemon_config
+    logs.init_logging()
+    budget = config.get_config('thread_budget') or os.cpu_count() or 1
+    nn.init_sessions(
+        max_bytes=config.get_config('session_cache.max_bytes'),
+        ttl=config.get_config('session_cache.ttl'),
+        thread_budget_total=max(1, budget // n_workers),
+        reserved_threads=1,
+        defaults=config.get_config('session_defaults'),
+    )
+    memo.init_result_cache(
+        enabled=config.get_config('result_cache.enabled'),
+        max_bytes=config.get_config('result_cache.max_bytes'),
+        ttl=config.get_config('result_cache.ttl'),
+    )
+    logger.info('Loading packages in inference process', {'pid': os.getpid()})
+    for db_package in package.db.DBPackage.get_active_packages():
+        package_meta = package.load.load_package_meta(storage.get_package_meta(db_package))
+        if package_meta['execution'] == 'process':
+            package.load.load_package(db_package)
+            package.load.warm_up_package(db_package)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _share(obj: Any, segments: List[shared_memory.SharedMemory]) -> Any:
+    if isinstance(obj, np.ndarray) and obj.dtype != object and obj.nbytes >= shared_min_bytes:
+        shm = shared_memory.SharedMemory(create=True, size=max(obj.nbytes, 1))
+        segments.append(shm)
+        np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)[...] = obj
+        return SharedTensor(shm.name, obj.dtype.str, obj.shape)
+    elif isinstance(obj, dict):
+        return {k: _share(v, segments) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [_share(v, segments) for v in obj]
+    elif isinstance(obj, tuple):
+        return tuple(_share(v, segments) for v in obj)
+    return obj
+
+
+def _unshare(obj: Any) -> Any:
+    # Takes ownership of the segments: the arrays are copied out and the segments unlinked
+    if isinstance(obj, SharedTensor):
+        shm = shared_memory.SharedMemory(name=obj.name)
+        try:
+            return np.ndarray(obj.shape, dtype=np.dtype(obj.dtype), buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+    elif isinstance(obj, dict):
+        return {k: _unshare(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [_unshare(v) for v in obj]
+    elif isinstance(obj, tuple):
+        return tuple(_unshare(v) for v in obj)
+    return obj
+
+
+def _release(segments: List[shared_memory.SharedMemory]):
+    for shm in segments:
+        shm.close()
+
+
+def put_extra(key: str, value: Any) -> bool:
+    """
+    Hold on to extra data for the job the current call belongs to (see job_put_extra)
+    :return: Whether there's a call running in this process to hold it for
+    """
+    extra = getattr(_call_extra, 'data', None)
+    if extra is None:
+        return False
+    extra[key] = value
+    return True
+
+
+def _run_in_worker(package_name: str, function_name: str, shared_inputs: Any) -> Tuple[Any, Dict[str, Any]]:
+    from .call import call
+    _call_extra.data = {}
+    try:
+        outputs = call(package_name, function_name, _unshare(shared_inputs))
+        extra = _call_extra.data
+    finally:
+        _call_extra.data = None
+    segments = []
+    shared_outputs = _share(outputs, segments)
+    # Closing only drops this process's mapping; the parent unlinks the segments once it has read them
+    _release(segments)
+    return shared_outputs, extra
+
+
+def _discard(fut: concurrent.futures.Future):
+    # The caller gave up on this job, but the worker may still have left output segments behind
+    if not fut.cancelled() and fut.exception() is None:
+        _unshare(fut.result()[0])
+
+
+def call(package_name: str, function_name: str, inputs: Any) -> Any:
+    segments = []
+    shared_inputs = _share(inputs, segments)
+    try:
+        fut = get_executor().submit(_run_in_worker, package_name, function_name, shared_inputs)
+    except concurrent.futures.BrokenExecutor:
+        # A worker died (segfault, OOM kill); start over with a new pool rather than failing every call from now on
+        reset()
+        fut = get_executor().submit(_run_in_worker, package_name, function_name, shared_inputs)
+
+    finished = False
+    try:
+        # Wait in short steps, so a JobInterrupted raised into this thread actually gets a chance to land
+        while True:
+            try:
+                res = fut.result(timeout=0.1)
+                finished = True
+                break
+            except concurrent.futures.TimeoutError:
+                continue
+    except concurrent.futures.BrokenExecutor as e:
+        reset()
+        raise errors.ModelRunError(f'Inference process for {package_name}/{function_name} died', data=str(e))
+    finally:
+        if not finished and not fut.done():
+            fut.cancel()
+            fut.add_done_callback(_discard)
+        # The worker unlinks the input segments when it reads them; if it never got to them, clean up here
+        for shm in segments:
+            shm.close()
+            if not finished:
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
+    shared_outputs, extra = res
+    outputs = _unshare(shared_outputs)
+    # Only arrives once the call is done, so progress updates come all at once
+    for key, value in extra.items():
+        server.parallel.job_put_extra(key, value)
+    return outputs
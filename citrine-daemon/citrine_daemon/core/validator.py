@@ -1,9 +1,13 @@
 import cerberus
 import json
+from typing import *
+
+import numpy as np
 
 from citrine_daemon.util import encode_tensor, decode_tensor
 
-tensor_type = cerberus.TypeDefinition('tensor', (dict,), ())
+# Tensors arrive as {dtype, data, shape} dicts from JSON requests, or as already-decoded arrays from binary ones
+tensor_type = cerberus.TypeDefinition('tensor', (dict, np.ndarray), ())
 
 np_dtypes = [
     'int8', 'int16', 'int32', 'int64', 
@@ -12,6 +16,8 @@ np_dtypes = [
     # dropping non-real-number types
 ]
 
+# Reference schema for a JSON tensor. check_tensor_dict enforces the same rules by hand, since building a cerberus
+# validator per tensor per request was the most expensive part of validating small inputs
 tensor_schema = {
     # discount tensorproto
     'dtype': {
@@ -30,6 +36,30 @@ tensor_schema = {
 }
 
 
+def check_tensor_dict(value: Dict) -> Dict[str, List[str]]:
+    errs = {}
+    for key in value.keys():
+        if key not in tensor_schema:
+            errs[key] = ['unknown field']
+    if 'dtype' not in value:
+        errs['dtype'] = ['required field']
+    elif not isinstance(value['dtype'], str):
+        errs['dtype'] = ['must be of string type']
+    elif value['dtype'] not in np_dtypes:
+        errs['dtype'] = [f'unallowed value {value["dtype"]}']
+    if 'data' not in value:
+        errs['data'] = ['required field']
+    elif not isinstance(value['data'], str):
+        errs['data'] = ['must be of string type']
+    if 'shape' not in value:
+        errs['shape'] = ['required field']
+    elif not isinstance(value['shape'], list):
+        errs['shape'] = ['must be of list type']
+    elif not all(isinstance(dim, int) for dim in value['shape']):
+        errs['shape'] = ['must be a list of integers']
+    return errs
+
+
 class CitrineValidator(cerberus.Validator):
     types_mapping = cerberus.Validator.types_mapping.copy()
     types_mapping['tensor'] = tensor_type
@@ -64,28 +94,38 @@ class CitrineValidator(cerberus.Validator):
         if value is None:
             return
 
-        value_validator = cerberus.Validator(schema=tensor_schema)
-        if not value_validator.validate(value):
-            return self._error(field, json.dumps(value_validator.errors, indent=4))
+        if isinstance(value, np.ndarray):
+            value_shape = list(value.shape)
+            value_dtype = str(value.dtype)
+        else:
+            value_errors = check_tensor_dict(value)
+            if value_errors:
+                return self._error(field, json.dumps(value_errors, indent=4))
+            value_shape = value['shape']
+            value_dtype = value['dtype']
         
         if schema['shape'] is not None:
-            if len(value['shape']) != len(schema['shape']):
+            if len(value_shape) != len(schema['shape']):
                 return self._error(
                     field, 
-                    f'{field} expects a rank {len(schema["shape"])} tensor, instead got rank {len(value["shape"])}'
+                    f'{field} expects a rank {len(schema["shape"])} tensor, instead got rank {len(value_shape)}'
                 )
-            for actual, expected in zip(value['shape'], schema['shape']):
+            for actual, expected in zip(value_shape, schema['shape']):
                 if expected is not None and actual != expected:
                     return self._error(
                         field, 
-                        f'{field} was expecting shape {schema["shape"]}, instead got shape {value["shape"]}'
+                        f'{field} was expecting shape {schema["shape"]}, instead got shape {value_shape}'
                     )
 
         if schema['dtype'] is not None:
-            if value['dtype'] != schema['dtype']:
+            if value_dtype != schema['dtype']:
                 expect_dtype = schema['dtype']
-                actual_dtype = value['dtype']
+                actual_dtype = value_dtype
                 return self._error(field, f'{field} should have dtype {expect_dtype} but instead got {actual_dtype}')
+
+        if isinstance(value, np.ndarray):
+            # Binary input, nothing left to decode
+            return
             
         ref = self.root_document
         for refpath in self.document_path:
@@ -16,6 +16,13 @@ class CitrineException(Exception):
         self.status_code = status_code
         self.data = data
         
+    def response_headers(self) -> Dict[str, str]:
+        return {}
+
+    def __reduce__(self):
+        # Keep status_code / data (and subclass fields) when the error is pickled back from an inference process
+        return _restore_exception, (self.__class__, self.args, self.__dict__)
+        
     def to_dict(self) -> Dict:
         res = {
             'error': self.name,
@@ -27,8 +34,40 @@ class CitrineException(Exception):
         return res
 
 
+def _restore_exception(cls, args, state):
+    exc = cls.__new__(cls)
+    exc.args = args
+    exc.__dict__.update(state)
+    return exc
+
+
 class JobInterrupted(CitrineException): name = 'Job Interrupted'
 
+
+class JobTimedOut(CitrineException):
+    name = 'Job Timed Out'
+    default_code = 504
+
+
+class JobEvicted(CitrineException):
+    # The job finished, but its result was dropped to keep finished jobs' results under job_cache.max_result_bytes
+    name = 'Job Evicted'
+    default_code = 410
+
+
+class ServerBusy(CitrineException):
+    name = 'Server Busy'
+    default_code = 503
+
+    def __init__(self, msg, retry_after: float, status_code=None, data=None):
+        super(ServerBusy, self).__init__(msg, status_code=status_code, data=data)
+        self.retry_after = retry_after
+
+    def response_headers(self) -> Dict[str, str]:
+        # Retry-After is whole seconds
+        return {'Retry-After': str(max(1, int(round(self.retry_after))))}
+
+
 class InternalError(CitrineException): name = 'Internal Error'
 class ModelRunError(InternalError): name = 'Model Run Error'
 
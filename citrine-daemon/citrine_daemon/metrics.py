@@ -0,0 +1,225 @@
+from contextlib import contextmanager
+import math
+import threading
+import time
+from typing import *
+
+from citrine_daemon import server
+
+
+# Seconds. Covers everything from a cached validate (well under a ms) to a slow model on a big input
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Add each job's phase breakdown to its extra_data, so it shows up in /async/get
+attach_timings = False
+
+# (method, package, function) -- package and function are blank for jobs that aren't function calls
+LABELS = Tuple[str, str, str]
+
+
+class Histogram(object):
+    def __init__(self, buckets: Tuple[float, ...] = default_buckets):
+        self.buckets = buckets
+        # One extra slot for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        idx = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                idx = i
+                break
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q: float) -> Optional[float]:
+        # Estimated by interpolating within the bucket the quantile falls in, same as Prometheus' histogram_quantile
+        counts, _, total = self.snapshot()
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        for idx, n in enumerate(counts):
+            if seen + n >= rank and n > 0:
+                if idx == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[idx - 1] if idx > 0 else 0.0
+                upper = self.buckets[idx]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+# Package/function label for calls that never resolved, so junk names from clients don't each get a histogram
+UNKNOWN = 'unknown'
+
+# (phase, labels) -> Histogram
+histograms = {}  # type: Dict[Tuple[str, LABELS], Histogram]
+histograms_lock = threading.Lock()
+
+# (pool, priority) -> Histogram of time spent waiting for a worker
+queue_waits = {}  # type: Dict[Tuple[str, str], Histogram]
+
+
+def init_metrics(attach: bool):
+    global attach_timings
+    attach_timings = attach
+
+
+def observe(phase: str, seconds: float, labels: LABELS = ('', '', '')):
+    key = (phase, labels)
+    hist = histograms.get(key)
+    if hist is None:
+        with histograms_lock:
+            hist = histograms.setdefault(key, Histogram())
+    hist.observe(seconds)
+
+
+def observe_queue_wait(pool: str, priority: str, seconds: float):
+    key = (pool, priority)
+    hist = queue_waits.get(key)
+    if hist is None:
+        with histograms_lock:
+            hist = queue_waits.setdefault(key, Histogram())
+    hist.observe(seconds)
+
+
+def record(phase: str, seconds: float):
+    """
+    Add time spent in a phase to the job running on this thread. It's only reported once the job is finished, when
+    it's known which function it called
+    """
+    job = server.parallel.get_active_job()
+    if job is None:
+        # Warmup, package loads at startup, inference processes...
+        observe(phase, seconds)
+        return
+    job.timings[phase] = job.timings.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase: str):
+    t_start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(phase, time.monotonic() - t_start)
+
+
+def label_job(package_name: str, function_name: str):
+    job = server.parallel.get_active_job()
+    if job is not None:
+        job.metric_labels = (job.metric_labels[0], package_name, function_name)
+
+
+def finish_job(job: 'server.parallel.AsyncFuture'):
+    job.timings['total'] = time.monotonic() - job.created_at
+    for phase, seconds in job.timings.items():
+        observe(phase, seconds, job.metric_labels)
+    if attach_timings:
+        job.extra_data['timings_ms'] = {phase: 1000 * seconds for phase, seconds in job.timings.items()}
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_str(pairs: List[Tuple[str, Any]]) -> str:
+    return '{' + ','.join(f'{k}="{_escape(str(v))}"' for k, v in pairs) + '}'
+
+
+def _fmt(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf'
+    return repr(float(value))
+
+
+def render_prometheus(gauges: Dict[str, Tuple[str, List[Tuple[Dict[str, str], float]]]]) -> str:
+    """
+    :param gauges: name -> (help text, [(labels, value)]) for point-in-time numbers like queue depth
+    """
+    with histograms_lock:
+        phase_items = sorted(histograms.items())
+        queue_items = sorted(queue_waits.items())
+    lines = [
+        '# HELP citrine_phase_seconds Time spent in each phase of a request',
+        '# TYPE citrine_phase_seconds histogram',
+    ]
+    for (phase, (method, package_name, function_name)), hist in phase_items:
+        base = [('phase', phase), ('method', method), ('package', package_name), ('function', function_name)]
+        lines.extend(_histogram_lines('citrine_phase_seconds', base, hist))
+    lines.append('# HELP citrine_queue_wait_seconds Time jobs spent waiting for a worker, by priority')
+    lines.append('# TYPE citrine_queue_wait_seconds histogram')
+    for (pool, priority), hist in queue_items:
+        lines.extend(_histogram_lines('citrine_queue_wait_seconds', [('pool', pool), ('priority', priority)], hist))
+
+    for name, (help_text, samples) in gauges.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in samples:
+            label_str = _label_str(sorted(labels.items())) if labels else ''
+            lines.append(f'{name}{label_str} {_fmt(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def _histogram_lines(name: str, base: List[Tuple[str, Any]], hist: Histogram) -> List[str]:
+    counts, total_sum, total_count = hist.snapshot()
+    lines = []
+    cumulative = 0
+    for bound, n in zip(list(hist.buckets) + [math.inf], counts):
+        cumulative += n
+        lines.append(f'{name}_bucket{_label_str(base + [("le", _fmt(bound))])} {cumulative}')
+    lines.append(f'{name}_sum{_label_str(base)} {_fmt(total_sum)}')
+    lines.append(f'{name}_count{_label_str(base)} {total_count}')
+    return lines
+
+
+def get_summary() -> List[Dict]:
+    with histograms_lock:
+        items = sorted(histograms.items())
+    res = []
+    for (phase, (method, package_name, function_name)), hist in items:
+        _, total_sum, total_count = hist.snapshot()
+        res.append({
+            'phase': phase,
+            'method': method,
+            'package': package_name,
+            'function': function_name,
+            'count': total_count,
+            'mean_ms': 1000 * total_sum / total_count if total_count else None,
+            'p50_ms': _ms(hist.quantile(0.5)),
+            'p95_ms': _ms(hist.quantile(0.95)),
+            'p99_ms': _ms(hist.quantile(0.99)),
+        })
+    return res
+
+
+def get_queue_wait_summary() -> List[Dict]:
+    with histograms_lock:
+        items = sorted(queue_waits.items())
+    res = []
+    for (pool, priority), hist in items:
+        _, total_sum, total_count = hist.snapshot()
+        res.append({
+            'pool': pool,
+            'priority': priority,
+            'count': total_count,
+            'mean_ms': 1000 * total_sum / total_count if total_count else None,
+            'p50_ms': _ms(hist.quantile(0.5)),
+            'p95_ms': _ms(hist.quantile(0.95)),
+            'p99_ms': _ms(hist.quantile(0.99)),
+        })
+    return res
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else 1000 * seconds
@@ -5,6 +5,7 @@ from typing import *
 import threading
 
 from citrine_daemon import errors, storage, core
+from citrine_daemon.config import get_config
 from citrine_daemon.package.orm import DBPackage, DBModel
 
 
@@ -19,30 +20,75 @@ def _db_path():
     return os.path.join(storage.root_path(), 'package.db')
 
 
-def start_connection():
-    connection_pool.conn = sqlite3.connect(_db_path())
-    
-    
-def end_connection(commit: bool):
-    conn = connection_pool.conn  # type: sqlite3.Connection
-    if commit:
-        logger.debug('Request completed successfully, will commit outstanding DB transactions')
-        conn.commit()
-    else:
-        logger.info('Request failed, rolling back database')
-        conn.rollback()
-    conn.close()
-    connection_pool.conn = None
-
-
-def get_conn():
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(_db_path(), timeout=get_config('database.busy_timeout'))
+    # WAL lets the many reader threads (every inference call looks up its package) run alongside a package write
+    # instead of blocking on it. NORMAL sync is safe under WAL: a power loss can drop the last commit, not corrupt
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute(f'PRAGMA cache_size=-{int(get_config("database.cache_size_kb"))}')
+    return conn
+
+
+def get_conn() -> sqlite3.Connection:
+    # Each thread keeps one long-lived connection; sqlite connections can't be shared across threads
     if getattr(connection_pool, 'conn', None) is None:
-        # TODO: I kinda only want this to work on the main thread
-        # worker threads should have something available via start_connection()
-        connection_pool.conn = sqlite3.connect(_db_path())
+        connection_pool.conn = _connect()
     return connection_pool.conn
 
 
+def begin_transaction():
+    # sqlite3 opens the transaction itself on the first write, this just makes sure the connection is there
+    get_conn()
+    connection_pool.after_transaction = []
+    connection_pool.after_commit = {}
+
+
+def after_transaction(fn: Callable[[], None]):
+    # Run fn once the current job's transaction has been committed or rolled back
+    if getattr(connection_pool, 'after_transaction', None) is None:
+        connection_pool.after_transaction = []
+    connection_pool.after_transaction.append(fn)
+
+
+def after_commit(key: Hashable, fn: Callable[[], None]):
+    # Run fn only if the current job's transaction commits, and only once per key however often it's registered
+    if getattr(connection_pool, 'after_commit', None) is None:
+        connection_pool.after_commit = {}
+    connection_pool.after_commit.setdefault(key, fn)
+
+
+def end_transaction(commit: bool):
+    conn = get_conn()
+    committed = False
+    try:
+        if commit:
+            logger.debug('Request completed successfully, will commit outstanding DB transactions')
+            conn.commit()
+            committed = True
+        else:
+            logger.info('Request failed, rolling back database')
+            conn.rollback()
+    finally:
+        hooks = getattr(connection_pool, 'after_transaction', None) or []
+        commit_hooks = getattr(connection_pool, 'after_commit', None) or {}
+        connection_pool.after_transaction = []
+        connection_pool.after_commit = {}
+        for fn in hooks:
+            fn()
+        if committed:
+            for fn in commit_hooks.values():
+                fn()
+
+
+def close_connection():
+    conn = getattr(connection_pool, 'conn', None)  # type: Optional[sqlite3.Connection]
+    if conn is not None:
+        conn.close()
+        connection_pool.conn = None
+
+
 class Cursor:
     def __init__(self, conn=None):
         if conn:
@@ -53,7 +99,7 @@ class Cursor:
         
     def __enter__(self):
         if self.conn is None:
-            self.conn = connection_pool.conn
+            self.conn = get_conn()
         self.cur = self.conn.cursor()
         return self.cur
     
@@ -108,6 +154,7 @@ def install_package(package_meta: Dict, install_id: str) -> DBPackage:
         )
         model.insert()
 
+    core.invalidate_package(db_package.name)
     return db_package
 
 
@@ -6,7 +6,7 @@ from typing import Optional, Dict
 import uuid
 import zipfile
 
-from citrine_daemon import errors, storage, core, package
+from citrine_daemon import errors, storage, core, package, config
 from citrine_daemon.package import repo
 
 
@@ -46,6 +46,8 @@ def install_package_file(localfile: str, activate: bool, exist_ok: bool = None)
 
         storage.package.install_from_temp(tmpdir, install_id, package_meta)
 
+    optimize_package(db_package)
+
     if activate:
         package.load.set_package_active(db_package, True)
 
@@ -62,6 +64,40 @@ def install_package_name(name: str, activate: bool, exist_ok: bool = None) -> Di
     return install_package_url(pkg_url, pkg_hash, activate, exist_ok=exist_ok)
 
 
+def optimize_package(db_package: 'package.DBPackage', force: bool = False):
+    """
+    Write a graph-optimized copy of each of the package's models. Failing to optimize isn't fatal: storage just keeps
+    handing out the original model file
+    """
+    if not config.get_config('optimization.enabled'):
+        return
+    level = config.get_config('optimization.level')
+    log_ctx = {'package_name': db_package.name, 'package_version': db_package.version, 'level': level}
+    for db_model in package.DBModel.all_from_package(db_package.rowid):
+        for stale_file in storage.get_stale_optimized_model_files(db_model):
+            logger.info(f'Removing stale optimized model {stale_file}', dict(log_ctx, model=db_model.name))
+            os.remove(stale_file)
+        target_file = storage.get_optimized_model_file(db_model, level)
+        if os.path.isfile(target_file) and not force:
+            continue
+        try:
+            core.nn.optimize_model(storage.get_model_file(db_model, optimized=False), target_file, level)
+        except errors.CitrineException as e:
+            logger.warning(f'Could not optimize model {db_model.name}', dict(log_ctx, error=e.to_dict()))
+
+
+def optimize_package_name(name: str, version: Optional[str]):
+    if version is not None:
+        db_package = package.DBPackage.from_name_version(name, version)
+    else:
+        db_package = package.DBPackage.from_name_latest(name)
+    optimize_package(db_package, force=True)
+    # Anything cached still points at the old model files
+    package.load.drop_package_sessions(db_package)
+    core.invalidate_package(db_package.name)
+    return {'status': 'OK'}
+
+
 def remove_package(name: str, version: Optional[str]):
     from citrine_daemon.package import DBPackage, DBModel
     
@@ -71,6 +107,8 @@ def remove_package(name: str, version: Optional[str]):
         db_package = DBPackage.from_name_latest(name)
 
     core.clear_functions(db_package.rowid)
+    core.invalidate_package(db_package.name)
+    package.load.drop_package_sessions(db_package)
     storage.package.remove(db_package.install_path)
 
     for model in DBModel.all_from_package(db_package.rowid):
@@ -3,16 +3,53 @@ import json
 import logging
 import os
 import threading
+import time
 from typing import Dict, Any, Optional
 
 import cerberus
+import numpy as np
 
-from citrine_daemon import storage, errors, package, core
+from citrine_daemon import storage, errors, package, core, config
 from citrine_daemon.package import db
 
 
 logger = logging.getLogger(__name__)
 
+session_options_schema = {
+    # onnxruntime SessionOptions for a model. Anything left out falls back to session_defaults in daemon.yaml
+    'intra_op_threads': {
+        'type': 'integer',
+        'min': 0,
+        'nullable': True,
+    },
+    'inter_op_threads': {
+        'type': 'integer',
+        'min': 0,
+        'nullable': True,
+    },
+    'execution_mode': {
+        'type': 'string',
+        'allowed': ['sequential', 'parallel'],
+        'nullable': True,
+    },
+    'enable_cpu_mem_arena': {
+        'type': 'boolean',
+        'nullable': True,
+    },
+    'enable_mem_pattern': {
+        'type': 'boolean',
+        'nullable': True,
+    },
+    'cpu_affinity': {
+        'type': 'list',
+        'schema': {
+            'type': 'integer',
+            'min': 0,
+        },
+        'nullable': True,
+    },
+}
+
 package_validator = {
     'name': {
         'type': 'string',
@@ -40,6 +77,16 @@ package_validator = {
                     'type': 'string',
                     'required': True,
                 },
+                'sample': {
+                    # .npz of model inputs to warm the session up with, instead of synthetic zeros
+                    'type': 'string',
+                    'required': False,
+                },
+                'session': {
+                    'type': 'dict',
+                    'required': False,
+                    'schema': session_options_schema,
+                },
             },
         },
     },
@@ -51,10 +98,42 @@ package_validator = {
         'type': 'string',
         'required': False,
     },
+    'deterministic': {
+        # Set to true if the package's functions always give the same output for the same input. Only then are their
+        # results cached, and identical concurrent requests shared
+        'type': 'boolean',
+        'required': False,
+        'default': False,
+    },
+    'execution': {
+        # 'process' runs the package's functions in the inference process pool instead of the daemon's threads, for
+        # packages whose pre/post-processing is heavy enough in pure python to be held back by the GIL
+        'type': 'string',
+        'allowed': ['thread', 'process'],
+        'required': False,
+        'default': 'thread',
+    },
+    'batching': {
+        # Opt-in: merge concurrent calls to the same model into a single batched run
+        'type': 'dict',
+        'required': False,
+        'schema': {
+            'window_ms': {
+                'type': 'number',
+                'min': 0,
+                'default': 5,
+            },
+            'max_batch_size': {
+                'type': 'integer',
+                'min': 1,
+                'default': 8,
+            },
+        },
+    },
 }
 
 
-load_context = {'package': None}  # type: Dict[str, Optional[Any]]
+load_context = {'package': None, 'meta': None}  # type: Dict[str, Optional[Any]]
 load_context_lock = threading.Lock()
 
 
@@ -75,13 +154,33 @@ def get_loading_package() -> Optional[db.DBPackage]:
     return load_context['package']
 
 
+def get_loading_meta() -> Optional[Dict]:
+    if not load_context_lock.locked():
+        return None
+    return load_context['meta']
+
+
 def init_packages():
     logger.info('Loading existing packages on startup')
     package.db.get_conn()
-    for db_package in db.DBPackage.get_active_packages():
+    active_packages = list(db.DBPackage.get_active_packages())
+    for db_package in active_packages:
+        # Only does work for models missing an optimized copy, e.g. after an onnxruntime upgrade
+        package.install.optimize_package(db_package)
         load_package(db_package)
+    for db_package in active_packages:
+        core.functions.index_package(db_package.name)
+    for db_package in active_packages:
+        warm_up_package(db_package)
+    core.procpool.process_packages.update(p.name for p in active_packages if is_process_package(p))
+    if core.procpool.process_packages:
+        core.procpool.start()
         
         
+def is_process_package(db_package: db.DBPackage) -> bool:
+    return load_package_meta(storage.get_package_meta(db_package))['execution'] == 'process'
+
+
 def activate_package(name: str, version: Optional[str]):
     logger.info(f'Setting package {name}v{version} to active', {'package_name': name, 'package_version': version})
     # TODO enforce only one active
@@ -102,35 +201,113 @@ def deactivate_package(name: str, version: Optional[str]):
         db_package = db.DBPackage.from_name_latest(name)
     set_package_active(db_package, False)
     core.clear_functions(db_package.rowid)
+    core.invalidate_package(db_package.name)
+    drop_package_sessions(db_package)
     return {'status': 'OK'}
 
 
+def drop_package_sessions(db_package: db.DBPackage):
+    model_files = []
+    for db_model in db.DBModel.all_from_package(db_package.rowid):
+        # Sessions may have been opened from either copy of the model
+        model_files.append(storage.get_model_file(db_model, optimized=False))
+        model_files.append(storage.get_optimized_model_file(db_model))
+    core.nn.drop_sessions(model_files)
+    core.batch.drop_batchers(model_files)
+
+
 def set_package_active(db_package: db.DBPackage, active: bool):
     if db_package.rowid is None:
         raise errors.InternalError('Tried to activate a package not in the database', data=db_package.to_dict())
     load_package(db_package)
+    if active:
+        # Only report the package as ready once its sessions are hot
+        warm_up_package(db_package)
 
     db_package.active = active
     db_package.update()
+    core.invalidate_package(db_package.name)
+
+
+def warm_up_package(db_package: db.DBPackage):
+    if not config.get_config('warmup'):
+        return
+    log_ctx = {'package_name': db_package.name, 'package_version': db_package.version}
+    package_meta = load_package_meta(storage.get_package_meta(db_package))
+    if package_meta['execution'] == 'process' and not core.procpool.in_worker:
+        # Its sessions live in the inference processes, which warm it up themselves when they boot
+        return
+    logger.info('Warming up package models', log_ctx)
+    package_dir = os.path.join(storage.package_path(), db_package.install_path)
+
+    t_start = time.monotonic()
+    for db_model in db.DBModel.all_from_package(db_package.rowid):
+        try:
+            sample_inputs = load_model_sample(package_dir, package_meta, db_model)
+            core.nn.warm_up(storage.get_model_file(db_model), sample_inputs)
+        except Exception as e:
+            # A model that can't be warmed up (say, a dynamic shape that 1 isn't valid for) still works; it just pays
+            # for its first run on the first real request
+            logger.warning(f'Could not warm up model {db_model.name}', dict(log_ctx, model=db_model.name, error=str(e)))
+    logger.info('Package warm-up complete', dict(log_ctx, warmup_time=time.monotonic() - t_start))
+
+
+def load_model_sample(package_dir: str, package_meta: Dict, db_model: db.DBModel) -> Optional[Dict[str, np.ndarray]]:
+    model_spec = package_meta['model'].get(db_model.name, {})
+    if not model_spec.get('sample'):
+        return None
+    with np.load(os.path.join(package_dir, model_spec['sample'])) as sample_f:
+        return {k: sample_f[k] for k in sample_f.files}
+
+
+def profile_model(name: str, model_name: str, version: Optional[str], runs: int) -> Dict:
+    if version is not None:
+        db_package = db.DBPackage.from_name_version(name, version)
+    else:
+        db_package = db.DBPackage.from_name_latest(name)
+    db_model = db.DBModel.from_id_name(db_package.rowid, model_name)
+    package_meta = load_package_meta(storage.get_package_meta(db_package))
+    package_dir = os.path.join(storage.package_path(), db_package.install_path)
+    sample_inputs = load_model_sample(package_dir, package_meta, db_model)
+    trace_file = core.nn.profile_model(storage.get_model_file(db_model), sample_inputs, runs)
+    # Open in chrome://tracing or perfetto
+    return {'trace': {'file_ref': trace_file}, 'runs': runs}
 
 
 class PackageContext(object):
-    def __init__(self, pkg: db.DBPackage):
+    def __init__(self, pkg: db.DBPackage, meta: Dict):
         self.package = pkg
+        self.meta = meta
 
     def __enter__(self):
         load_context_lock.acquire()
         load_context['package'] = self.package
+        load_context['meta'] = self.meta
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         load_context['package'] = None
+        load_context['meta'] = None
         load_context_lock.release()
 
 
+def configure_package_sessions(db_package: db.DBPackage, package_meta: Dict):
+    if package_meta['execution'] == 'process' and not core.procpool.in_worker:
+        # Never opens a session in the daemon itself, so it shouldn't take a share of the daemon's thread budget
+        return
+    for db_model in db.DBModel.all_from_package(db_package.rowid):
+        model_spec = package_meta['model'].get(db_model.name, {})
+        core.nn.configure_model([
+            storage.get_model_file(db_model, optimized=False),
+            storage.get_optimized_model_file(db_model),
+        ], model_spec.get('session'))
+
+
 def load_package(db_package: db.DBPackage):
     log_ctx = {'package_name': db_package.name, 'package_version': db_package.version}
     logger.info('Beginning to load package module', log_ctx)
     module_file = storage.get_package_module(db_package)
+    package_meta = load_package_meta(storage.get_package_meta(db_package))
+    configure_package_sessions(db_package, package_meta)
 
     # I dunno where this actually shows up, but it's not a problem yet. Maybe multiple imports?
     useless_module_name = 'userpackage'
@@ -141,7 +318,7 @@ def load_package(db_package: db.DBPackage):
     exec_dir = os.path.join(storage.package_path(), db_package.install_path)
     try:
         os.chdir(exec_dir)
-        with PackageContext(db_package):
+        with PackageContext(db_package, package_meta):
             logger.info('BEGIN loading module', log_ctx)
             spec.loader.exec_module(mod)
             logger.info('END loading module', log_ctx)
@@ -0,0 +1,59 @@
+from contextlib import contextmanager
+import cProfile
+import logging
+import os
+import pstats
+import random
+from typing import *
+
+from citrine_daemon import server, storage
+
+
+logger = logging.getLogger(__name__)
+
+# Fraction of jobs profiled even when nobody asked for it
+sample_rate = 0.0
+
+
+def init_profiling(rate: float):
+    global sample_rate
+    logger.info('Configuring job profiling', {'sample_rate': rate})
+    sample_rate = rate
+
+
+def should_profile(requested: bool) -> bool:
+    return requested or (sample_rate > 0 and random.random() < sample_rate)
+
+
+@contextmanager
+def profiled(job: 'server.parallel.AsyncFuture'):
+    # Pipelined jobs run a piece at a time on different threads; each piece gets its own profile, merged at the end
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Only one profiler can be active at a time on some pythons
+        logger.warning('Could not start profiler', {'error': str(e)})
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        job.profiles.append(profiler)
+
+
+def finish_job(job: 'server.parallel.AsyncFuture'):
+    if not job.profiles:
+        return
+    fname = f'profile-{job.uid}.prof'
+    try:
+        stats = pstats.Stats(*job.profiles)
+        stats.dump_stats(os.path.join(storage.results_path(), fname))
+    except Exception as e:
+        logger.warning('Failed to save job profile', {'error': str(e)})
+        return
+    job.profiles = []
+    # Fetch with /result/{file_ref}, and open with pstats / snakeviz
+    job.extra_data['profile'] = {'file_ref': fname}
+    logger.info('Saved job profile', {'file_ref': fname})
@@ -1,12 +1,24 @@
 import json
 import logging
+import math
+import time
 from typing import *
 
 from aiohttp import web
 
-from citrine_daemon import errors
-from citrine_daemon.server.json import CitrineEncoder
-from citrine_daemon.server.parallel import AsyncFuture
+from citrine_daemon import errors, metrics
+from citrine_daemon.server import parallel
+from citrine_daemon.server.json import CitrineEncoder, dumps_binary
+from citrine_daemon.server.parallel import (
+    AsyncFuture,
+    default_pool,
+    profile_requested,
+    request_client,
+    request_deadline,
+    request_priority,
+    submit_pool,
+)
+from citrine_daemon.util import binary_content_type
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +32,7 @@ def error_handler(f):
             return web.Response(
                 body=json.dumps(e.to_dict()),
                 status=e.status_code,
+                headers=e.response_headers(),
             )
         except Exception as e:
             logger.error('Request failed with unexpected error', errors.serialize_unknown_exception(e))
@@ -27,13 +40,90 @@ def error_handler(f):
     return wrapped
 
 
+def accepts_binary(request: web.Request) -> bool:
+    return binary_content_type in request.headers.get('Accept', '')
+
+
+def encode_response(request: web.Request, obj: Any, job: Optional[AsyncFuture] = None) -> web.Response:
+    """
+    Respond in the binary tensor format if the client asked for it, JSON otherwise
+    :param job: The job obj came from, if any, to file the encoding time under
+    """
+    t_start = time.monotonic()
+    binary = accepts_binary(request)
+    body = encode_body(obj, binary)
+    if job is not None:
+        metrics.observe('encode', time.monotonic() - t_start, job.metric_labels)
+    return body_response(body, binary)
+
+
+def encode_body(obj: Any, binary: bool) -> bytes:
+    if binary:
+        return bytes(dumps_binary(obj))
+    return json.dumps(obj, cls=CitrineEncoder).encode('utf-8')
+
+
+def body_response(body: bytes, binary: bool, headers: Optional[Dict[str, str]] = None) -> web.Response:
+    if binary:
+        return web.Response(body=body, status=200, content_type=binary_content_type, headers=headers)
+    return web.Response(body=body, status=200, headers=headers)
+
+
+def job_etag(fut: AsyncFuture, binary: bool) -> str:
+    return f'"{fut.uid}-{fut.version}{"-b" if binary else ""}"'
+
+
+def etag_matches(request: web.Request, etag: str) -> bool:
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    # Weak or strong, a match is a match for a GET
+    return etag in {tag.strip().replace('W/', '', 1) for tag in header.split(',')}
+
+
+def encode_job_status(request: web.Request, fut: AsyncFuture) -> web.Response:
+    """
+    The job's status document, answering polls that already have the latest version with a 304. Once the job is
+    finished the encoded body is kept, so however many more times it's polled it's only encoded once
+    """
+    binary = accepts_binary(request)
+    # Read before encoding: if the job moves on in the meantime, the tag is older than the body, and the next poll
+    # just gets the new version again
+    finished = fut.finished
+    etag = job_etag(fut, binary)
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers={'ETag': etag})
+    body = fut.encoded.get(binary)
+    if body is None:
+        body = encode_body(fut, binary)
+        if finished:
+            parallel.keep_encoded(fut, fut.encoded, binary, body)
+    return body_response(body, binary, headers={'ETag': etag})
+
+
+def encode_job_result(request: web.Request, fut: AsyncFuture, result: Any) -> web.Response:
+    """
+    The synchronous endpoints' reply. Requests coalesced into one job all get the same bytes, so it's encoded once
+    for all of them; nobody else will ask for a job's bare result again, so otherwise it isn't kept
+    """
+    binary = accepts_binary(request)
+    body = fut.encoded_results.get(binary)
+    if body is not None:
+        return body_response(body, binary)
+    t_start = time.monotonic()
+    body = encode_body(result, binary)
+    metrics.observe('encode', time.monotonic() - t_start, fut.metric_labels)
+    if isinstance(fut, parallel.SharedJobHandle):
+        parallel.keep_encoded(fut, fut.encoded_results, binary, body)
+    return body_response(body, binary)
+
+
 def wrap_async(fn: Callable[[web.Request], Awaitable[AsyncFuture]]):
     async def wrapped(request: web.Request) -> web.Response:
         fut = await fn(request)
-        return web.Response(
-            body=json.dumps(fut, cls=CitrineEncoder),
-            status=200
-        )
+        return encode_job_status(request, fut)
     return wrapped
 
 
@@ -43,10 +133,90 @@ def wrap_sync(fn: Callable[[web.Request], Awaitable[AsyncFuture]]):
         result = await fut.result()
         if result is None:
             result = {'status': 'OK'}
-        return web.Response(
-            body=json.dumps(result, cls=CitrineEncoder),
-            status=200,
+        return encode_job_result(request, fut, result)
+    return wrapped
+
+
+def with_pool(fn: Callable[[web.Request], Awaitable], pool: str):
+    async def wrapped(request: web.Request):
+        token = submit_pool.set(pool)
+        try:
+            return await fn(request)
+        finally:
+            submit_pool.reset(token)
+    return wrapped
+
+
+def wants_profile(request: web.Request) -> bool:
+    flag = request.headers.get('X-Citrine-Profile') or request.query.get('profile') or ''
+    return flag.lower() in {'1', 'true', 'yes'}
+
+
+def with_profiling(fn: Callable[[web.Request], Awaitable]):
+    async def wrapped(request: web.Request):
+        token = profile_requested.set(wants_profile(request))
+        try:
+            return await fn(request)
+        finally:
+            profile_requested.reset(token)
+    return wrapped
+
+
+def get_deadline(request: web.Request, sync: bool) -> Optional[float]:
+    """
+    Seconds the request is willing to wait, from the X-Citrine-Deadline header or ?timeout=. Synchronous requests
+    fall back to the configured default, since the client will hang up at some point; async ones wait as long as it
+    takes unless they say otherwise
+    :return: The time.monotonic() by which the job has to have started
+    """
+    value = request.headers.get('X-Citrine-Deadline') or request.query.get('timeout')
+    if not value:
+        # 0 (or less) in the config means no default deadline
+        timeout = (parallel.sync_deadline or None) if sync else None
+    else:
+        try:
+            timeout = float(value)
+        except ValueError:
+            raise errors.InvalidInput('Deadline must be a number of seconds', data={'deadline': value})
+        if not math.isfinite(timeout):
+            raise errors.InvalidInput('Deadline must be a finite number of seconds', data={'deadline': value})
+        if timeout <= 0:
+            raise errors.InvalidInput('Deadline must be positive', data={'deadline': value})
+    if timeout is None:
+        return None
+    return time.monotonic() + timeout
+
+
+def with_deadline(fn: Callable[[web.Request], Awaitable], sync: bool):
+    async def wrapped(request: web.Request):
+        token = request_deadline.set(get_deadline(request, sync))
+        try:
+            return await fn(request)
+        finally:
+            request_deadline.reset(token)
+    return wrapped
+
+
+def get_priority(request: web.Request, default: str) -> str:
+    priority = request.headers.get('X-Citrine-Priority') or request.query.get('priority') or default
+    if priority not in parallel.priorities:
+        raise errors.InvalidInput(
+            f'Unknown priority {priority}',
+            data={'priority': priority, 'priorities': parallel.priorities},
         )
+    return priority
+
+
+def with_priority(fn: Callable[[web.Request], Awaitable], default: str):
+    async def wrapped(request: web.Request):
+        priority_token = request_priority.set(get_priority(request, default))
+        # Clients take turns within a priority; one that doesn't say who it is goes by its address
+        client_token = request_client.set(request.headers.get('X-Citrine-Client') or request.remote or '')
+        try:
+            return await fn(request)
+        finally:
+            request_client.reset(client_token)
+            request_priority.reset(priority_token)
     return wrapped
 
 
@@ -81,11 +251,28 @@ class AioServer:
         for sub_prefix, submodule in self.submodules:
             submodule.bind(app, prefix=f'{prefix}{sub_prefix}')
             
-    def route(self, method, path: str, fn, async_: bool = False, handle_errors: bool = True):
+    def route(
+            self,
+            method,
+            path: str,
+            fn,
+            async_: bool = False,
+            handle_errors: bool = True,
+            pool: str = default_pool,
+            priority: Optional[str] = None,
+    ):
+        """
+        :param pool: Which worker pool jobs started by this handler (via run_async) should be queued on
+        :param priority: Default priority of those jobs. If not given, someone's waiting on the synchronous version
+            so it's interactive, and the /async version is normal
+        """
         assert method in [web.head, web.options, web.get, web.post, web.put, web.patch, web.delete, web.view]
         maybe_err_handler = error_handler if handle_errors else lambda x: x
+        fn = with_profiling(with_pool(fn, pool))
         if async_:
-            self.routes.append((method, path, maybe_err_handler(wrap_sync(fn))))
-            self.async_routes.append((method, path, maybe_err_handler(wrap_async(fn))))
+            sync_fn = with_priority(with_deadline(fn, sync=True), priority or 'interactive')
+            async_fn = with_priority(with_deadline(fn, sync=False), priority or 'normal')
+            self.routes.append((method, path, maybe_err_handler(wrap_sync(sync_fn))))
+            self.async_routes.append((method, path, maybe_err_handler(wrap_async(async_fn))))
         else:
             self.routes.append((method, path, maybe_err_handler(fn)))
@@ -1,19 +1,26 @@
+import asyncio
 import json
 import logging
 import os
+from typing import *
 
 import aiofiles
 from aiohttp import web
+import cerberus
 
-from citrine_daemon import storage
-from citrine_daemon.server.parallel import get_future
+from citrine_daemon import core, metrics, storage
+from citrine_daemon.server.parallel import FutureState, get_future, get_many, get_queue_stats
 from citrine_daemon.server.json import CitrineEncoder
 
-from .aio_server import AioServer
+from .aio_server import AioServer, encode_job_status, encode_response
+from .util import expect_json
 
 
 logger = logging.getLogger(__name__)
 
+# Seconds between comments on an otherwise quiet /async/stream, so proxies and clients can tell it's still alive
+stream_keepalive = 15
+
 
 def get_base_server():
     server = AioServer()
@@ -21,7 +28,13 @@ def get_base_server():
     server.route(web.get, '/', heartbeat, handle_errors=False)
     server.route(web.get, '/result/{name}', get_result, handle_errors=False)
     server.route(web.get, '/async/get/{uid}', async_status)
+    server.route(web.post, '/async/get_many', async_status_many)
     server.route(web.get, '/async/cancel/{uid}', async_cancel)
+    server.route(web.get, '/async/stream/{uid}', async_stream)
+    server.route(web.get, '/queue', queue_status)
+    server.route(web.get, '/cache', cache_status)
+    server.route(web.get, '/metrics', metrics_prometheus)
+    server.route(web.get, '/metrics/json', metrics_json)
     
     return server
 
@@ -48,10 +61,74 @@ async def get_result(request: web.Request) -> web.Response:
 async def async_status(request: web.Request) -> web.Response:
     logger.debug('Handling request for method async.status')
     fut = get_future(request.match_info['uid'])
-    return web.Response(
-        body=json.dumps(fut, cls=CitrineEncoder),
-        status=200
-    )
+    return encode_job_status(request, fut)
+
+
+async def async_status_many(request: web.Request) -> web.Response:
+    """
+    Status of many jobs in one go. Pass the version from the last response as "since" to only hear about the ones
+    that have changed; uids that have expired (or never existed) come back under "missing", and ones whose results
+    were dropped early to save memory under "evicted"
+    """
+    logger.debug('Handling request for method async.get_many')
+    validator = cerberus.Validator(schema={
+        'uids': {
+            'type': 'list',
+            'schema': {'type': 'string'},
+            'maxlength': 100000,
+            'required': True,
+        },
+        'since': {
+            'type': 'integer',
+            'nullable': True,
+            'default': None,
+        },
+        'results': {
+            'type': 'boolean',
+            'default': False,
+        },
+    })
+    params = await expect_json(request, validator)
+    return encode_response(request, get_many(params['uids'], since=params['since'], results=params['results']))
+
+
+async def async_stream(request: web.Request) -> web.StreamResponse:
+    """
+    Server-sent events: the job's status (same as /async/get) every time it changes, ending with the finished job
+    """
+    logger.debug('Handling request for method async.stream')
+    fut = get_future(request.match_info['uid'])
+    resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await resp.prepare(request)
+    changed = fut.watch()
+    try:
+        sent_version = None
+        while True:
+            changed.clear()
+            # Check after clearing, so a change from here on sets it again
+            finished = fut.finished
+            version = fut.version
+            # A job that's just stopped still gets its timings etc. added; the client stops listening once it sees
+            # it's stopped, so hold off until it's finished
+            settled = finished or fut.state in {FutureState.INITIALIZED, FutureState.RUNNING}
+            if version != sent_version and settled:
+                data = json.dumps(fut, cls=CitrineEncoder)
+                await resp.write(f'id: {version}\nevent: status\ndata: {data}\n\n'.encode('utf-8'))
+                sent_version = version
+            if finished:
+                break
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=stream_keepalive)
+            except asyncio.TimeoutError:
+                await resp.write(b': keepalive\n\n')
+    except ConnectionResetError:
+        # Client went away. The job carries on; it's /async/cancel that stops it
+        logger.debug('Stream closed by client', {'async_job_id': fut.uid})
+        return resp
+    finally:
+        fut.unwatch(changed)
+    await resp.write_eof()
+    return resp
 
 
 async def async_cancel(request: web.Request) -> web.Response:
@@ -62,3 +139,56 @@ async def async_cancel(request: web.Request) -> web.Response:
         body=json.dumps(fut, cls=CitrineEncoder),
         status=200
     )
+
+
+async def queue_status(request: web.Request) -> web.Response:
+    logger.debug('Handling request for method queue')
+    return web.Response(body=json.dumps(get_queue_stats()), status=200)
+
+
+async def cache_status(request: web.Request) -> web.Response:
+    logger.debug('Handling request for method cache')
+    return web.Response(body=json.dumps({
+        'sessions': core.nn.session_cache.stats(),
+        'threads': core.nn.thread_budget.stats(),
+        'results': core.memo.get_stats(),
+    }), status=200)
+
+
+def current_gauges() -> Dict:
+    queue_stats = get_queue_stats()['pools']
+    session_stats = core.nn.session_cache.stats()
+    result_stats = core.memo.result_cache.stats()
+    pool_gauge = lambda field: [({'pool': name}, stats[field]) for name, stats in queue_stats.items()]
+    return {
+        'citrine_queue_depth': ('Jobs waiting in each worker pool', pool_gauge('depth')),
+        'citrine_queue_rejected': ('Jobs turned away because the pool was full', pool_gauge('rejected')),
+        'citrine_queue_timed_out': ('Jobs dropped because their deadline passed in the queue', pool_gauge('timed_out')),
+        'citrine_queue_cancelled': ('Jobs cancelled while waiting in the queue', pool_gauge('cancelled')),
+        'citrine_session_cache_entries': ('Cached ONNX sessions', [({}, session_stats['entries'])]),
+        'citrine_session_cache_bytes': ('Approximate size of cached ONNX sessions', [({}, session_stats['weight'])]),
+        'citrine_session_cache_misses': ('Session cache misses (session loads)', [({}, session_stats['misses'])]),
+        'citrine_result_cache_entries': ('Cached function results', [({}, result_stats['entries'])]),
+        'citrine_result_cache_hits': ('Result cache hits', [({}, result_stats['hits'])]),
+        'citrine_result_cache_misses': ('Result cache misses', [({}, result_stats['misses'])]),
+    }
+
+
+async def metrics_prometheus(request: web.Request) -> web.Response:
+    logger.debug('Handling request for method metrics')
+    return web.Response(
+        text=metrics.render_prometheus(current_gauges()),
+        content_type='text/plain',
+    )
+
+
+async def metrics_json(request: web.Request) -> web.Response:
+    logger.debug('Handling request for method metrics.json')
+    return web.Response(body=json.dumps({
+        'phases': metrics.get_summary(),
+        'queue_wait': metrics.get_queue_wait_summary(),
+        'gauges': {
+            name: [dict(labels, value=value) for labels, value in samples]
+            for name, (_, samples) in current_gauges().items()
+        },
+    }), status=200)
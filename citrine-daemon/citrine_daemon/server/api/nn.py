@@ -1,14 +1,28 @@
+import hashlib
 import json
 import logging
+from typing import *
 
 from aiohttp import web
+import cerberus
 import numpy as np
 
-from citrine_daemon import core, errors
-from citrine_daemon.server.parallel import AsyncFuture, run_async
+from citrine_daemon import config, core, errors, package
+from citrine_daemon.core.call import (
+    BATCH_ITEM,
+    PreparedCall,
+    finish,
+    finish_batch,
+    infer,
+    infer_batch,
+    prepare,
+    prepare_batch,
+)
+from citrine_daemon.server.parallel import AsyncFuture, NextStage, run_async
+from citrine_daemon.util import binary_content_type, unpack_binary
 
-from .aio_server import AioServer
-from .util import make_request_info
+from .aio_server import AioServer, wants_profile
+from .util import expect_json, make_request_info
 
 
 logger = logging.getLogger(__name__)
@@ -17,33 +31,139 @@ logger = logging.getLogger(__name__)
 def get_nn_server():
     server = AioServer()
     
-    server.route(web.post, '/run/{package_name}/{function_name}', run_network, async_=True)
-    server.route(web.post, '/_run/{package_name}/{model_name}', run_network_raw, async_=True)
+    server.route(web.post, '/run/{package_name}/{function_name}', run_network, async_=True, pool='inference')
+    server.route(web.post, '/_run/{package_name}/{model_name}', run_network_raw, async_=True, pool='inference')
+    server.route(
+        web.post,
+        '/run_batch/{package_name}/{function_name}',
+        run_network_batch,
+        async_=True,
+        pool='inference',
+        priority='batch',
+    )
+    server.route(
+        web.post,
+        '/profile/{package_name}/{model_name}',
+        profile_model,
+        async_=True,
+        pool='inference',
+        priority='batch',
+    )
     
     return server
 
 
+async def read_input(request: web.Request) -> Dict:
+    if not request.body_exists:
+        return {}
+    if request.content_type == binary_content_type:
+        return unpack_binary(await request.read())
+    try:
+        return await request.json()
+    except json.decoder.JSONDecodeError as e:
+        raise errors.InvalidInput(f'Input should be JSON or {binary_content_type}')
+
+
+async def coalesce_key(request: web.Request, endpoint: str, package_name: str, target: str) -> Optional[str]:
+    """
+    Identical requests that arrive while one is still in flight share its job. Anything that could make two
+    identical-looking requests come out differently (profiling, a function that isn't deterministic) opts out
+    """
+    if not config.get_config('coalescing.enabled') or wants_profile(request):
+        return None
+    if endpoint == 'run' and not core.functions.is_deterministic(package_name, target):
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    for part in (endpoint, package_name, target, request.content_type):
+        data = part.encode('utf-8')
+        h.update(len(data).to_bytes(8, 'little') + data)
+    # aiohttp keeps the body around after read_input, so this doesn't read it twice
+    h.update(await request.read())
+    return h.hexdigest()
+
+
+def call_pre(package_name: str, function_name: str, inputs: Dict):
+    prepared = prepare(package_name, function_name, inputs)
+    if prepared.finished:
+        return prepared.outputs
+    return NextStage('infer', call_infer, (prepared,))
+
+
+def call_infer(prepared: PreparedCall):
+    infer(prepared)
+    return NextStage('post', finish, (prepared,))
+
+
 async def run_network(request: web.Request) -> AsyncFuture:
     logger.debug('Handling request for method run')
-    if not request.body_exists:
-        jsn = {}
-    else:
-        try:
-            jsn = await request.json()
-        except json.decoder.JSONDecodeError as e:
-            # TODO: support protobuf input
-            raise errors.InvalidInput('Input should be JSON')
+    jsn = await read_input(request)
 
     # TODO run_network multipart inputs
     # I'll probably want to handle the case where the user uploads an image at some point, which means exposing that to
     # the intermediate loader at some point.
     # Already have a method for reading multipart, just need to decide on a function signature
 
-    return run_async(core.call, kwargs={
+    call_kwargs = {
         'package_name': request.match_info['package_name'],
         'function_name': request.match_info['function_name'],
         'inputs': jsn,
-    }, request_info=make_request_info('run'))
+    }
+    key = await coalesce_key(request, 'run', call_kwargs['package_name'], call_kwargs['function_name'])
+    if config.get_config('pipeline.enabled'):
+        # Input processing, model run and output processing each get their own pool, so they overlap across requests
+        return run_async(
+            call_pre,
+            kwargs=call_kwargs,
+            request_info=make_request_info('run'),
+            pool='pre',
+            coalesce_key=key,
+        )
+    return run_async(core.call, kwargs=call_kwargs, request_info=make_request_info('run'), coalesce_key=key)
+
+
+def call_batch_pre(package_name: str, function_name: str, inputs: List[Dict]):
+    return NextStage('infer', call_batch_infer, (prepare_batch(package_name, function_name, inputs),))
+
+
+def call_batch_infer(items: List[BATCH_ITEM]):
+    return NextStage('post', call_batch_post, (infer_batch(items),))
+
+
+def call_batch_post(items: List[BATCH_ITEM]) -> Dict:
+    return {'results': finish_batch(items)}
+
+
+def call_batch(package_name: str, function_name: str, inputs: List[Dict]) -> Dict:
+    return {'results': core.call_batch(package_name, function_name, inputs)}
+
+
+async def run_network_batch(request: web.Request) -> AsyncFuture:
+    """
+    run for each of a list of inputs, {"inputs": [...]}, with the model runs batched together where their shapes
+    allow. Each input gets back {"result": ...} or {"error": ...} in the same place in "results"
+    """
+    logger.debug('Handling request for method run_batch')
+    jsn = await read_input(request)
+    max_items = config.get_config('run_batch.max_items')
+    validator = cerberus.Validator(schema={
+        'inputs': {
+            'type': 'list',
+            'schema': {'type': 'dict'},
+            'maxlength': max_items,
+            'required': True,
+        },
+    })
+    if not isinstance(jsn, dict) or not validator.validate(jsn):
+        raise errors.ValidationError('Input failed to validate', data=validator.errors)
+
+    call_kwargs = {
+        'package_name': request.match_info['package_name'],
+        'function_name': request.match_info['function_name'],
+        'inputs': jsn['inputs'],
+    }
+    if config.get_config('pipeline.enabled'):
+        return run_async(call_batch_pre, kwargs=call_kwargs, request_info=make_request_info('run_batch'), pool='pre')
+    return run_async(call_batch, kwargs=call_kwargs, request_info=make_request_info('run_batch'))
 
 
 async def run_network_raw(request: web.Request) -> AsyncFuture:
@@ -51,21 +171,47 @@ async def run_network_raw(request: web.Request) -> AsyncFuture:
     low-level run exactly this network with exactly these inputs
     """
     logger.debug('Handling request for method _run')
-    if not request.body_exists:
-        jsn = {}
-    else:
-        try:
-            jsn = await request.json()
-        except json.decoder.JSONDecodeError as e:
-            # TODO: support protobuf input
-            raise errors.InvalidInput('Input should be JSON')
+    jsn = await read_input(request)
 
     # I am not able to come up with an input which np.asarray will fail on
     # It juts coerces everything to object, which onnxruntime should be able to reject smoothly
+    # (binary inputs are already arrays, and np.asarray leaves them alone)
     model_args = {str(k): np.asarray(v) for k, v in jsn.items()}
 
+    package_name = request.match_info['package_name']
+    model_name = request.match_info['model_name']
+    key = await coalesce_key(request, '_run', package_name, model_name)
     return run_async(core.call_raw, kwargs={
-        'package_name': request.match_info['package_name'],
-        'model_name': request.match_info['model_name'],
+        'package_name': package_name,
+        'model_name': model_name,
         'inputs': model_args,
-    }, request_info=make_request_info('_run'))
+    }, request_info=make_request_info('_run'), coalesce_key=key)
+
+
+async def profile_model(request: web.Request) -> AsyncFuture:
+    """
+    Run a model under onnxruntime's profiler, with the package's sample inputs if it has them
+    """
+    logger.debug('Handling request for method profile')
+    params = {}
+    if request.body_exists:
+        validator = cerberus.Validator(schema={
+            'runs': {
+                'type': 'integer',
+                'min': 1,
+                'max': 10000,
+                'default': 10,
+            },
+            'version': {
+                'type': 'string',
+                'nullable': True,
+                'default': None,
+            },
+        })
+        params = await expect_json(request, validator)
+    return run_async(package.load.profile_model, kwargs={
+        'name': request.match_info['package_name'],
+        'model_name': request.match_info['model_name'],
+        'version': params.get('version'),
+        'runs': params.get('runs', 10),
+    }, request_info=make_request_info('profile'))
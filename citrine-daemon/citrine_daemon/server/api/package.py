@@ -18,13 +18,14 @@ logger = logging.getLogger(__name__)
 def get_package_server():
     server = AioServer()
 
-    server.route(web.post, '/fetch', package_fetch, async_=True)
-    server.route(web.post, '/install', package_install, async_=True)
-    server.route(web.post, '/activate', package_activate, async_=True)
-    server.route(web.post, '/deactivate', package_deactivate, async_=True)
-    server.route(web.post, '/remove', package_remove, async_=True)
-    server.route(web.post, '/search', package_search, async_=True)
-    server.route(web.get,  '/list', package_list, async_=True)
+    server.route(web.post, '/fetch', package_fetch, async_=True, pool='download')
+    server.route(web.post, '/install', package_install, async_=True, pool='download')
+    server.route(web.post, '/activate', package_activate, async_=True, pool='package')
+    server.route(web.post, '/deactivate', package_deactivate, async_=True, pool='package')
+    server.route(web.post, '/remove', package_remove, async_=True, pool='package')
+    server.route(web.post, '/optimize', package_optimize, async_=True, pool='package')
+    server.route(web.post, '/search', package_search, async_=True, pool='control')
+    server.route(web.get,  '/list', package_list, async_=True, pool='control')
 
     return server
 
@@ -185,6 +186,27 @@ async def package_remove(request: web.Request) -> AsyncFuture:
     }, request_info=make_request_info('package.remove'))
 
 
+async def package_optimize(request: web.Request) -> AsyncFuture:
+    logger.debug('Handling request for method package.optimize')
+    validator = cerberus.Validator(schema={
+        'name': {
+            'type': 'string',
+            'required': True,
+        },
+        'version': {
+            'type': 'string',
+            'required': False,
+            'nullable': True,
+            'default': None,
+        },
+    })
+    params = await expect_json(request, validator)
+    return run_async(package.install.optimize_package_name, kwargs={
+        'name': params['name'],
+        'version': params['version'],
+    }, request_info=make_request_info('package.optimize'))
+
+
 async def package_list(request: web.Request) -> AsyncFuture:
     logger.debug('Handling request for method package.list')
     return run_async(package.db.list_packages, request_info=make_request_info('package.list'))
@@ -4,7 +4,7 @@ from typing import Any, Callable
 
 import numpy as np
 
-from citrine_daemon.util import encode_tensor
+from citrine_daemon.util import encode_tensor, pack_binary
 
 
 logger = logging.getLogger(__name__)
@@ -26,6 +26,27 @@ class CitrineEncoder(JSONEncoder):
         CitrineEncoder.encoder_registry.append((cls, fn))
 
 
+class BinaryEncoder(CitrineEncoder):
+    """
+    CitrineEncoder that pulls tensors out into raw buffers instead of base64-encoding them
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BinaryEncoder, self).__init__(*args, **kwargs)
+        self.buffers = []
+
+    def default(self, o: Any) -> Any:
+        if isinstance(o, np.ndarray) and o.dtype != object:
+            self.buffers.append(o)
+            return {'dtype': str(o.dtype), 'shape': list(o.shape), 'buffer': len(self.buffers) - 1}
+        return super(BinaryEncoder, self).default(o)
+
+
+def dumps_binary(obj: Any) -> bytearray:
+    encoder = BinaryEncoder()
+    return pack_binary(encoder.encode(obj), encoder.buffers)
+
+
 CitrineEncoder.register_encoder(np.ndarray, encode_tensor)
 CitrineEncoder.register_encoder(np.float32, float)
 CitrineEncoder.register_encoder(np.uint32, int)
@@ -1,6 +1,11 @@
 import asyncio
+from collections import deque, OrderedDict
+import contextvars
+import cProfile
+import heapq
+import itertools
 import logging
-from queue import Queue
+from queue import Full
 import threading
 import time
 from typing import *
@@ -8,15 +13,55 @@ from uuid import uuid4
 
 import stopit
 
-from citrine_daemon import errors, package
+from citrine_daemon import core, errors, metrics, package, profiling
 from citrine_daemon.server.json import CitrineEncoder
+from citrine_daemon.util import approx_size
 
 
 logger = logging.getLogger(__name__)
 
-primary_job_queue = Queue(maxsize=1000)
+worker_pools = {}  # type: Dict[str, WorkerPool]
+default_pool = 'control'
+queue_retry_after = 1
+# Seconds a synchronous request's job may wait to start, when the request doesn't give its own deadline
+sync_deadline = None  # type: Optional[float]
+
+# Most urgent first. Requests pick one with X-Citrine-Priority; see AioServer.route for the defaults
+priorities = ['interactive', 'normal', 'batch']
+default_priority = 'normal'
+# A queued job counts as one priority more urgent for every aging_time seconds it's waited, so nothing starves
+aging_time = 5.0  # type: Optional[float]
+# Client -> jobs it gets per turn within a priority. Everyone else gets 1
+client_weights = {}  # type: Dict[str, int]
 job_cache_hold_time = 60
 job_cache: Dict[str, 'AsyncFuture'] = {}
+# Guards job_cache, expiry_heap and retained_results: request handlers, workers and the janitor all change them
+job_cache_lock = threading.Lock()
+# (cache_expire, tiebreak, uid) for every finished job, soonest first. Jobs dropped early leave their entry behind,
+# and the janitor skips it
+expiry_heap = []  # type: List[Tuple[float, int, str]]
+_expiry_seq = itertools.count()
+# uid -> approximate size of its result, for finished jobs still in job_cache, oldest first
+retained_results = OrderedDict()  # type: OrderedDict[str, int]
+retained_bytes = 0
+max_retained_bytes = 256 * 1024 ** 2
+evicted_results = 0
+# uids of jobs evicted before their hold time was up, so asking for one says so instead of "no such job". Each goes
+# once its expiry_heap entry comes due
+evicted_uids = set()  # type: Set[str]
+# How often the janitor drops expired jobs, and how often it does its slower sweeps (sessions, result cache)
+janitor_interval = 1.0
+maintenance_interval = 60.0
+
+# Jobs take a new number from here whenever anything /async/get shows changes, for ETags. Held while a number is taken
+# and stored, so a cursor from current_version() can't land between the two and miss the change
+_versions = itertools.count(1)
+_versions_lock = threading.Lock()
+
+# Request key -> the job identical requests are being coalesced into
+inflight = {}  # type: Dict[str, AsyncFuture]
+inflight_lock = threading.Lock()
+coalesced_count = 0
 
 thread_local = threading.local()
 thread_local.active_job = None
@@ -32,6 +77,7 @@ class FutureState:
     DONE = 2
     ERROR = -1
     INTERRUPTED = -2
+    TIMED_OUT = -3
 
     @staticmethod
     def get_msg(state):
@@ -41,9 +87,23 @@ class FutureState:
             FutureState.DONE: 'Done',
             FutureState.ERROR: 'Error',
             FutureState.INTERRUPTED: 'Interrupted',
+            FutureState.TIMED_OUT: 'Timed Out',
         }.get(state)
 
 
+class NextStage(object):
+    """
+    Returned from a job's function to hand the rest of the job off to another pool: the job stays In Progress, and
+    carries on with fn once a worker in that pool picks it up
+    """
+
+    def __init__(self, pool: str, fn, args=None, kwargs=None):
+        self.pool = pool
+        self.fn = fn
+        self.args = args or ()
+        self.kwargs = kwargs or {}
+
+
 class AsyncFuture(object):
     """
     Utility for crossing thread boundaries from within an asyncio event loop
@@ -59,28 +119,81 @@ class AsyncFuture(object):
         self.result_val = None
         self.result_exc = None
         self.extra_data = {}
+        # Bumped by touch() whenever state, extra_data or the result change
+        self.version = next(_versions)
+        # Set once the job's outcome (and extra_data) won't change any more
+        self.finished = False
+        # Encoded response bodies, kept once the job is finished so repeated polls don't redo the work. The status
+        # document in encoded, the bare result (what the synchronous endpoint returns) in encoded_results
+        self.encoded = {}  # type: Dict[Hashable, bytes]
+        self.encoded_results = {}  # type: Dict[Hashable, bytes]
+        # Size of what's in those, counted towards max_retained_bytes
+        self.encoded_bytes = 0
 
         self.uid = uuid()  # type: str
         self.thread = None
-        # initialized -> running, interrupted
-        # running -> done, error, interrupted
+        self.enqueued_at = None  # type: Optional[float]
+        # The pool whose queue the job is waiting in, if any, and the priority it's filed under there
+        self.queued_in = None  # type: Optional[WorkerPool]
+        self.queued_priority = None  # type: Optional[int]
+        # time.monotonic() after which nobody wants the result any more, see request_deadline
+        self.deadline = request_deadline.get()  # type: Optional[float]
+        # Index into priorities, and who's asking, for JobQueue
+        self.priority = priorities.index(request_priority.get())  # type: int
+        self.client = request_client.get()  # type: str
+        self.created_at = time.monotonic()
+        # phase -> seconds, see metrics.record
+        self.timings = {}  # type: Dict[str, float]
+        self.metric_labels = ((request_info or {}).get('method', ''), '', '')
+        self.profile = profiling.should_profile(profile_requested.get())
+        self.profiles = []  # type: List[cProfile.Profile]
+        # initialized -> running, interrupted, timed out
+        # running -> done, error, interrupted, timed out (between stages)
         self.state = FutureState.INITIALIZED
         self._state_lock = threading.Lock()
 
+        # Handles on this job, when identical requests were coalesced into it. See SharedJobHandle
+        self.waiters = 0
+        # Set along with the last handle going, so nothing attaches to a job that's about to be interrupted
+        self.abandoned = False
+        self._callbacks = []  # type: List[Callable[[AsyncFuture], None]]
+        self._resolving = False
+        self._resolved = False
+
         self._done = asyncio.Event()
         _event_set = self._done.set
         _threadsafe_call = asyncio.get_running_loop().call_soon_threadsafe
         self.set_done = lambda: _threadsafe_call(_event_set)
-        job_cache[self.uid] = self
+        # Set whenever the job changes, for /async/stream
+        self._watchers = set()  # type: Set[asyncio.Event]
+        self._threadsafe_call = _threadsafe_call
+        cache_job(self)
         
-    def run(self, thread):
+    def run(self, thread) -> bool:
+        """
+        :return: Whether the job was handed off to another pool rather than finished
+        """
         logger.debug('Executing async job')
-        if self.state != FutureState.INITIALIZED:
-            return
+        with self._state_lock:
+            startable = self._queued()
+            if startable:
+                self.thread = thread  # Once this is set, thread can be interrupted
+                if self.state != FutureState.RUNNING:
+                    self.state = FutureState.RUNNING
+                    self.touch()
+        if not startable:
+            # Cancelled while it was waiting in a queue, and already answered for
+            return False
         try:
-            self.thread = thread  # Once this is set, thread can be interrupted
-            self.transition(FutureState.RUNNING)
-            self.result_val = self.fn(*self.args, **self.kwargs)
+            if self.profile:
+                with profiling.profiled(self):
+                    res = self.fn(*self.args, **self.kwargs)
+            else:
+                res = self.fn(*self.args, **self.kwargs)
+            if isinstance(res, NextStage):
+                self.hand_off(res)
+                return True
+            self.result_val = res
             self.transition(FutureState.DONE)
             logger.debug('Async job complete')
         except errors.JobInterrupted as e:
@@ -91,18 +204,151 @@ class AsyncFuture(object):
             self.result_exc = e
             logger.warning('Async job failed')
 
+        self.resolve()
+        return False
+
+    def _queued(self) -> bool:
+        # Waiting for a worker, either to start or (running with no thread) for the next stage after a hand-off.
+        # Call with _state_lock held
+        return self.state == FutureState.INITIALIZED or (self.state == FutureState.RUNNING and self.thread is None)
+
+    def expired(self, now: Optional[float] = None) -> bool:
+        return self.deadline is not None and (now or time.monotonic()) > self.deadline
+
+    def extend_deadline(self, deadline: Optional[float]):
+        # Another caller is waiting on this job too; keep it alive for whichever of them is willing to wait longest
+        with self._state_lock:
+            if self.deadline is not None:
+                self.deadline = None if deadline is None else max(self.deadline, deadline)
+
+    def raise_priority(self, priority: int):
+        # Another caller is waiting on this job too; run it as soon as the most urgent of them wants it
+        with self._state_lock:
+            if priority >= self.priority:
+                return
+            self.priority = priority
+        # Set first, so a queue it goes into after this files it under the new priority
+        pool = self.queued_in
+        if pool is not None:
+            pool.queue.reprioritize(self)
+
+    def time_out(self) -> bool:
+        """
+        Drop the job if it's still waiting for a worker
+        :return: Whether it was dropped
+        """
+        with self._state_lock:
+            if not self._queued():
+                return False
+            self.state = FutureState.TIMED_OUT
+            self.touch()
+        self.result_exc = errors.JobTimedOut(
+            'Job deadline passed before it could run',
+            data={'uid': self.uid, 'waited_s': time.monotonic() - self.created_at},
+        )
+        self.resolve()
+        return True
+
+    def resolve(self):
+        with self._state_lock:
+            # A job cancelled in a queue is resolved right there, and again if a worker gets to it anyway
+            if self._resolving:
+                return
+            self._resolving = True
+        # Everything that should be in extra_data before anyone waiting on the job sees it
+        metrics.finish_job(self)
+        profiling.finish_job(self)
+        self.finished = True
+        self.touch()
         self.set_done()
+        with self._state_lock:
+            self._resolved = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    def add_done_callback(self, callback: Callable[['AsyncFuture'], None]):
+        """
+        Call callback(self) from the worker thread once the job has its result, or right away if it already does
+        """
+        with self._state_lock:
+            if not self._resolved:
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def _run_callback(self, callback: Callable[['AsyncFuture'], None]):
+        try:
+            callback(self)
+        except Exception as e:
+            logger.error('Job callback failed', errors.serialize_unknown_exception(e))
+
+    def release(self):
+        # A handle on this job was cancelled. Only stop the job once nobody is left waiting on it
+        with self._state_lock:
+            self.waiters -= 1
+            abandoned = self.abandoned = (self.waiters <= 0)
+        if abandoned:
+            self.interrupt()
+
+    def attach(self) -> bool:
+        # Count one more handle on this job, unless every earlier one has already let it go
+        with self._state_lock:
+            if self.abandoned:
+                return False
+            self.waiters += 1
+            return True
         
+    def hand_off(self, stage: NextStage):
+        with self._state_lock:
+            self.fn = stage.fn
+            self.args = stage.args
+            self.kwargs = stage.kwargs
+            self.thread = None
+        logger.debug(f'Handing job off to {stage.pool}', {'async_job_id': self.uid, 'pool': stage.pool})
+        get_pool(stage.pool).hand_off(self)
+
     def transition(self, to_state: int):
         with self._state_lock:
             self.state = to_state
+            self.touch()
+
+    def touch(self):
+        with _versions_lock:
+            self.version = next(_versions)
+        self.notify()
+
+    def notify(self):
+        for event in list(self._watchers):
+            self._threadsafe_call(event.set)
+
+    def watch(self) -> asyncio.Event:
+        """
+        :return: An event that gets set (from the event loop) every time the job changes. Clear it before looking
+        """
+        event = asyncio.Event()
+        self._watchers.add(event)
+        return event
+
+    def unwatch(self, event: asyncio.Event):
+        self._watchers.discard(event)
         
     def interrupt(self):
         with self._state_lock:
-            if self.state == FutureState.RUNNING:
+            queued = self._queued()
+            if self.state == FutureState.RUNNING and self.thread is not None:
                 stopit.async_raise(self.thread.ident, errors.JobInterrupted('Interrupted by user'))
             if self.state in {FutureState.RUNNING, FutureState.INITIALIZED}:
                 self.state = FutureState.INTERRUPTED
+                self.touch()
+        if queued:
+            # Nothing to stop, so answer now instead of waiting for a worker to get to it
+            pool = self.queued_in
+            if pool is not None:
+                pool.discard(self)
+            self.result_exc = errors.JobInterrupted('Interrupted by user')
+            self.resolve()
+            retire_job(self)
 
     async def result(self):
         await self._done.wait()
@@ -127,78 +373,710 @@ class AsyncFuture(object):
 CitrineEncoder.register_encoder(AsyncFuture, lambda fut: fut.to_dict())
 
 
-async def run_in_worker(fn, args=None, kwargs=None, request_info=None):
+class SharedJobHandle(object):
+    """
+    One caller's view of a job that identical concurrent requests were coalesced into. Each caller gets its own uid,
+    so one can cancel without pulling the result out from under the others: the job itself is only interrupted once
+    every handle on it has been cancelled.
+
+    Stands in for an AsyncFuture everywhere the server deals with jobs (job_cache, /async/get, wrap_sync)
+    """
+
+    def __init__(self, job: AsyncFuture):
+        self.job = job
+        self.uid = uuid()  # type: str
+        self.request_info = job.request_info
+        self.cache_expire = None
+        self.cancelled = False
+        self.encoded = {}  # type: Dict[Hashable, bytes]
+        self.encoded_bytes = 0
+        # Only moves when this handle is cancelled, otherwise it reports the job's
+        self._version = 0
+        self._lock = threading.Lock()
+
+        self._done = asyncio.Event()
+        _event_set = self._done.set
+        _threadsafe_call = asyncio.get_running_loop().call_soon_threadsafe
+        self.set_done = lambda: _threadsafe_call(_event_set)
+        cache_job(self)
+        job.add_done_callback(self._job_done)
+
+    @property
+    def state(self) -> int:
+        return FutureState.INTERRUPTED if self.cancelled else self.job.state
+
+    @property
+    def extra_data(self) -> Dict:
+        return self.job.extra_data
+
+    @property
+    def metric_labels(self) -> Tuple[str, str, str]:
+        return self.job.metric_labels
+
+    @property
+    def result_val(self) -> Any:
+        return None if self.cancelled else self.job.result_val
+
+    @property
+    def version(self) -> int:
+        return max(self._version, self.job.version)
+
+    @property
+    def finished(self) -> bool:
+        return self.cancelled or self.job.finished
+
+    @property
+    def encoded_results(self) -> Dict[Hashable, bytes]:
+        # Every handle gets the same result, so encode it once for all of them
+        return self.job.encoded_results
+
+    def watch(self) -> asyncio.Event:
+        return self.job.watch()
+
+    def unwatch(self, event: asyncio.Event):
+        self.job.unwatch(event)
+
+    def _job_done(self, job: AsyncFuture):
+        retire_job(self)
+        self.set_done()
+
+    def interrupt(self):
+        with self._lock:
+            if self.cancelled or self.job._resolved:
+                return
+            self.cancelled = True
+            with _versions_lock:
+                self._version = next(_versions)
+        retire_job(self)
+        self.set_done()
+        # Anyone streaming this handle needs to hear it's been cancelled, even though the job carries on
+        self.job.notify()
+        self.job.release()
+
+    async def result(self):
+        await self._done.wait()
+        if self.cancelled:
+            raise errors.JobInterrupted('Interrupted by user')
+        if self.job.result_exc:
+            raise self.job.result_exc
+        return self.job.result_val
+
+    def to_dict(self):
+        res = {
+            'uid': self.uid,
+            'status': FutureState.get_msg(self.state),
+            'data': self.extra_data,
+        }
+        if self.cancelled:
+            res['error'] = errors.JobInterrupted('Interrupted by user')
+            return res
+        if self.job.result_exc:
+            res['error'] = self.job.result_exc
+        if self.job.result_val:
+            res['result'] = self.job.result_val
+        return res
+
+
+CitrineEncoder.register_encoder(SharedJobHandle, lambda handle: handle.to_dict())
+
+
+class ClientRotation(object):
+    """
+    The jobs of one priority in a JobQueue. Each client has its own line, and the clients take turns: a client with
+    weight n gets up to n jobs taken per turn before moving to the back
+    """
+
+    def __init__(self):
+        self.lines = {}  # type: Dict[str, Deque[AsyncFuture]]
+        # Clients with jobs waiting, in the order they're served. The one in front has credit jobs left this turn
+        self.turns = deque()  # type: Deque[str]
+        self.credit = 0
+
+    def __len__(self):
+        return len(self.turns)
+
+    def push(self, fut: AsyncFuture):
+        line = self.lines.get(fut.client)
+        if line is None:
+            line = self.lines[fut.client] = deque()
+            self.turns.append(fut.client)
+        line.append(fut)
+
+    def pop(self) -> AsyncFuture:
+        client = self.turns[0]
+        if self.credit <= 0:
+            self.credit = max(1, client_weights.get(client, 1))
+        line = self.lines[client]
+        fut = line.popleft()
+        self.credit -= 1
+        if not line:
+            self._drop_client(client)
+        elif self.credit <= 0:
+            self.turns.rotate(-1)
+        return fut
+
+    def remove(self, fut: AsyncFuture) -> bool:
+        line = self.lines.get(fut.client)
+        if line is None:
+            return False
+        try:
+            line.remove(fut)
+        except ValueError:
+            return False
+        if not line:
+            self._drop_client(fut.client)
+        return True
+
+    def _drop_client(self, client: str):
+        if self.turns[0] == client:
+            self.turns.popleft()
+            self.credit = 0
+        else:
+            self.turns.remove(client)
+        del self.lines[client]
+
+    def oldest(self) -> float:
+        # Lines are in arrival order, so the oldest job is at the front of one of them
+        return min(line[0].enqueued_at for line in self.lines.values())
+
+
+class JobQueue(object):
+    """
+    Where a WorkerPool's jobs wait for a worker. Jobs come out most urgent priority first, and within a priority
+    clients take turns (see ClientRotation), so one client queueing a thousand batch jobs doesn't hold up anyone
+    else's. Waiting ages a job towards the front, see aging_time.
+
+    Otherwise behaves like the queue.Queue it replaced: blocking put and get, put_nowait raising queue.Full
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.levels = [ClientRotation() for _ in priorities]
+        self.size = 0
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+
+    def qsize(self) -> int:
+        return self.size
+
+    def depths(self) -> Dict[str, int]:
+        with self.mutex:
+            return {
+                name: sum(len(line) for line in level.lines.values())
+                for name, level in zip(priorities, self.levels)
+            }
+
+    def put(self, fut: AsyncFuture, block: bool = True):
+        with self.not_full:
+            if self.maxsize > 0:
+                if not block and self.size >= self.maxsize:
+                    raise Full
+                while self.size >= self.maxsize:
+                    self.not_full.wait()
+            fut.queued_priority = fut.priority
+            self.levels[fut.priority].push(fut)
+            self.size += 1
+            self.not_empty.notify()
+
+    def put_nowait(self, fut: AsyncFuture):
+        self.put(fut, block=False)
+
+    def get(self) -> AsyncFuture:
+        with self.not_empty:
+            while not self.size:
+                self.not_empty.wait()
+            fut = self._next_level(time.monotonic()).pop()
+            fut.queued_priority = None
+            self.size -= 1
+            self.not_full.notify()
+            return fut
+
+    def remove(self, fut: AsyncFuture) -> bool:
+        with self.mutex:
+            if fut.queued_priority is None or not self.levels[fut.queued_priority].remove(fut):
+                return False
+            self.size -= 1
+            self.not_full.notify()
+            return True
+
+    def reprioritize(self, fut: AsyncFuture):
+        # Move a waiting job to the level its (since raised) priority says. It keeps its enqueued_at, so aging still
+        # counts from when it first arrived
+        with self.mutex:
+            if fut.queued_priority is None or fut.queued_priority == fut.priority:
+                return
+            if self.levels[fut.queued_priority].remove(fut):
+                fut.queued_priority = fut.priority
+                self.levels[fut.priority].push(fut)
+
+    def _next_level(self, now: float) -> ClientRotation:
+        # Call with mutex held, and something in the queue
+        best, best_rank = None, None
+        for idx, level in enumerate(self.levels):
+            if not level:
+                continue
+            rank = idx
+            if aging_time:
+                rank -= int((now - level.oldest()) // aging_time)
+            # Ties go to the more urgent level
+            if best is None or rank < best_rank:
+                best, best_rank = level, rank
+        return best
+
+
+class WorkerPool(object):
+    """
+    A named job queue with its own set of worker threads, so that slow work of one kind (downloads, package loads)
+    can't hold up another (inference)
+    """
+
+    def __init__(self, name: str, n_workers: int, queue_size: int):
+        self.name = name
+        self.n_workers = n_workers
+        self.queue = JobQueue(maxsize=queue_size)
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        # Jobs dropped from the queue without running: past their deadline, or cancelled while waiting
+        self.timed_out = 0
+        self.cancelled = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self._stats_lock = threading.Lock()
+        self.threads = []  # type: List[threading.Thread]
+
+    def start(self):
+        logger.info(f'Booting {self.name} threadpool', {'pool': self.name, 'workers': self.n_workers})
+        for idx in range(self.n_workers):
+            thread = threading.Thread(
+                name=f'{self.name}-worker-{idx}',
+                target=worker_thread,
+                args=(self, idx),
+                daemon=True,
+            )
+            self.threads.append(thread)
+            thread.start()
+
+    def submit(self, fut: AsyncFuture) -> None:
+        # Called from the event loop, so this must never block: a full queue is reported back to the client instead
+        fut.enqueued_at = time.monotonic()
+        fut.queued_in = self
+        try:
+            self.queue.put_nowait(fut)
+        except Full:
+            fut.queued_in = None
+            uncache_job(fut.uid)
+            self.rejected += 1
+            logger.warning(
+                f'Job queue {self.name} is full; rejecting job',
+                {'async_job_id': fut.uid, 'pool': self.name},
+            )
+            raise errors.ServerBusy(
+                'Server is at capacity, try again later',
+                retry_after=queue_retry_after,
+                data={'pool': self.name, 'queue_depth': self.queue.qsize(), 'retry_after': queue_retry_after},
+            )
+        self.submitted += 1
+
+    def hand_off(self, fut: AsyncFuture) -> None:
+        # Called from the previous stage's worker thread. Blocking here when this stage is backed up is the point:
+        # it slows the earlier stage down instead of letting work pile up in between
+        fut.enqueued_at = time.monotonic()
+        fut.queued_in = self
+        self.queue.put(fut)
+        self.submitted += 1
+
+    def discard(self, fut: AsyncFuture) -> bool:
+        """
+        Take a cancelled job out of the queue, so it doesn't hold a place in it until a worker comes along
+        :return: Whether it was still queued
+        """
+        if not self.queue.remove(fut):
+            return False
+        with self._stats_lock:
+            self.cancelled += 1
+        return True
+
+    def record_timed_out(self):
+        with self._stats_lock:
+            self.timed_out += 1
+
+    def record(self, wait_time: float, run_time: float):
+        with self._stats_lock:
+            self.completed += 1
+            self.wait_time += wait_time
+            self.run_time += run_time
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            completed = self.completed
+            wait_time = self.wait_time
+            run_time = self.run_time
+            timed_out = self.timed_out
+            cancelled = self.cancelled
+        return {
+            'workers': self.n_workers,
+            'depth': self.queue.qsize(),
+            'depth_by_priority': self.queue.depths(),
+            'max_size': self.queue.maxsize,
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'completed': completed,
+            'timed_out': timed_out,
+            'cancelled': cancelled,
+            'mean_wait_ms': 1000 * wait_time / completed if completed else None,
+            'mean_run_ms': 1000 * run_time / completed if completed else None,
+        }
+
+
+# Set per request by AioServer.route: time.monotonic() by which the job must have started, or None to wait forever
+request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+# Set per request by AioServer.route, from X-Citrine-Priority / X-Citrine-Client or the route's defaults
+request_priority = contextvars.ContextVar('request_priority', default=default_priority)
+request_client = contextvars.ContextVar('request_client', default='')
+
+
+# Set per request by AioServer.route when the client asks for the job to be profiled
+profile_requested = contextvars.ContextVar('profile_requested', default=False)
+
+
+# Which pool run_async sends jobs to. Set per request by AioServer.route, so handlers don't need to know about pools
+submit_pool = contextvars.ContextVar('submit_pool', default=default_pool)
+
+
+def get_pool(name: str) -> WorkerPool:
+    if name not in worker_pools:
+        raise errors.InternalError(f'No worker pool named {name}', data={'pool': name})
+    return worker_pools[name]
+
+
+async def run_in_worker(fn, args=None, kwargs=None, request_info=None, pool: str = None):
     fut = AsyncFuture(fn, args, kwargs, request_info)
-    primary_job_queue.put(fut)
+    get_pool(pool or submit_pool.get()).submit(fut)
     return await fut.result()
 
 
-def run_async(fn, args=None, kwargs=None, request_info=None):
+def run_async(fn, args=None, kwargs=None, request_info=None, pool: str = None, coalesce_key: str = None):
+    """
+    :param coalesce_key: Identifies the request. While a job with the same key is queued or running, the caller is
+        attached to that job instead of starting another
+    """
+    if coalesce_key is not None:
+        return run_coalesced(coalesce_key, fn, args, kwargs, request_info, pool)
     fut = AsyncFuture(fn, args, kwargs, request_info)
-    logger.debug(f'Queueing async job {fut.uid}', {'async_job_id': fut.uid})
-    primary_job_queue.put(fut)
+    pool = pool or submit_pool.get()
+    logger.debug(f'Queueing async job {fut.uid} on {pool}', {'async_job_id': fut.uid, 'pool': pool})
+    get_pool(pool).submit(fut)
     return fut
 
 
+def run_coalesced(key: str, fn, args, kwargs, request_info, pool: Optional[str]) -> SharedJobHandle:
+    global coalesced_count
+    with inflight_lock:
+        job = inflight.get(key)
+        if job is not None and job.state in {FutureState.INITIALIZED, FutureState.RUNNING} and job.attach():
+            coalesced_count += 1
+            job.extend_deadline(request_deadline.get())
+            job.raise_priority(priorities.index(request_priority.get()))
+            handle = SharedJobHandle(job)
+            logger.debug(f'Attached to in-flight job {job.uid}', {'async_job_id': handle.uid, 'shared_job': job.uid})
+            return handle
+
+    job = AsyncFuture(fn, args, kwargs, request_info)
+    # Only reachable through its handles, so that cancelling goes through the waiter count
+    uncache_job(job.uid)
+    pool = pool or submit_pool.get()
+    logger.debug(f'Queueing async job {job.uid} on {pool}', {'async_job_id': job.uid, 'pool': pool})
+    get_pool(pool).submit(job)
+
+    with inflight_lock:
+        # Replaces an abandoned job still winding down under the same key
+        inflight[key] = job
+        job.attach()
+        handle = SharedJobHandle(job)
+    job.add_done_callback(lambda done_job: drop_inflight(key, done_job))
+    return handle
+
+
+def drop_inflight(key: str, job: AsyncFuture):
+    with inflight_lock:
+        if inflight.get(key) is job:
+            del inflight[key]
+
+
+def get_queue_stats() -> Dict:
+    with job_cache_lock:
+        jobs = {
+            'cached': len(job_cache),
+            'retained_results': len(retained_results),
+            'retained_bytes': retained_bytes,
+            'max_retained_bytes': max_retained_bytes,
+            'evicted': evicted_results,
+        }
+    return {
+        'pools': {name: pool.stats() for name, pool in worker_pools.items()},
+        'coalescing': {'inflight': len(inflight), 'coalesced': coalesced_count},
+        'jobs': jobs,
+    }
+
+
 def get_future(uid: str) -> AsyncFuture:
-    if uid in job_cache:
-        return job_cache[uid]
-    raise errors.NoSuchJob(f'No such job {uid}', data={'uid': uid})
+    with job_cache_lock:
+        fut = job_cache.get(uid)
+        evicted = uid in evicted_uids
+    if evicted:
+        raise errors.JobEvicted(f'Job {uid} finished, but its result was dropped to save memory', data={'uid': uid})
+    if fut is None:
+        raise errors.NoSuchJob(f'No such job {uid}', data={'uid': uid})
+    return fut
+
+
+def current_version() -> int:
+    """
+    A cursor for changes to jobs: anything that changes after this is called gets a higher version
+    """
+    with _versions_lock:
+        return next(_versions)
+
+
+def get_many(uids: List[str], since: Optional[int] = None, results: bool = False) -> Dict:
+    """
+    Compact status of a lot of jobs at once
+    :param since: A version from an earlier call; only jobs that have changed after it are included
+    :param results: Include each job's data and result, not just its status (and error, if it has one)
+    """
+    # Taken first, so anything that changes while we look is newer than it
+    cursor = current_version()
+    with job_cache_lock:
+        found = {uid: job_cache.get(uid) for uid in uids}
+        evicted = [uid for uid in uids if uid in evicted_uids]
+    jobs = {}
+    missing = []
+    for uid, fut in found.items():
+        if fut is None:
+            if uid not in evicted:
+                missing.append(uid)
+            continue
+        version = fut.version
+        if since is not None and version <= since:
+            continue
+        full = fut.to_dict()
+        summary = {'status': full['status'], 'version': version}
+        if 'error' in full:
+            summary['error'] = full['error']
+        if results:
+            summary['data'] = full['data']
+            if 'result' in full:
+                summary['result'] = full['result']
+        jobs[uid] = summary
+    return {'version': cursor, 'jobs': jobs, 'missing': missing, 'evicted': evicted}
+
+
+def cache_job(job: Union[AsyncFuture, 'SharedJobHandle']):
+    with job_cache_lock:
+        job_cache[job.uid] = job
+
+
+def uncache_job(uid: str):
+    with job_cache_lock:
+        job_cache.pop(uid, None)
+        _forget_result(uid)
+
+
+def retire_job(job: Union[AsyncFuture, 'SharedJobHandle']):
+    """
+    The job is finished: keep it around for job_cache_hold_time so the client can collect the result, unless finished
+    jobs' results are taking up more than max_retained_bytes, in which case the oldest go first. This job's own result
+    is always kept, even if it's over the cap by itself
+    """
+    # Handles on a shared job each count its result, so this overestimates. Better than letting them through free
+    size = approx_size(job.result_val) if job.result_val is not None else 0
+    global retained_bytes
+    with job_cache_lock:
+        if job.cache_expire is not None:
+            return
+        size += job.encoded_bytes
+        job.cache_expire = time.time() + job_cache_hold_time
+        heapq.heappush(expiry_heap, (job.cache_expire, next(_expiry_seq), job.uid))
+        if job.uid not in job_cache:
+            return
+        retained_results[job.uid] = size
+        retained_bytes += size
+        _evict_results(keep=job.uid)
+
+
+def keep_encoded(job: Union[AsyncFuture, 'SharedJobHandle'], memo: Dict[Hashable, bytes], key: Hashable, body: bytes):
+    """
+    Hold on to an encoded response for a finished job, counting it towards max_retained_bytes
+    """
+    global retained_bytes
+    with job_cache_lock:
+        if key in memo:
+            return
+        memo[key] = body
+        job.encoded_bytes += len(body)
+        if job.uid in retained_results:
+            retained_results[job.uid] += len(body)
+            retained_bytes += len(body)
+            _evict_results(keep=job.uid)
+
+
+def _evict_results(keep: str):
+    """
+    Drop the oldest finished jobs until their results fit under max_retained_bytes again, never keep itself: its
+    client hasn't had a chance to collect it yet. Call with job_cache_lock held
+    """
+    global retained_bytes, evicted_results
+    if retained_bytes <= max_retained_bytes:
+        return
+    for old_uid in list(retained_results):
+        if retained_bytes <= max_retained_bytes:
+            break
+        if old_uid == keep:
+            continue
+        # Whoever's still waiting synchronously holds on to the job itself, so this only stops /async/get
+        retained_bytes -= retained_results.pop(old_uid)
+        job_cache.pop(old_uid, None)
+        evicted_uids.add(old_uid)
+        evicted_results += 1
+        logger.debug('Evicting finished job to keep retained results under the cap', {'async_job_id': old_uid})
+
+
+def _forget_result(uid: str):
+    # Call with job_cache_lock held
+    global retained_bytes
+    retained_bytes -= retained_results.pop(uid, 0)
+
+
+def expire_jobs(now: float) -> int:
+    """
+    Drop finished jobs that have been held for long enough
+    :return: How many were dropped
+    """
+    expired = 0
+    with job_cache_lock:
+        while expiry_heap and expiry_heap[0][0] < now:
+            _, _, uid = heapq.heappop(expiry_heap)
+            if job_cache.pop(uid, None) is not None:
+                expired += 1
+            _forget_result(uid)
+            evicted_uids.discard(uid)
+    return expired
 
 
 def get_active_job() -> Optional[AsyncFuture]:
     return getattr(thread_local, 'active_job', None)
 
 
-def worker_thread(worker_id: int):
-    logger.info(f'Worker {worker_id} initialized')
+def worker_thread(pool: WorkerPool, worker_id: int):
+    logger.info(f'Worker {pool.name}-{worker_id} initialized')
     self = threading.current_thread()
     while True:
-        job: AsyncFuture = primary_job_queue.get()
+        job: AsyncFuture = pool.queue.get()
+        job.queued_in = None
+        t_start = time.monotonic()
+        if job.expired(t_start):
+            # Whoever asked for it has given up by now; don't spend a worker on it
+            if job.time_out():
+                pool.record_timed_out()
+                retire_job(job)
+                logger.info(
+                    'Dropping async job past its deadline',
+                    {'async_job_id': job.uid, 'pool': pool.name, 'late_s': t_start - job.deadline},
+                )
+            continue
         thread_local.active_job = job
         logger.debug('Worker starting async job')
-        package.db.start_connection()
+        # Read it now: once the job's been handed on, the next stage's queue overwrites it
+        wait_time = t_start - (job.enqueued_at or t_start)
+        metrics.record('queue_wait', wait_time)
+        metrics.observe_queue_wait(pool.name, priorities[job.priority], wait_time)
+        package.db.begin_transaction()
+        handed_off = False
         try:
-            job.run(self)
+            handed_off = job.run(self)
         except errors.JobInterrupted:
             pass
-        package.db.end_connection(commit=(job.state == FutureState.DONE))
-        job.cache_expire = time.time() + job_cache_hold_time
+        pool.record(wait_time=wait_time, run_time=time.monotonic() - t_start)
+        try:
+            package.db.end_transaction(commit=(job.state == FutureState.DONE or handed_off))
+        except Exception as e:
+            # Don't let a bad commit take the worker down with it; start over with a fresh connection instead
+            logger.error('Failed to finish job transaction', errors.serialize_unknown_exception(e))
+            package.db.close_connection()
+        if not handed_off:
+            retire_job(job)
         logger.debug('Worker finished async job')
         thread_local.active_job = None
         
         
 def janitor_thread():
     logger.info('Janitor initialized')
+    next_maintenance = time.monotonic() + maintenance_interval
     while True:
-        time.sleep(job_cache_hold_time)
-        t = time.time()
-        purge_jobs = []
-        for job_id, cached_job in job_cache.items():
-            if cached_job.cache_expire is None:
-                continue
-            if cached_job.cache_expire < t:
-                purge_jobs.append(job_id)
-        for job_id in purge_jobs:
-            job_cache.pop(job_id)
+        time.sleep(janitor_interval)
+        # Only looks at the jobs that are due, so it's cheap to do often
+        expire_jobs(time.time())
+        if time.monotonic() < next_maintenance:
+            continue
+        next_maintenance = time.monotonic() + maintenance_interval
+        core.nn.expire_sessions()
+        core.memo.expire_results()
+
+
+def init_job_cache(hold_time: float, max_result_bytes: int):
+    """
+    :param hold_time: Seconds a finished job is kept for its client to collect
+    :param max_result_bytes: Cap on the results of finished jobs held in the meantime
+    """
+    global job_cache_hold_time, max_retained_bytes
+    logger.info('Configuring job cache', {'hold_time': hold_time, 'max_result_bytes': max_result_bytes})
+    job_cache_hold_time = hold_time
+    max_retained_bytes = max_result_bytes
 
 
 def job_put_extra(key: str, value: any):
-    fut: AsyncFuture = thread_local.active_job
+    fut = get_active_job()
+    if fut is None:
+        # Package code running in an inference process sends it back to the daemon's job with the outputs
+        if not core.procpool.put_extra(key, value):
+            logger.debug('No active job for extra data; dropping it', {'key': key})
+        return
     fut.extra_data[key] = value
+    fut.touch()
 
 
-def init_workers(n_workers: int):
-    logger.info('Booting threadpool')
-    threadpool = []
-    for idx in range(n_workers):
-        threadpool.append(threading.Thread(
-            name=f'worker-{idx}',
-            target=worker_thread,
-            args=(idx,),
-            daemon=True,
-        ))
-    [t.start() for t in threadpool]
+def init_workers(
+        pools: Dict[str, int],
+        queue_size: int,
+        retry_after: float,
+        queue_sizes: Optional[Dict[str, int]] = None,
+        default_deadline: Optional[float] = None,
+        aging: Optional[float] = 5.0,
+        weights: Optional[Dict[str, int]] = None,
+):
+    """
+    :param queue_sizes: Per-pool overrides of queue_size, e.g. short queues between pipeline stages
+    :param default_deadline: Seconds a synchronous request's job may wait to start, if the request doesn't say. 0 or
+        None for no default deadline
+    :param aging: Seconds of waiting that move a queued job up one priority. 0 (or None) for strict priorities
+    :param weights: Per-client weights, for taking turns within a priority
+    """
+    global queue_retry_after, sync_deadline, aging_time
+    queue_retry_after = retry_after
+    sync_deadline = default_deadline if default_deadline and default_deadline > 0 else None
+    aging_time = aging
+    client_weights.update(weights or {})
+    queue_sizes = queue_sizes or {}
+    for name, n_workers in pools.items():
+        worker_pools[name] = WorkerPool(name, n_workers, queue_sizes.get(name, queue_size))
+    if default_pool not in worker_pools:
+        worker_pools[default_pool] = WorkerPool(default_pool, 1, queue_size)
+    for pool in worker_pools.values():
+        pool.start()
     threading.Thread(
         name='janitor',
         target=janitor_thread,
@@ -1,5 +1,10 @@
+import glob
 import logging
 import os
+import re
+from typing import List
+
+import onnxruntime
 
 import citrine_daemon.package.db as db
 from citrine_daemon.config import get_config
@@ -15,6 +20,9 @@ __all__ = [
     'get_package_module',
     'get_package_meta',
     'get_model_file',
+    'get_optimized_model_file',
+    'get_stale_optimized_model_files',
+    'is_optimized_model_file',
     'init_storage',
 ]
 
@@ -51,10 +59,40 @@ def get_package_meta(package: db.DBPackage) -> str:
     return os.path.join(package_path(), package.install_path, 'meta.json')
 
 
-def get_model_file(model: db.DBModel) -> str:
+def get_model_file(model: db.DBModel, optimized: bool = True) -> str:
+    # Prefer the graph-optimized copy written at install time, if there is one for this onnxruntime
+    if optimized and get_config('optimization.enabled'):
+        optimized_file = get_optimized_model_file(model)
+        if os.path.isfile(optimized_file):
+            return optimized_file
     return os.path.join(package_path(), model.install_path)
 
 
+# Optimized models are stored next to the original as <model>.ort-<onnxruntime version>-<level>.onnx
+# Optimizations are specific to the onnxruntime that made them, so a new version just won't find its file
+_optimized_re = re.compile(r'\.ort-[^/\\]+-[a-z]+\.onnx$')
+
+
+def get_optimized_model_file(model: db.DBModel, level: str = None) -> str:
+    if level is None:
+        level = get_config('optimization.level')
+    base, ext = os.path.splitext(model.install_path)
+    return os.path.join(package_path(), f'{base}.ort-{onnxruntime.__version__}-{level}{ext}')
+
+
+def get_stale_optimized_model_files(model: db.DBModel) -> List[str]:
+    base, ext = os.path.splitext(model.install_path)
+    current = get_optimized_model_file(model)
+    return [
+        fpath for fpath in glob.glob(os.path.join(package_path(), f'{glob.escape(base)}.ort-*{ext}'))
+        if fpath != current
+    ]
+
+
+def is_optimized_model_file(fpath: str) -> bool:
+    return bool(_optimized_re.search(fpath))
+
+
 def init_storage():
     logger.info(f'Initializing citrine storage at {root_path()}', {'root_path': root_path()})
     for path in [
@@ -1,4 +1,6 @@
 import base64
+import json
+import struct
 from typing import *
 
 import numpy as np
@@ -27,6 +29,22 @@ def truncate_str(obj: Any, maxlength: int) -> str:
     return s
 
 
+def approx_size(obj: Any) -> int:
+    """
+    Rough memory footprint of a result document, in bytes. Only meant to be good enough to budget caches with:
+    tensors and strings are counted, everything else is a flat guess
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes + 100
+    if isinstance(obj, (str, bytes, bytearray)):
+        return len(obj) + 50
+    if isinstance(obj, dict):
+        return 100 + sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return 50 + sum(approx_size(v) for v in obj)
+    return 30
+
+
 def encode_tensor(arr: np.ndarray) -> Dict:
     if not arr.flags.c_contiguous:
         arr = arr.copy(order='C')
@@ -41,3 +59,72 @@ def encode_tensor(arr: np.ndarray) -> Dict:
 def decode_tensor(t: Dict) -> np.ndarray:
     arr = np.frombuffer(base64.b64decode(t['data']), t['dtype'])
     return arr.reshape(t['shape'])
+
+
+# Binary wire format: tensors travel as raw buffers next to a JSON document instead of base64 inside it
+#   b'CTRN' | uint32 LE header length | header JSON | padding | buffers
+# The header is {"doc": <document>, "buffers": [[offset, nbytes], ...]}, where each tensor in the document is replaced
+# by {"dtype": ..., "shape": ..., "buffer": <index>}. Offsets are relative to the (aligned) start of the buffer section,
+# and every buffer is aligned so it can be viewed with np.frombuffer without copying.
+binary_content_type = 'application/x-citrine-binary'
+_binary_magic = b'CTRN'
+_binary_align = 64
+
+
+def _align(n: int) -> int:
+    return (n + _binary_align - 1) // _binary_align * _binary_align
+
+
+def pack_binary(doc_json: str, buffers: List[np.ndarray]) -> bytearray:
+    layout = []
+    offset = 0
+    for arr in buffers:
+        offset = _align(offset)
+        layout.append((offset, arr.nbytes))
+        offset += arr.nbytes
+
+    header = f'{{"doc": {doc_json}, "buffers": {json.dumps(layout)}}}'.encode('utf-8')
+    prefix_len = len(_binary_magic) + 4 + len(header)
+    data_start = _align(prefix_len)
+
+    out = bytearray(data_start + offset)
+    out[:prefix_len] = _binary_magic + struct.pack('<I', len(header)) + header
+    for arr, (buf_offset, nbytes) in zip(buffers, layout):
+        start = data_start + buf_offset
+        # Not memoryview(...).cast('B'), which refuses arrays with a zero-length axis
+        out[start:start + nbytes] = memoryview(np.ascontiguousarray(arr).reshape(-1).view(np.uint8))
+    return out
+
+
+def unpack_binary(data: bytes) -> Any:
+    if len(data) < 8 or data[:4] != _binary_magic:
+        raise errors.InvalidInput('Binary request is missing the citrine header')
+    header_len, = struct.unpack_from('<I', data, 4)
+    header_end = 8 + header_len
+    try:
+        header = json.loads(bytes(data[8:header_end]).decode('utf-8'))
+        doc = header['doc']
+        layout = header['buffers']
+    except (UnicodeDecodeError, json.JSONDecodeError, KeyError, TypeError):
+        raise errors.InvalidInput('Binary request header is not valid')
+    data_start = _align(header_end)
+
+    def decode_ref(ref: Dict) -> np.ndarray:
+        try:
+            buf_offset, nbytes = layout[ref['buffer']]
+            dtype = np.dtype(ref['dtype'])
+            arr = np.frombuffer(data, dtype, count=nbytes // dtype.itemsize, offset=data_start + buf_offset)
+            return arr.reshape(ref['shape'])
+        except (IndexError, KeyError, TypeError, ValueError) as e:
+            raise errors.InvalidTensor(f'Could not decode binary tensor: {e}')
+
+    def walk(obj: Any) -> Any:
+        if isinstance(obj, dict):
+            if obj.keys() == {'dtype', 'shape', 'buffer'}:
+                return decode_ref(obj)
+            return {k: walk(v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [walk(v) for v in obj]
+        return obj
+
+    return walk(doc)